@@ -46,6 +46,7 @@ class RasterMapIndexer(object):
         self.subscriber = ZmqSubscriber(**ZmqSubscriber.getOptionValues(self.opts))
         self.cacheDir = os.path.join(DATA_PATH, 'cache')
         self.store = None
+        self.commitTimer = None
         self.delayBox = DelayBox(self.writeOutputTile,
                                  maxDelaySeconds=5,
                                  numBuckets=10)
@@ -82,9 +83,19 @@ class RasterMapIndexer(object):
             print '# initializing map index:', index.valueCode
             print '###################################################'
             index.start()
+        if settings.XGDS_PLOT_MAP_MBTILES:
+            # make tiles written since the last batch commit visible
+            self.commitTimer = ioloop.PeriodicCallback(self.commitTiles, 1000)
+            self.commitTimer.start()
+
+    def commitTiles(self):
+        for index in self.indexes.itervalues():
+            index.commitTiles()
 
     def stop(self):
         logging.info('cleaning up indexer...')
+        if self.commitTimer is not None:
+            self.commitTimer.stop()
         self.store.sync()
         self.delayBox.stop()
         for index in self.indexes.itervalues():
@@ -96,6 +107,11 @@ class RasterMapIndexer(object):
         for index in self.indexes.itervalues():
             index.clean()
 
+    def rebuildPyramid(self):
+        for index in self.indexes.itervalues():
+            print '--> rebuilding tile pyramid for', index.valueCode
+            index.rebuildPyramid()
+
 
 def main():
     import optparse
@@ -109,6 +125,9 @@ def main():
     parser.add_option('-q', '--quit',
                       action='store_true', default=False,
                       help='Quit after initial indexing is complete')
+    parser.add_option('--rebuildPyramid',
+                      action='store_true', default=False,
+                      help='Re-smooth the finest zoom level and rebuild coarser levels from it after initial indexing')
     opts, args = parser.parse_args()
     if args:
         parser.error('expected no args')
@@ -125,6 +144,8 @@ def main():
     if opts.clean:
         rmi.clean()
     rmi.start()
+    if opts.rebuildPyramid:
+        rmi.rebuildPyramid()
     atexit.register(rmi.stop)
     if not opts.quit:
         zmqLoop()
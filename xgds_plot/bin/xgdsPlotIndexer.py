@@ -19,6 +19,7 @@ import sys
 import atexit
 import logging
 import signal
+import multiprocessing
 
 from zmq.eventloop import ioloop
 ioloop.install()
@@ -26,8 +27,30 @@ ioloop.install()
 from geocamUtil.zmqUtil.subscriber import ZmqSubscriber
 from geocamUtil.zmqUtil.util import zmqLoop
 
+from django import db
+
+from geocamUtil import TimeUtil
+
 from xgds_plot.meta import TIME_SERIES, TIME_SERIES_LOOKUP
-from xgds_plot.segmentIndex import SegmentIndex
+from xgds_plot.segmentIndex import (SegmentIndex, SegmentIndexGroup, batchIndexShard,
+                                    LIVE_FLUSH_INTERVAL_SECONDS)
+from xgds_plot.plotUtil import parseTime
+
+
+def batchIndexWorker(metaList):
+    """
+    Run initial batch indexing for one group of time series in a worker
+    process. Results are flushed to the segment cache and status files,
+    where the parent process picks them up.
+    """
+    group = SegmentIndexGroup(metaList, None)
+    group.start()
+    group.stop()
+    return group.valueCode
+
+
+def batchIndexShardWorker(args):
+    return args[0]['valueCode'], batchIndexShard(*args)
 
 
 class XgdsPlotIndexer(object):
@@ -45,22 +68,109 @@ class XgdsPlotIndexer(object):
         else:
             timeSeriesList = TIME_SERIES
         self.subscriber = ZmqSubscriber(**ZmqSubscriber.getOptionValues(self.opts))
+        self.flushTimer = None
+        # time series that read the same table share one query
+        self.groups = []
         self.indexes = {}
-        for meta in timeSeriesList:
-            index = SegmentIndex(meta, self.subscriber)
-            self.indexes[meta['valueCode']] = index
+        for metaList in SegmentIndexGroup.groupTimeSeries(timeSeriesList):
+            group = SegmentIndexGroup(metaList, self.subscriber)
+            self.groups.append(group)
+            for index in group.indexes:
+                self.indexes[index.valueCode] = index
+
+    def parallelBatchIndex(self, numWorkers):
+        print ('--> batch indexing %d groups of time series with %d worker processes'
+               % (len(self.groups), numWorkers))
+
+        # each worker must open its own database connection
+        db.connections.close_all()
+
+        pool = multiprocessing.Pool(processes=numWorkers, maxtasksperchild=1)
+        metaLists = [[index.meta for index in group.indexes]
+                     for group in self.groups]
+        for valueCode in pool.imap_unordered(batchIndexWorker, metaLists):
+            print '--> worker finished batch indexing %s' % valueCode
+        pool.close()
+        pool.join()
+
+    def shardedBatchIndex(self, numWorkers, numShards):
+        """
+        Split the backlog of each time series into @numShards time
+        intervals, index the intervals in parallel, then merge the results
+        into the main index and build the pyramid.
+        """
+        indexes = {}
+        tasks = []
+        for valueCode, index in self.indexes.iteritems():
+            # start first, so the intervals begin after any samples
+            # recovered from the log
+            mainIndex = SegmentIndex(index.meta, None, batchIndexAtStart=False)
+            mainIndex.start()
+            intervals = mainIndex.getShardIntervals(numShards)
+            for shardIndex, (minTime, maxTime) in enumerate(intervals):
+                tasks.append((index.meta, shardIndex, minTime, maxTime))
+            if intervals:
+                indexes[valueCode] = mainIndex
+            else:
+                mainIndex.stop()
+        print ('--> batch indexing %d time series in %d shards with %d worker processes'
+               % (len(indexes), len(tasks), numWorkers))
+
+        # each worker must open its own database connection
+        db.connections.close_all()
+
+        pool = multiprocessing.Pool(processes=numWorkers, maxtasksperchild=1)
+        for valueCode, shardResult in pool.imap_unordered(batchIndexShardWorker, tasks):
+            print '--> worker finished shard %d of %s' % (shardResult[0], valueCode)
+            indexes[valueCode].mergeShard(shardResult)
+        pool.close()
+        pool.join()
+
+        for index in indexes.itervalues():
+            index.finishShardMerge()
+            index.stop()
+
+    def reindexFrom(self, posixTimeMs):
+        """
+        Delete the indexed data from @posixTimeMs onward, so that
+        start() reindexes only that part of each time series.
+        """
+        for index in self.indexes.itervalues():
+            clearIndex = SegmentIndex(index.meta, None, batchIndexAtStart=False)
+            clearIndex.start()
+            clearIndex.clearFrom(posixTimeMs)
+            clearIndex.stop()
 
     def start(self):
+        if self.opts.shards > 1:
+            self.shardedBatchIndex(max(self.opts.workers, 1), self.opts.shards)
+        elif self.opts.workers > 1:
+            # the groups started below only need to catch up on data that
+            # arrived while the workers were running
+            self.parallelBatchIndex(self.opts.workers)
+
         self.subscriber.start()
-        for index in self.indexes.itervalues():
+        for group in self.groups:
             print
             print '###################################################'
-            print '# initializing time series:', index.valueCode
+            print '# initializing time series:', group.valueCode
             print '###################################################'
-            index.start()
+            group.start()
+        # index live records in batches and publish finished segments
+        self.flushTimer = ioloop.PeriodicCallback(self.flushIndexes,
+                                                  LIVE_FLUSH_INTERVAL_SECONDS * 1000)
+        self.flushTimer.start()
+
+    def flushIndexes(self):
+        for group in self.groups:
+            group.flushLiveQueue()
+        for index in self.indexes.itervalues():
+            index.flushManifests()
 
     def stop(self):
         logging.info('cleaning up indexer...')
+        if self.flushTimer is not None:
+            self.flushTimer.stop()
         for index in self.indexes.itervalues():
             index.stop()
         logging.info('  ... done')
@@ -69,6 +179,11 @@ class XgdsPlotIndexer(object):
         for index in self.indexes.itervalues():
             index.clean()
 
+    def rebuildPyramid(self):
+        for index in self.indexes.itervalues():
+            print '--> rebuilding segment pyramid for', index.valueCode
+            index.rebuildPyramid()
+
 
 def main():
     import optparse
@@ -80,6 +195,17 @@ def main():
     parser.add_option('-q', '--quit',
                       action='store_true', default=False,
                       help='Quit after initial indexing is complete')
+    parser.add_option('-w', '--workers',
+                      type='int', default=1,
+                      help='Number of processes to use for initial batch indexing [%default]')
+    parser.add_option('--shards',
+                      type='int', default=1,
+                      help='Split initial batch indexing of each time series into this many time intervals indexed in parallel by the worker processes [%default]')
+    parser.add_option('--reindexFrom',
+                      help='Delete indexed data from this time onward and reindex it, e.g. "2015-06-01 12:00" (display time zone), an epoch time in ms, or negative hours from now')
+    parser.add_option('--rebuildPyramid',
+                      action='store_true', default=False,
+                      help='Rebuild coarse segment levels from the finest level after initial indexing')
     parser.add_option('--timeSeries',
                       help='Comma-separated list of time series to index (by default index all)')
     opts, args = parser.parse_args()
@@ -97,7 +223,11 @@ def main():
     x = XgdsPlotIndexer(opts)
     if opts.clean:
         x.clean()
+    elif opts.reindexFrom:
+        x.reindexFrom(TimeUtil.utcDateTimeToPosix(parseTime(opts.reindexFrom)) * 1000)
     x.start()
+    if opts.rebuildPyramid:
+        x.rebuildPyramid()
     atexit.register(x.stop)
     if not opts.quit:
         zmqLoop()
@@ -36,6 +36,63 @@ XGDS_PLOT_SEGMENT_RESOLUTION = 512
 # load and display at least N data points (and might be up to 2N)
 XGDS_PLOT_MIN_DISPLAY_RESOLUTION = 384
 
+# during batch indexing, populate only the finest segment level from the
+# raw data and build coarser levels by merging pairs of finer segments.
+# this makes large batch jobs faster, but the coarser levels only appear
+# when the batch finishes, so it is off by default.
+XGDS_PLOT_BOTTOM_UP_PYRAMID = False
+
+# segment file formats to write: 'json' and/or 'bin'. the binary format
+# (see segmentFile.py) can be loaded without parsing. the plot page
+# loads binary segments if 'bin' is listed.
+XGDS_PLOT_SEGMENT_FORMATS = ('json',)
+
+# pre-compressed copies to write next to each segment file: 'gzip'
+# (.gz) and/or 'br' (.br, requires the brotli module). the segment view
+# serves them with a Content-Encoding; for static serving, enable e.g.
+# nginx gzip_static.
+XGDS_PLOT_SEGMENT_ENCODINGS = ('gzip',)
+
+# output segment files are written by a pool of background threads so
+# bursts of changed segments don't stall indexing. 0 threads writes them
+# on the indexing thread. when the queue is full, indexing waits.
+XGDS_PLOT_SEGMENT_WRITER_THREADS = 2
+XGDS_PLOT_SEGMENT_WRITER_QUEUE_SIZE = 1000
+
+# fsync output segment files (in batches) after writing them. they can
+# be regenerated from the segment cache, so this is off by default.
+XGDS_PLOT_SEGMENT_WRITER_FSYNC = False
+
+# how often the indexer saves the segment cache and its status together
+# as a checkpoint. samples indexed since the last checkpoint are
+# replayed from a log after a crash, so a shorter interval means a
+# faster restart but more frequent cache writes.
+XGDS_PLOT_CHECKPOINT_INTERVAL_SECONDS = 60
+
+# if True, the plot page loads the status and initial segments of all
+# plots with one request, and later loads the segments it needs for a
+# plot with one request to the segments view. if False, it requests the
+# status and each segment file separately from the status and segment
+# file views.
+XGDS_PLOT_MERGE_SEGMENT_REQUESTS = True
+
+# how long browsers and proxies may cache a segment that is still
+# receiving data before revalidating it. closed segments, which can no
+# longer change, are marked immutable.
+XGDS_PLOT_OPEN_SEGMENT_MAX_AGE_SECONDS = 5
+
+# how the indexer caches segment statistics between updates: 'pickle'
+# keeps one pickle file per segment with an in-memory LRU cache. 'array'
+# keeps one memory-mapped file of fixed-size records per segment level
+# (see segmentStore.py), so loading a segment needs no deserialization.
+# switching types requires reindexing (xgdsPlotIndexer.py --clean).
+XGDS_PLOT_SEGMENT_STORE = 'pickle'
+
+# segments with at most this fraction of their buckets occupied keep
+# statistics only for the occupied buckets, which saves memory and disk
+# space for sparse or bursty data. set to 0 to always use dense segments.
+XGDS_PLOT_SPARSE_SEGMENT_MAX_FILL = 0.5
+
 # make segment files more readable for debugging (increases file size)
 XGDS_PLOT_PRETTY_PRINT_JSON_SEGMENTS = False
 
@@ -67,6 +124,26 @@ XGDS_PLOT_OPS_TIME_ZONE = 'UTC'
 # zoom in interval [MIN_ZOOM, MAX_ZOOM)
 XGDS_PLOT_MAP_ZOOM_RANGE = (14, 22)
 
+# during batch indexing, populate only the finest map zoom level from the
+# raw data and build coarser levels by summing 2x2 blocks of finer tiles.
+# faster for large batch jobs, but the coarser zoom levels only appear
+# when the batch finishes, so it is off by default.
+XGDS_PLOT_MAP_BOTTOM_UP_PYRAMID = False
+
+# write map tiles as 8-bit paletted PNGs instead of RGBA. much smaller,
+# but approximate: opaque pixels get half the colormap resolution and
+# the partly transparent edges of the data get a coarse palette.
+XGDS_PLOT_MAP_PALETTE_PNG = False
+
+# store map tiles in one SQLite file per layer and day, using the
+# MBTiles schema, instead of one PNG file per tile. the tile KML then
+# links to a view that serves tiles from these files.
+XGDS_PLOT_MAP_MBTILES = False
+
+# number of tile writes grouped into one MBTiles transaction. the
+# raster map indexer also commits pending writes every second.
+XGDS_PLOT_MAP_MBTILES_BATCH_SIZE = 500
+
 # batch sleep avoids overloading server; larger values sleep more
 XGDS_PLOT_BATCH_SLEEP_TIME_FACTOR = 3
 
@@ -0,0 +1,110 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The xGDS platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+"""
+Map tile images stored in an SQLite file with the MBTiles schema, one
+file per layer and day, instead of one PNG file per tile.
+
+Tile coordinates are stored as given: x counts tiles east from -180
+degrees longitude and y counts tiles north from -90 degrees latitude
+(see tile.getTileBounds()). That matches the row order of MBTiles, but
+not its Web Mercator tiling, so generic MBTiles viewers will not place
+the tiles correctly.
+
+Writes are grouped into transactions of up to batchSize tiles; call
+commit() to end one early. The database uses write-ahead logging, so
+readers see the last committed transaction while the indexer writes.
+"""
+
+import os
+import sqlite3
+
+
+def getPath(layerDir, dayCode):
+    return os.path.join(layerDir, '%s.mbtiles' % dayCode)
+
+
+class MbTiles(object):
+    def __init__(self, path, batchSize=100, readOnly=False):
+        self.path = path
+        self.batchSize = batchSize
+        self.numUncommitted = 0
+        if readOnly:
+            self.conn = sqlite3.connect(path)
+            return
+
+        pathDir = os.path.dirname(path)
+        if not os.path.exists(pathDir):
+            os.makedirs(pathDir)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS tiles '
+                          '(zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)')
+        self.conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS tile_index '
+                          'ON tiles (zoom_level, tile_column, tile_row)')
+        self.conn.commit()
+
+    def setMetadata(self, meta):
+        self.conn.execute('DELETE FROM metadata')
+        self.conn.executemany('INSERT INTO metadata (name, value) VALUES (?, ?)',
+                              sorted(meta.iteritems()))
+        self.conn.commit()
+
+    def getTile(self, level, x, y):
+        """
+        Return the image data of tile (@level, @x, @y), or None if there
+        is no such tile.
+        """
+        row = self.conn.execute('SELECT tile_data FROM tiles '
+                                'WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                                (level, x, y)).fetchone()
+        if row is None:
+            return None
+        return str(row[0])
+
+    def hasTile(self, level, x, y):
+        row = self.conn.execute('SELECT 1 FROM tiles '
+                                'WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                                (level, x, y)).fetchone()
+        return row is not None
+
+    def putTile(self, level, x, y, data):
+        self.conn.execute('INSERT OR REPLACE INTO tiles '
+                          '(zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)',
+                          (level, x, y, sqlite3.Binary(data)))
+        self.changed()
+
+    def deleteTile(self, level, x, y):
+        self.conn.execute('DELETE FROM tiles '
+                          'WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                          (level, x, y))
+        self.changed()
+
+    def changed(self):
+        self.numUncommitted += 1
+        if self.numUncommitted >= self.batchSize:
+            self.commit()
+
+    def commit(self):
+        if self.numUncommitted:
+            self.conn.commit()
+            self.numUncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()
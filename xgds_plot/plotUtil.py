@@ -18,6 +18,7 @@ import os
 import shutil
 import sys
 import datetime
+import time
 import pytz
 import re
 
@@ -58,6 +59,41 @@ def rmIfPossible(path):
         print >> sys.stderr, 'Failed to remove %s: %s' % (path, oe)
 
 
+def batchSleep(batchProcessStartTime):
+    """
+    Sleep in proportion to the time spent processing since
+    @batchProcessStartTime to avoid overloading the server. Returns the
+    start time of the next batch.
+    """
+    batchProcessDuration = time.time() - batchProcessStartTime
+    if settings.XGDS_PLOT_BATCH_SLEEP_TIME_FACTOR > 0:
+        sleepTime = batchProcessDuration * settings.XGDS_PLOT_BATCH_SLEEP_TIME_FACTOR
+        print 'sleeping for %.3f seconds to avoid overloading server' % sleepTime
+        time.sleep(sleepTime)
+    else:
+        time.sleep(0)
+    return time.time()
+
+
+def getUtcTimeString(posixTimeMs):
+    return (datetime.datetime.utcfromtimestamp(posixTimeMs * 1e-3)
+            .strftime('%Y-%m-%d %H:%M:%S UTC'))
+
+
+def getProgressString(startTimeMs, currentTimeMs, endTimeMs):
+    """
+    Describe how far batch indexing has progressed through the time
+    interval [@startTimeMs, @endTimeMs].
+    """
+    if endTimeMs > startTimeMs:
+        fraction = float(currentTimeMs - startTimeMs) / (endTimeMs - startTimeMs)
+        fraction = min(max(fraction, 0.0), 1.0)
+    else:
+        fraction = 1.0
+    return ('indexed through %s (%.1f%% of time range)'
+            % (getUtcTimeString(currentTimeMs), 100 * fraction))
+
+
 class JsonStore(object):
     def __init__(self, path):
         self.path = os.path.realpath(path)
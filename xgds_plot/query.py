@@ -14,7 +14,9 @@
 # specific language governing permissions and limitations under the License.
 #__END_LICENSE__
 
+import numpy
 from django.db import connection
+from django.db.models import Q
 
 from geocamUtil.loader import getModelByName
 from geocamUtil import TimeUtil
@@ -28,6 +30,16 @@ def posixTimeMsToUtcDateTime(posixTimeMs):
     return TimeUtil.posixToUtcDateTime(posixTimeMs / 1000.0)
 
 
+def utcDateTimesToPosixTimesMs(utcDts):
+    """
+    Vectorized conversion of a sequence of UTC datetimes (naive or
+    aware) to a float array of posix times in milliseconds.
+    """
+    utcDts = [dt.replace(tzinfo=None) for dt in utcDts]
+    microseconds = numpy.array(utcDts, dtype='datetime64[us]').astype('int64')
+    return microseconds * 1e-3
+
+
 class TimeSeriesQueryManager(object):
     """
     TimeSeriesQueryManager is an abstract base class for classes that
@@ -55,6 +67,57 @@ class TimeSeriesQueryManager(object):
         """
         raise NotImplementedError()
 
+    def iterData(self, minTime=None, maxTime=None, pageSize=5000):
+        """
+        Like getData(), but yield the records as a series of lists of at
+        most @pageSize records. Implementations should avoid holding the
+        whole result set in memory. The default implementation returns
+        everything in one page.
+        """
+        recs = list(self.getData(minTime=minTime, maxTime=maxTime))
+        if recs:
+            yield recs
+
+    def getColumns(self, fields, minTime=None, maxTime=None):
+        """
+        Return a pair (posixTimesMs, columns) for the records in the
+        specified time interval. posixTimesMs is a float array of
+        timestamps and columns is a list with one float array of values
+        for each entry in @fields (missing values are NaN). The default
+        implementation extracts the columns from getData() records.
+        """
+        return self.getColumnsFromRecords(fields,
+                                          list(self.getData(minTime=minTime,
+                                                            maxTime=maxTime)))
+
+    def iterColumns(self, fields, minTime=None, maxTime=None, pageSize=5000):
+        """
+        Like iterData(), but yield (posixTimesMs, columns) pairs in the
+        format returned by getColumns().
+        """
+        for recs in self.iterData(minTime=minTime, maxTime=maxTime, pageSize=pageSize):
+            yield self.getColumnsFromRecords(fields, recs)
+
+    def getColumnsFromRecords(self, fields, recs):
+        posixTimesMs = numpy.array([self.getTimestamp(rec) for rec in recs], dtype='d')
+        columns = [numpy.array([getattr(rec, field) for rec in recs], dtype='d')
+                   for field in fields]
+        return posixTimesMs, columns
+
+    def getMinTime(self):
+        """
+        Return the timestamp of the first record, or None if it is not
+        cheap to find out.
+        """
+        return None
+
+    def getMaxTime(self):
+        """
+        Return the timestamp of the last record, or None if it is not
+        cheap to find out.
+        """
+        return None
+
     def getTimestamp(self, obj):
         """
         Return the timestamp for a record.
@@ -124,6 +187,103 @@ class Django(TimeSeriesQueryManager):
             filterKwargs.update(self.filterDict)
         return self.model.objects.filter(**filterKwargs).order_by(self.timestampField)
 
+    def getPage(self, minTime=None, maxTime=None, after=None):
+        """
+        Return the records of getData() ordered by (timestamp, pk),
+        starting after the record with (timestamp, pk) @after if it is
+        specified. Used for keyset pagination. Timestamps alone are not
+        unique, so paging on them could drop records that share the
+        timestamp at the end of a page.
+        """
+        query = (self.getData(minTime=minTime, maxTime=maxTime)
+                 .order_by(self.timestampField, 'pk'))
+        if after is not None:
+            timestamp, pk = after
+            query = query.filter(Q(**{self.timestampField + '__gt': timestamp})
+                                 | Q(**{self.timestampField: timestamp,
+                                        'pk__gt': pk}))
+        return query
+
+    def iterData(self, minTime=None, maxTime=None, pageSize=5000):
+        # keyset pagination: each page starts after the last record of
+        # the previous page. this avoids COUNT queries and large
+        # OFFSETs, and iterator() lets the database driver stream rows
+        # instead of caching them in the QuerySet.
+        after = None
+        while True:
+            recs = list(self.getPage(minTime, maxTime, after)[:pageSize].iterator())
+            if not recs:
+                break
+            yield recs
+            if len(recs) < pageSize:
+                break
+            after = (getattr(recs[-1], self.timestampField), recs[-1].pk)
+
+    def getColumnsFromQuery(self, query, fields, limit=None):
+        """
+        Return (posixTimesMs, columns, lastKey) for the records of
+        @query, in the format of getColumns(). lastKey is the (timestamp,
+        pk) of the last record, for getPage(), or None if there are no
+        records.
+        """
+        # fetch only the needed columns as tuples with values_list()
+        # rather than building a model instance for each row
+        timeFields = [self.timestampField]
+        if self.timestampMicrosecondsField is not None:
+            timeFields.append(self.timestampMicrosecondsField)
+        elif self.timestampNanosecondsField is not None:
+            timeFields.append(self.timestampNanosecondsField)
+        rows = query.values_list(*(['pk'] + timeFields + list(fields)))
+        if limit is not None:
+            rows = rows[:limit]
+        rows = list(rows.iterator())
+        if not rows:
+            return (numpy.zeros(0),
+                    [numpy.zeros(0) for _field in fields],
+                    None)
+
+        cols = zip(*rows)
+        posixTimesMs = utcDateTimesToPosixTimesMs(cols[1])
+        if self.timestampMicrosecondsField is not None:
+            posixTimesMs += numpy.array(cols[2], dtype='d') * 1e-3
+        elif self.timestampNanosecondsField is not None:
+            posixTimesMs += numpy.array(cols[2], dtype='d') * 1e-6
+        columns = [numpy.array(col, dtype='d')
+                   for col in cols[1 + len(timeFields):]]
+        return posixTimesMs, columns, (rows[-1][1], rows[-1][0])
+
+    def getColumns(self, fields, minTime=None, maxTime=None):
+        query = self.getData(minTime=minTime, maxTime=maxTime)
+        posixTimesMs, columns, _lastKey = self.getColumnsFromQuery(query, fields)
+        return posixTimesMs, columns
+
+    def iterColumns(self, fields, minTime=None, maxTime=None, pageSize=5000):
+        # keyset pagination, as in iterData()
+        after = None
+        while True:
+            query = self.getPage(minTime, maxTime, after)
+            posixTimesMs, columns, after = self.getColumnsFromQuery(query, fields,
+                                                                    limit=pageSize)
+            if len(posixTimesMs) == 0:
+                break
+            yield posixTimesMs, columns
+            if len(posixTimesMs) < pageSize:
+                break
+
+    def getMinTime(self):
+        firstRecs = list(self.getData()[:1])
+        if firstRecs:
+            return self.getTimestamp(firstRecs[0])
+        else:
+            return None
+
+    def getMaxTime(self):
+        lastRecs = list(self.getData().reverse()[:1])
+        if lastRecs:
+            return self.getTimestamp(lastRecs[0])
+        else:
+            return None
+
     def getDatesWithData(self):
         cursor = connection.cursor()
         cursor.execute("SELECT DISTINCT DATE(CONVERT_TZ(%s, 'UTC', '%s')) FROM %s"
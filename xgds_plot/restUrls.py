@@ -27,7 +27,12 @@ urlpatterns = [url(r'^now/$', views.now, {}, name='xgds_plot_now'),
                url(r'^mapIndex\.kml$', views.mapIndexKml, {},'xgds_plot_mapIndexKml'),
               #url(r'^mapLayer_(?P<layerId>[^\.]+)\.kml$', views.mapKml, {}, 'xgds_plot_mapKml'),
                url(r'^mapTile/(?P<layerId>[^/]+)/(?P<dayCode>\d+)/(?P<level>\d+)/(?P<x>\d+)/(?P<y>\d+)\.kml$', views.mapTileKml, {}, 'xgds_plot_mapTileKml'),
+               url(r'^mapTile/(?P<layerId>[^/]+)/(?P<dayCode>\d+)/(?P<level>\d+)/(?P<x>\d+)/(?P<y>\d+)\.png$', views.getMapTile, {}, 'xgds_plot_mapTileImage'),
                url(r'^profile/(?P<layerId>[^\.]*)\.png$', views.profileRender, {}, 'xgds_plot_profileRender'),
                url(r'^profile/(?P<layerId>[^\.]*)\.csv$', views.profileCsv, {}, 'xgds_plot_profileCsv'),
                url(r'staticPlot/(?P<seriesId>[^\.]+)\.png', views.getStaticPlot, {}, 'xgds_plot_staticPlot'),
+               url(r'^segments/$', views.getSegmentsBatch, {}, 'xgds_plot_segmentsBatch'),
+               url(r'^segment/(?P<valueCode>[^/]+)/(?P<level>\d+)/(?P<index>-?\d+)\.(?P<extension>json|bin)$', views.getSegmentFile, {}, 'xgds_plot_segmentFile'),
+               url(r'^status/(?P<valueCode>[^/]+)\.json$', views.getSegmentStatus, {}, 'xgds_plot_segmentStatus'),
+               url(r'^segments/(?P<valueCode>[^/]+)$', views.getSegments, {}, 'xgds_plot_segments'),
                ]
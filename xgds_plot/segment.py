@@ -34,73 +34,383 @@ LAST_DENOM_ZERO_WARNING_TIME = 0
 
 HUGE_VALUE = 99e+20
 
+# segments with at most this fraction of buckets occupied are stored sparse
+SPARSE_MAX_FILL = settings.XGDS_PLOT_SPARSE_SEGMENT_MAX_FILL
+
+
+def combineStats(countA, meanA, m2A, countB, meanB, m2B):
+    """
+    Combine (count, mean, M2) statistics of two disjoint sample sets
+    (Chan et al.). Returns (mean, m2); the caller adds the counts.
+    """
+    weightB = countB / numpy.maximum(countA + countB, 1).astype('d')
+    delta = meanB - meanA
+    mean = meanA + delta * weightB
+    m2 = m2A + m2B + delta * delta * countA * weightB
+    return mean, m2
+
+
+def getBucketStats(n, bucketIndices, vals):
+    """
+    Return per-bucket (count, mean, M2) arrays of length @n for a batch
+    of samples.
+    """
+    count = numpy.bincount(bucketIndices, minlength=n)
+    total = numpy.bincount(bucketIndices, weights=vals, minlength=n)
+    mean = total / numpy.maximum(count, 1)
+    deviations = vals - mean[bucketIndices]
+    m2 = numpy.bincount(bucketIndices, weights=deviations * deviations, minlength=n)
+    return count, mean, m2
+
 
 class ScalarSegment(object):
+    """
+    Statistics for the samples in each of the n buckets of a segment.
+    Sparse segments only hold the buckets listed in self.buckets, so
+    accessors like getMean() take an array position, not a bucket index.
+    """
+    # statistics that combine by summing, taking the min, or taking the max
+    SUM_FIELDS = ('timeSum', 'count')
+    MIN_FIELDS = ('min',)
+    MAX_FIELDS = ('max',)
+
+    # the number of samples included in the mean and m2 statistics
+    STATS_COUNT_FIELD = 'count'
+
+    # per-bucket arrays that make up the segment's state
+    ARRAY_FIELDS = ('timeSum', 'mean', 'm2', 'min', 'max', 'count')
+    INT_FIELDS = ('count',)
+
+    # columns of getJsonObj() and getColumns()
+    FIELDS = ['timestamp',
+              'mean',
+              'variance',
+              'min',
+              'max',
+              'count']
+
     def __init__(self):
         self.n = settings.XGDS_PLOT_SEGMENT_RESOLUTION
-        self.timeSum = numpy.zeros(self.n)
-        self.sum = numpy.zeros(self.n)
-        self.sqsum = numpy.zeros(self.n)
-        self.min = numpy.zeros(self.n) + HUGE_VALUE
-        self.max = numpy.zeros(self.n) - HUGE_VALUE
-        self.count = numpy.zeros(self.n, dtype='l')
+        # time range of the samples added, so a replay of logged samples
+        # can skip the ones the segment already includes
+        self.minTime = numpy.inf
+        self.maxTime = -numpy.inf
+        if SPARSE_MAX_FILL > 0:
+            self.buckets = numpy.zeros(0, dtype='l')
+            self.__dict__.update(self.newArrays(0))
+        else:
+            self.buckets = None
+            self.__dict__.update(self.newArrays(self.n))
+
+    def __getstate__(self):
+        # pickle dense segments that have few occupied buckets as sparse
+        state = self.__dict__.copy()
+        if self.buckets is None:
+            occupied = numpy.flatnonzero(self.count)
+            if len(occupied) <= self.n * SPARSE_MAX_FILL:
+                state['buckets'] = occupied
+                for field in self.ARRAY_FIELDS:
+                    state[field] = state[field][occupied]
+        return state
+
+    def __setstate__(self, state):
+        # convert segments pickled before mean and m2 replaced sum and sqsum
+        if 'sum' in state:
+            count = numpy.maximum(state[self.STATS_COUNT_FIELD], 1)
+            state['mean'] = state.pop('sum') / count
+            state['m2'] = numpy.maximum(state.pop('sqsum') - state['mean'] ** 2 * count, 0)
+        state.setdefault('buckets', None)
+        state.setdefault('minTime', numpy.inf)
+        state.setdefault('maxTime', -numpy.inf)
+        self.__dict__.update(state)
+
+    def copy(self):
+        """
+        Return a copy of the segment that shares no arrays with it.
+        """
+        result = self.__class__.__new__(self.__class__)
+        result.__dict__.update(self.__dict__)
+        for field in self.ARRAY_FIELDS:
+            setattr(result, field, getattr(self, field).copy())
+        if self.buckets is not None:
+            result.buckets = self.buckets.copy()
+        return result
+
+    def getEmptyValue(self, field):
+        if field in self.INT_FIELDS:
+            return 0
+        elif field in self.MIN_FIELDS:
+            return HUGE_VALUE
+        elif field in self.MAX_FIELDS:
+            return -HUGE_VALUE
+        else:
+            return 0.0
+
+    def newArrays(self, size):
+        """
+        Return a dict of empty per-bucket arrays of length @size.
+        """
+        arrays = {}
+        for field in self.ARRAY_FIELDS:
+            dtype = 'l' if field in self.INT_FIELDS else 'd'
+            arrays[field] = numpy.zeros(size, dtype=dtype) + self.getEmptyValue(field)
+        return arrays
+
+    def getBucketIndices(self):
+        """
+        Return the bucket index of each position in the arrays.
+        """
+        if self.buckets is None:
+            return numpy.arange(self.n)
+        else:
+            return self.buckets
+
+    def setBuckets(self, buckets):
+        """
+        Switch to sparse storage of @buckets, or dense if @buckets is None.
+        """
+        oldBuckets = self.getBucketIndices()
+        if buckets is None:
+            size = self.n
+            newPositions = oldBuckets
+            keep = slice(None)
+        else:
+            size = len(buckets)
+            newPositions = numpy.searchsorted(buckets, oldBuckets)
+            keep = newPositions < size
+            keep[keep] = buckets[newPositions[keep]] == oldBuckets[keep]
+            newPositions = newPositions[keep]
+        arrays = self.newArrays(size)
+        for field in self.ARRAY_FIELDS:
+            arrays[field][newPositions] = getattr(self, field)[keep]
+        self.buckets = buckets
+        self.__dict__.update(arrays)
+
+    def getPositions(self, bucketIndices):
+        """
+        Return the array positions of @bucketIndices, adding missing buckets.
+        """
+        bucketIndices = numpy.asarray(bucketIndices, dtype='l')
+        if self.buckets is None:
+            return bucketIndices
+        newBuckets = numpy.setdiff1d(bucketIndices, self.buckets)
+        if len(newBuckets):
+            buckets = numpy.union1d(self.buckets, newBuckets)
+            if len(buckets) > self.n * SPARSE_MAX_FILL:
+                self.setBuckets(None)
+                return bucketIndices
+            self.setBuckets(buckets)
+        return numpy.searchsorted(self.buckets, bucketIndices)
+
+    def getPosition(self, bucketIndex):
+        """
+        Scalar version of getPositions().
+        """
+        if self.buckets is None:
+            return bucketIndex
+        i = self.buckets.searchsorted(bucketIndex)
+        if i < len(self.buckets) and self.buckets[i] == bucketIndex:
+            return i
+        if len(self.buckets) + 1 > self.n * SPARSE_MAX_FILL:
+            self.setBuckets(None)
+            return bucketIndex
+        # insert an empty bucket at position i
+        self.buckets = numpy.concatenate((self.buckets[:i], [bucketIndex], self.buckets[i:]))
+        for field in self.ARRAY_FIELDS:
+            arr = getattr(self, field)
+            setattr(self, field, numpy.concatenate((arr[:i], [self.getEmptyValue(field)], arr[i:])))
+        return i
+
+    def getDenseArrays(self):
+        """
+        Return a dict of the per-bucket arrays in dense form.
+        """
+        if self.buckets is None:
+            return dict([(field, getattr(self, field)) for field in self.ARRAY_FIELDS])
+        arrays = self.newArrays(self.n)
+        for field in self.ARRAY_FIELDS:
+            arrays[field][self.buckets] = getattr(self, field)
+        return arrays
+
+    def setDenseArrays(self, arrays):
+        """
+        Replace the state of the segment with the dense per-bucket
+        @arrays.
+        """
+        self.buckets = None
+        denseArrays = self.newArrays(self.n)
+        for field in self.ARRAY_FIELDS:
+            denseArrays[field][:] = arrays[field]
+        self.__dict__.update(denseArrays)
+
+    def addStat(self, i, val):
+        # Welford's update
+        countField = getattr(self, self.STATS_COUNT_FIELD)
+        countField[i] += 1
+        delta = val - self.mean[i]
+        self.mean[i] += delta / countField[i]
+        self.m2[i] += delta * (val - self.mean[i])
+
+    def addStats(self, positions, vals):
+        countField = getattr(self, self.STATS_COUNT_FIELD)
+        count, mean, m2 = getBucketStats(len(countField), positions, vals)
+        self.mean, self.m2 = combineStats(countField, self.mean, self.m2,
+                                          count, mean, m2)
+        countField += count
 
     def addSample(self, bucketIndex, posixTimeMs, val):
-        self.timeSum[bucketIndex] += posixTimeMs
-        self.sum[bucketIndex] += val
-        self.sqsum[bucketIndex] += val * val
+        i = self.getPosition(bucketIndex)
+        self.timeSum[i] += posixTimeMs
+        self.minTime = min(self.minTime, posixTimeMs)
+        self.maxTime = max(self.maxTime, posixTimeMs)
+        self.addStat(i, val)
+
+        self.min[i] = min(self.min[i], val)
+        self.max[i] = max(self.max[i], val)
+
+    def addSamples(self, bucketIndices, posixTimesMs, vals):
+        """
+        Add many samples at once. The arguments are parallel arrays. The
+        same bucket index may appear more than once.
+        """
+        if len(bucketIndices) == 0:
+            return
+        positions = self.getPositions(bucketIndices)
+        vals = numpy.asarray(vals, dtype='d')
+
+        self.timeSum += numpy.bincount(positions, weights=posixTimesMs, minlength=len(self.count))
+        self.minTime = min(self.minTime, numpy.min(posixTimesMs))
+        self.maxTime = max(self.maxTime, numpy.max(posixTimesMs))
+        self.addStats(positions, vals)
+
+        numpy.minimum.at(self.min, positions, vals)
+        numpy.maximum.at(self.max, positions, vals)
+
+    def mergeBuckets(self, dstBuckets, other, src):
+        """
+        Fold the statistics at positions @src of @other into the distinct
+        buckets @dstBuckets.
+        """
+        dst = self.getPositions(dstBuckets)
 
-        self.min[bucketIndex] = min(self.min[bucketIndex], val)
-        self.max[bucketIndex] = max(self.max[bucketIndex], val)
-        self.count[bucketIndex] += 1
+        # combine mean and m2 before the counts are summed
+        countField = getattr(self, self.STATS_COUNT_FIELD)
+        otherCount = getattr(other, self.STATS_COUNT_FIELD)[src]
+        self.mean[dst], self.m2[dst] = combineStats(countField[dst], self.mean[dst], self.m2[dst],
+                                                    otherCount, other.mean[src], other.m2[src])
+        if self.STATS_COUNT_FIELD not in self.SUM_FIELDS:
+            countField[dst] += otherCount
 
-    def getMeanTimestamp(self, bucketIndex):
-        return float(self.timeSum[bucketIndex]) / self.count[bucketIndex]
+        for field in self.SUM_FIELDS:
+            getattr(self, field)[dst] += getattr(other, field)[src]
+        for field in self.MIN_FIELDS:
+            arr = getattr(self, field)
+            arr[dst] = numpy.minimum(arr[dst], getattr(other, field)[src])
+        for field in self.MAX_FIELDS:
+            arr = getattr(self, field)
+            arr[dst] = numpy.maximum(arr[dst], getattr(other, field)[src])
 
-    def getMean(self, bucketIndex):
-        return float(self.sum[bucketIndex]) / self.count[bucketIndex]
+    def merge(self, other):
+        """
+        Fold in the statistics of @other, a segment covering the same time
+        interval built from a different set of samples.
+        """
+        src = numpy.flatnonzero(other.count)
+        self.mergeBuckets(other.getBucketIndices()[src], other, src)
+        self.minTime = min(self.minTime, other.minTime)
+        self.maxTime = max(self.maxTime, other.maxTime)
 
-    def getVariance(self, bucketIndex):
-        if self.count[bucketIndex] >= 2:
-            return ((float(self.sqsum[bucketIndex]) / self.count[bucketIndex])
-                    - (float(self.sum[bucketIndex]) / self.count[bucketIndex]) ** 2)
+    def addChild(self, child, half):
+        """
+        Fold in the statistics of @child, the segment at the next finer
+        level covering half @half (0 or 1) of this one.
+        """
+        src = numpy.flatnonzero(child.count)
+        childBuckets = child.getBucketIndices()[src]
+        offset = half * (self.n // 2)
+        # merge even and odd child buckets separately so that each merge
+        # maps onto distinct buckets
+        for parity in (0, 1):
+            sel = childBuckets % 2 == parity
+            self.mergeBuckets(offset + childBuckets[sel] // 2, child, src[sel])
+        self.minTime = min(self.minTime, child.minTime)
+        self.maxTime = max(self.maxTime, child.maxTime)
+
+    def getMeanTimestamp(self, i):
+        return float(self.timeSum[i]) / self.count[i]
+
+    def getMean(self, i):
+        return float(self.mean[i])
+
+    def getVariance(self, i):
+        count = getattr(self, self.STATS_COUNT_FIELD)[i]
+        if count >= 2:
+            return float(self.m2[i]) / count
         else:
             return None
 
     def getJsonObj(self):
-        fields = ['timestamp',
-                  'mean',
-                  'variance',
-                  'min',
-                  'max',
-                  'count']
+        fields = self.FIELDS
         data = [[self.getMeanTimestamp(i),
                  self.getMean(i),
                  self.getVariance(i),
                  self.min[i],
                  self.max[i],
                  self.count[i]]
-                for i in xrange(self.n)
+                for i in xrange(len(self.count))
                 if self.count[i] > 0]
         return {'fields': fields,
                 'data': data}
 
+    def getOccupiedColumns(self, occupied):
+        count = self.count[occupied].astype('d')
+        statsCount = getattr(self, self.STATS_COUNT_FIELD)[occupied]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            variance = numpy.where(statsCount >= 2,
+                                   self.m2[occupied] / statsCount,
+                                   numpy.nan)
+        return [self.timeSum[occupied] / count,
+                self.mean[occupied],
+                variance,
+                self.min[occupied],
+                self.max[occupied],
+                count]
+
+    def getColumns(self):
+        """
+        Vectorized getJsonObj(). Returns (fields, columns) with one row per
+        field and one column per non-empty bucket; undefined values are NaN.
+        """
+        occupied = numpy.flatnonzero(self.count)
+        return self.FIELDS, numpy.array(self.getOccupiedColumns(occupied), dtype='d')
+
 
 class RatioSegment(ScalarSegment):
-    def __init__(self):
-        super(RatioSegment, self).__init__()
-        self.numSum = numpy.zeros(self.n)
-        self.denomSum = numpy.zeros(self.n)
+    SUM_FIELDS = ScalarSegment.SUM_FIELDS + ('numSum', 'denomSum')
+    FIELDS = ScalarSegment.FIELDS + ['numSum', 'denomSum']
+
+    # samples with denominator 0 are left out of the ratio statistics
+    STATS_COUNT_FIELD = 'ratioCount'
+    ARRAY_FIELDS = ScalarSegment.ARRAY_FIELDS + ('numSum', 'denomSum', 'ratioCount')
+    INT_FIELDS = ScalarSegment.INT_FIELDS + ('ratioCount',)
+
+    def __setstate__(self, state):
+        if 'ratioCount' not in state:
+            state['ratioCount'] = state['count'].copy()
+        super(RatioSegment, self).__setstate__(state)
 
     def addSample(self, bucketIndex, posixTimeMs, vals):
         global LAST_DENOM_ZERO_WARNING_TIME
 
         num, denom = vals
 
-        self.timeSum[bucketIndex] += posixTimeMs
-        self.numSum[bucketIndex] += num
-        self.denomSum[bucketIndex] += denom
-        self.count[bucketIndex] += 1
+        i = self.getPosition(bucketIndex)
+        self.timeSum[i] += posixTimeMs
+        self.minTime = min(self.minTime, posixTimeMs)
+        self.maxTime = max(self.maxTime, posixTimeMs)
+        self.numSum[i] += num
+        self.denomSum[i] += denom
+        self.count[i] += 1
 
         if denom == 0:
             now = time.time()
@@ -110,40 +420,65 @@ class RatioSegment(ScalarSegment):
         else:
             val = float(num) / denom
 
-            self.sum[bucketIndex] += val
-            self.sqsum[bucketIndex] += val * val
-            self.min[bucketIndex] = min(self.min[bucketIndex], val)
-            self.max[bucketIndex] = max(self.max[bucketIndex], val)
+            self.addStat(i, val)
+            self.min[i] = min(self.min[i], val)
+            self.max[i] = max(self.max[i], val)
+
+    def addSamples(self, bucketIndices, posixTimesMs, vals):
+        global LAST_DENOM_ZERO_WARNING_TIME
+
+        if len(bucketIndices) == 0:
+            return
+        nums, denoms = vals
+        positions = self.getPositions(bucketIndices)
+        nums = numpy.asarray(nums, dtype='d')
+        denoms = numpy.asarray(denoms, dtype='d')
+
+        size = len(self.count)
+        self.timeSum += numpy.bincount(positions, weights=posixTimesMs, minlength=size)
+        self.minTime = min(self.minTime, numpy.min(posixTimesMs))
+        self.maxTime = max(self.maxTime, numpy.max(posixTimesMs))
+        self.numSum += numpy.bincount(positions, weights=nums, minlength=size)
+        self.denomSum += numpy.bincount(positions, weights=denoms, minlength=size)
+        self.count += numpy.bincount(positions, minlength=size)
 
-    def getMean(self, bucketIndex):
-        if self.denomSum[bucketIndex] == 0:
+        ok = denoms != 0
+        if not ok.all():
+            now = time.time()
+            if now - LAST_DENOM_ZERO_WARNING_TIME > 5:
+                print >> sys.stderr, 'warning: RatioSegment.addSamples: denominator = 0, leaving samples out of some statistics to avoid divide by zero'
+                LAST_DENOM_ZERO_WARNING_TIME = now
+            positions = positions[ok]
+            nums = nums[ok]
+            denoms = denoms[ok]
+
+        vals = nums / denoms
+        self.addStats(positions, vals)
+        numpy.minimum.at(self.min, positions, vals)
+        numpy.maximum.at(self.max, positions, vals)
+
+    def getMean(self, i):
+        if self.denomSum[i] == 0:
             return None
         else:
-            return float(self.numSum[bucketIndex]) / self.denomSum[bucketIndex]
+            return float(self.numSum[i]) / self.denomSum[i]
 
-    def getMin(self, bucketIndex):
-        minVal = self.min[bucketIndex]
+    def getMin(self, i):
+        minVal = self.min[i]
         if minVal == HUGE_VALUE:
             return None
         else:
             return minVal
 
-    def getMax(self, bucketIndex):
-        maxVal = self.max[bucketIndex]
+    def getMax(self, i):
+        maxVal = self.max[i]
         if maxVal == -HUGE_VALUE:
             return None
         else:
             return maxVal
 
     def getJsonObj(self):
-        fields = ['timestamp',
-                  'mean',
-                  'variance',
-                  'min',
-                  'max',
-                  'count',
-                  'numSum',
-                  'denomSum']
+        fields = self.FIELDS
         data = [[self.getMeanTimestamp(i),
                  self.getMean(i),
                  self.getVariance(i),
@@ -152,7 +487,17 @@ class RatioSegment(ScalarSegment):
                  self.count[i],
                  self.numSum[i],
                  self.denomSum[i]]
-                for i in xrange(self.n)
+                for i in xrange(len(self.count))
                 if self.count[i] > 0]
         return {'fields': fields,
                 'data': data}
+
+    def getOccupiedColumns(self, occupied):
+        columns = super(RatioSegment, self).getOccupiedColumns(occupied)
+        numSum = self.numSum[occupied]
+        denomSum = self.denomSum[occupied]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            columns[1] = numpy.where(denomSum != 0, numSum / denomSum, numpy.nan)
+        columns[3] = numpy.where(columns[3] == HUGE_VALUE, numpy.nan, columns[3])
+        columns[4] = numpy.where(columns[4] == -HUGE_VALUE, numpy.nan, columns[4])
+        return columns + [numSum, denomSum]
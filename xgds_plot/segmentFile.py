@@ -0,0 +1,268 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The xGDS platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+"""
+Binary segment file format. A binary segment holds the same table as
+the 'fields' and 'data' members of a JSON segment, stored column-major
+so it can be loaded without parsing:
+
+  offset  size  contents
+  0       4     magic string 'XGPS'
+  4       2     uint16 format version
+  6       2     uint16 number of fields
+  8       4     uint32 number of rows
+  12      4     uint32 data offset (a multiple of 8)
+  16      ...   comma-separated ASCII field names, NUL padded
+  offset  ...   float64 columns, one per field, each with one entry per row
+
+All integers and floats are little-endian. Undefined values (such as the
+variance of a bucket with only one sample) are stored as NaN.
+
+Each level directory also has a manifest listing the segments that exist
+at that level, so readers don't need to probe for missing files:
+
+  {"level": <level>,
+   "maxTime": <status maxTime when the manifest was written>,
+   "segments": [[<segment index>, <last modified, posix ms>], ...]}
+
+Segments sorted by index. A segment whose time interval ends at or
+before maxTime is closed and will not change unless the time series is
+reindexed.
+
+Segment files may have pre-compressed copies alongside them, named by
+adding '.gz' (gzip) or '.br' (brotli) to the file name, so they can be
+served with a Content-Encoding without compressing on each request. A
+copy is written after its segment file, so a copy older than the
+segment file is stale and must not be served.
+"""
+
+import os
+import struct
+import sys
+import zlib
+
+import numpy
+
+from geocamUtil import anyjson as json
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MAGIC = 'XGPS'
+VERSION = 1
+HEADER_FORMAT = '<4sHHII'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+DTYPE = numpy.dtype('<f8')
+
+MANIFEST_NAME = 'manifest.json'
+
+# file name suffix of the pre-compressed copies for each content coding
+ENCODING_SUFFIXES = {'gzip': '.gz',
+                     'br': '.br'}
+
+# segments are rewritten often while live, so compress them fast. on
+# indexed segments, level 1 takes a third of the time of zlib's default
+# level 6 for output about 12% larger.
+GZIP_COMPRESS_LEVEL = 1
+
+BROTLI_QUALITY = 9
+
+
+def getEncodings(encodings):
+    """
+    Return the entries of @encodings that can be written, warning about
+    the others.
+    """
+    result = []
+    for encoding in encodings:
+        if encoding not in ENCODING_SUFFIXES:
+            raise ValueError('unknown segment encoding %s, expected gzip or br'
+                             % repr(encoding))
+        if encoding == 'br' and brotli is None:
+            print >> sys.stderr, 'warning: brotli module is not available; not writing .br segment files'
+            continue
+        result.append(encoding)
+    return result
+
+
+def compress(data, encoding):
+    if encoding == 'gzip':
+        # wbits offset 16 selects the gzip container
+        out = zlib.compressobj(GZIP_COMPRESS_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return out.compress(data) + out.flush()
+    elif encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    else:
+        raise ValueError('unknown segment encoding %s' % repr(encoding))
+
+
+def writeFileWithTmp(outPath, data):
+    tmpPath = outPath + '.part'
+    out = open(tmpPath, 'wb')
+    out.write(data)
+    out.close()
+    os.rename(tmpPath, outPath)
+
+
+def writeSegmentData(outPath, data, encodings=()):
+    """
+    Write the string @data to @outPath, followed by a compressed copy for
+    each of @encodings. Each file is written to a temporary path first
+    and renamed into place so readers never see a partial segment.
+    Returns the list of paths written.
+    """
+    writeFileWithTmp(outPath, data)
+    paths = [outPath]
+    for encoding in encodings:
+        encodedPath = outPath + ENCODING_SUFFIXES[encoding]
+        writeFileWithTmp(encodedPath, compress(data, encoding))
+        paths.append(encodedPath)
+    return paths
+
+
+def getEncodedPath(path, acceptedEncodings):
+    """
+    Return (path, encoding) for the pre-compressed copy of @path to
+    serve to a client that accepts @acceptedEncodings, or (@path, None)
+    if there is no up-to-date copy in an accepted encoding.
+    """
+    mtime = os.path.getmtime(path)
+    for encoding in ('br', 'gzip'):
+        if encoding not in acceptedEncodings:
+            continue
+        encodedPath = path + ENCODING_SUFFIXES[encoding]
+        if os.path.exists(encodedPath) and os.path.getmtime(encodedPath) >= mtime:
+            return encodedPath, encoding
+    return path, None
+
+
+def writeBinarySegment(outPath, fields, columns, encodings=()):
+    """
+    Write @columns, a float array with one row per entry of @fields, to
+    @outPath, with compressed copies for each of @encodings. Returns the
+    list of paths written.
+    """
+    names = ','.join(fields)
+    dataOffset = HEADER_SIZE + len(names)
+    dataOffset += -dataOffset % DTYPE.itemsize
+    numRows = columns.shape[1]
+
+    data = (struct.pack(HEADER_FORMAT, MAGIC, VERSION, len(fields), numRows, dataOffset)
+            + names.ljust(dataOffset - HEADER_SIZE, '\0')
+            + numpy.ascontiguousarray(columns, dtype=DTYPE).tostring())
+    return writeSegmentData(outPath, data, encodings)
+
+
+def readBinarySegment(path):
+    """
+    Return (fields, columns) for the binary segment at @path. The columns
+    array is memory-mapped read-only from the file.
+    """
+    inFile = open(path, 'rb')
+    header = inFile.read(HEADER_SIZE)
+    magic, version, numFields, numRows, dataOffset = struct.unpack(HEADER_FORMAT, header)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('%s is not a version %d binary segment file' % (path, VERSION))
+    fields = inFile.read(dataOffset - HEADER_SIZE).rstrip('\0').split(',')
+    inFile.close()
+
+    if numRows == 0:
+        return fields, numpy.zeros((numFields, 0), dtype=DTYPE)
+    columns = numpy.memmap(path, dtype=DTYPE, mode='r',
+                           offset=dataOffset, shape=(numFields, numRows))
+    return fields, columns
+
+
+def readManifest(valueDir, level):
+    """
+    Return (segments, maxTime) from the manifest of @level in
+    @valueDir, where segments is a dict mapping segment index to last
+    modified time, or None if there is no manifest.
+    """
+    path = os.path.join(valueDir, str(level), MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+    obj = json.loads(open(path, 'rb').read())
+    return dict([(t, mtime) for t, mtime in obj['segments']]), obj['maxTime']
+
+
+def writeManifest(valueDir, level, segments, maxTime):
+    """
+    Write the manifest of @level in @valueDir. @segments is a dict
+    mapping segment index to last modified time.
+    """
+    path = os.path.join(valueDir, str(level), MANIFEST_NAME)
+    obj = {'level': level,
+           'maxTime': maxTime,
+           'segments': sorted(segments.iteritems())}
+    tmpPath = path + '.part'
+    out = open(tmpPath, 'wb')
+    out.write(json.dumps(obj, separators=(',', ':')))
+    out.close()
+    os.rename(tmpPath, path)
+
+
+def scanSegments(valueDir, level):
+    """
+    Return a dict mapping segment index to last modified time for the
+    segment files of @level in @valueDir, for building the manifest of
+    an index written before manifests existed.
+    """
+    levelDir = os.path.join(valueDir, str(level))
+    segments = {}
+    if not os.path.isdir(levelDir):
+        return segments
+    for name in os.listdir(levelDir):
+        base, ext = os.path.splitext(name)
+        if ext in ('.json', '.bin') and base.lstrip('-').isdigit():
+            mtime = int(os.path.getmtime(os.path.join(levelDir, name)) * 1000)
+            t = int(base)
+            segments[t] = max(segments.get(t, 0), mtime)
+    return segments
+
+
+def removeSegmentFiles(valueDir, level, index):
+    """
+    Delete the output files of segment @index of @level in @valueDir,
+    in all formats, including any pre-compressed copies.
+    """
+    for fmt in ('json', 'bin'):
+        path = os.path.join(valueDir, str(level), '%s.%s' % (index, fmt))
+        for suffix in [''] + ENCODING_SUFFIXES.values():
+            if os.path.exists(path + suffix):
+                os.unlink(path + suffix)
+
+
+def readSegment(valueDir, level, index, formats=('json',)):
+    """
+    Return (fields, columns) for output segment @index of @level in
+    @valueDir, reading the first of @formats that exists, or None if
+    there is no such segment. Columns are in the format returned by
+    readBinarySegment().
+    """
+    for fmt in formats:
+        path = os.path.join(valueDir, str(level), '%s.%s' % (index, fmt))
+        if not os.path.exists(path):
+            continue
+        if fmt == 'bin':
+            return readBinarySegment(path)
+        obj = json.loads(open(path, 'rb').read())
+        # numpy converts None to NaN
+        columns = numpy.array(obj['data'], dtype=DTYPE).reshape((-1, len(obj['fields']))).T
+        return obj['fields'], columns
+    return None
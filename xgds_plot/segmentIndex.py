@@ -15,19 +15,23 @@
 #__END_LICENSE__
 
 import os
+import sys
 import math
 from collections import deque
 import time
 
+import numpy
 from django import db
 
 from geocamUtil import anyjson as json
 from geocamUtil.loader import getClassByName
-from geocamUtil.store import FileStore, LruCacheStore
 from geocamUtil.zmqUtil.delayBox import DelayBox
 
 from django.conf import settings
-from xgds_plot import plotUtil
+from xgds_plot import plotUtil, segmentFile
+from xgds_plot.segmentStore import makeSegmentStore
+from xgds_plot.segmentWriter import SegmentWriter
+from xgds_plot.segmentLog import SegmentLog
 
 MIN_SEGMENT_LENGTH_MS = (settings.XGDS_PLOT_MIN_DATA_INTERVAL_MS
                          * settings.XGDS_PLOT_SEGMENT_RESOLUTION)
@@ -36,13 +40,25 @@ MIN_SEGMENT_LEVEL = int(math.log(MIN_SEGMENT_LENGTH_MS, 2))
 
 MAX_SEGMENT_LEVEL = int(math.ceil(math.log(settings.XGDS_PLOT_MAX_SEGMENT_LENGTH_MS, 2))) + 1
 
+SEGMENT_LEVELS = numpy.arange(MIN_SEGMENT_LEVEL, MAX_SEGMENT_LEVEL)
+SEGMENT_LENGTHS_MS = 2.0 ** SEGMENT_LEVELS
+
+# (level, segment length) pairs as python numbers for the scalar path
+LEVEL_LENGTHS_MS = zip(SEGMENT_LEVELS.tolist(), SEGMENT_LENGTHS_MS.tolist())
+
 DATA_PATH = os.path.join(settings.DATA_DIR,
                          settings.XGDS_PLOT_DATA_SUBDIR)
 
-SEGMENTS_IN_MEMORY_PER_TIME_SERIES = 100
-
 BATCH_READ_NUM_SAMPLES = 5000
-BATCH_SLEEP_NUM_SAMPLES = 100
+
+# live records are buffered and indexed in batches, at least this often
+LIVE_FLUSH_INTERVAL_SECONDS = 1
+
+# flush the live buffer early once it holds this many records
+LIVE_BATCH_NUM_RECORDS = 1000
+
+# how often to rewrite the manifests of levels with new segments
+MANIFEST_WRITE_INTERVAL_SECONDS = 5
 
 
 class SegmentIndex(object):
@@ -68,6 +84,20 @@ class SegmentIndex(object):
         return [cls.getSegmentIndexContainingTime(level, posixTimeMs)
                 for level in xrange(MIN_SEGMENT_LEVEL, MAX_SEGMENT_LEVEL)]
 
+    @classmethod
+    def getSegmentAndBucketIndices(cls, posixTimesMs):
+        """
+        Vectorized getSegmentIndexContainingTime() and
+        getBucketIndexContainingTime(). Returns arrays indexed by
+        [level - MIN_SEGMENT_LEVEL, sample].
+        """
+        segVals = (numpy.asarray(posixTimesMs, dtype='d')[numpy.newaxis, :]
+                   / SEGMENT_LENGTHS_MS[:, numpy.newaxis])
+        segmentIndices = segVals.astype('l')
+        bucketIndices = ((segVals - segmentIndices)
+                         * settings.XGDS_PLOT_SEGMENT_RESOLUTION).astype('l')
+        return segmentIndices, bucketIndices
+
     def __init__(self, meta, subscriber, batchIndexAtStart=True):
         self.meta = meta
         self.subscriber = subscriber
@@ -92,6 +122,37 @@ class SegmentIndex(object):
                                  maxDelaySeconds=5,
                                  numBuckets=10)
 
+        # in bottom-up mode, batch indexing only populates the finest
+        # level and coarser levels are built from it at the end
+        self.bottomUp = settings.XGDS_PLOT_BOTTOM_UP_PYRAMID
+        self.pyramidSegments = set()
+
+        # level -> {segment index: last modified time}
+        self.manifests = {}
+        self.dirtyManifests = set()
+        # (segment index, write time) of segments the writer threads have
+        # finished; only these are added to the manifests, so a manifest
+        # version never refers to a file that isn't written yet
+        self.writtenSegments = deque()
+        self.lastManifestWriteTime = 0
+
+        # content codings of the pre-compressed copies of output segments
+        self.encodings = segmentFile.getEncodings(settings.XGDS_PLOT_SEGMENT_ENCODINGS)
+        self.segmentWriter = SegmentWriter(self.writeSegmentFiles,
+                                           numThreads=settings.XGDS_PLOT_SEGMENT_WRITER_THREADS,
+                                           maxQueueSize=settings.XGDS_PLOT_SEGMENT_WRITER_QUEUE_SIZE,
+                                           fsync=settings.XGDS_PLOT_SEGMENT_WRITER_FSYNC)
+
+        # samples indexed since the last checkpoint are logged so they
+        # can be replayed after a crash
+        self.log = None
+        self.replaying = False
+        self.replayedSegments = None
+        self.checkpointMaxTime = None
+        self.merging = False
+        self.checkpointStore = None
+        self.lastCheckpointTime = 0
+
         self.queue = deque()
         self.running = False
         self.status = None
@@ -100,9 +161,13 @@ class SegmentIndex(object):
         self.store = None
         self.batchProcessStartTime = None
 
-    def start(self):
-        self.store = LruCacheStore(FileStore(self.cacheDir),
-                                   SEGMENTS_IN_MEMORY_PER_TIME_SERIES)
+    def start(self, batchIndex=True):
+        """
+        Start indexing. If @batchIndex is False, the caller must call
+        finishBatchIndex() after batch indexing.
+        """
+        self.store = makeSegmentStore(self.cacheDir, self.valueManager.makeSegment)
+        self.segmentWriter.start()
         self.delayBox.start()
         if self.subscriber:
             self.queryManager.subscribeDjango(self.subscriber,
@@ -110,6 +175,17 @@ class SegmentIndex(object):
 
         self.running = True
 
+        self.readStatus()
+        self.recover()
+        # clients include the build id in segment urls, so a clean
+        # rebuild doesn't collide with segments they cached as immutable
+        self.status.setdefault('buildId', int(time.time() * 1000))
+        self.statusStore.write(self.status)
+
+        if self.queueMode and batchIndex:
+            self.batchIndex()
+
+    def readStatus(self):
         self.statusPath = os.path.join(self.segmentDir,
                                        'status.json')
         self.statusStore = plotUtil.JsonStore(self.statusPath)
@@ -119,98 +195,428 @@ class SegmentIndex(object):
             'numSamples': 0,
             'numSegments': 0
         })
-        self.statusStore.write(self.status)
-
-        if self.queueMode:
-            self.batchIndex()
+        return self.status
+
+    def recover(self):
+        """
+        Restore the status saved by the last checkpoint and replay the
+        samples logged since then, which may not have reached the
+        segment cache before the indexer stopped. status.json can't be
+        trusted for this because it is written between checkpoints.
+        """
+        self.checkpointStore = plotUtil.JsonStore(os.path.join(self.cacheDir, 'checkpoint.json'))
+        self.log = SegmentLog(os.path.join(self.cacheDir, 'log.dat'))
+        checkpoint = self.checkpointStore.read()
+        if checkpoint is not None:
+            if checkpoint['merging']:
+                print >> sys.stderr, ('warning: %s indexer stopped while merging shards; some samples may be counted twice, run with --clean to reindex'
+                                      % self.valueCode)
+            self.status = checkpoint['status']
+            self.checkpointMaxTime = self.status['maxTime']
+            if self.checkpointMaxTime is None:
+                self.checkpointMaxTime = -numpy.inf
+            self.pyramidSegments.update(checkpoint['pyramidSegments'])
+            numSamples = 0
+            self.replaying = True
+            self.replayedSegments = set()
+            for posixTimesMs, vals in self.log.read():
+                self.indexSamples(posixTimesMs, vals)
+                numSamples += len(posixTimesMs)
+            self.replaying = False
+            self.replayedSegments = None
+            if numSamples:
+                print ('--> replayed %d %s samples logged since the last checkpoint'
+                       % (numSamples, self.valueCode))
+        self.checkpoint()
+
+    def checkpoint(self):
+        """
+        Save the segment cache and the output segments together with the
+        matching status and empty the log. After a crash, only segments
+        changed by the replay need to be written again.
+        """
+        self.store.sync()
+        self.delayBox.sync()
+        self.segmentWriter.sync()
+        self.writeManifests()
+        # every segment that ends before maxTime is now written in full,
+        # unless coarse levels are still waiting for the pyramid build.
+        # clients may cache segments before closedTime as immutable.
+        if not self.pyramidSegments:
+            self.status['closedTime'] = self.status['maxTime']
+        self.checkpointStore.write({'status': self.status,
+                                    'pyramidSegments': sorted(self.pyramidSegments),
+                                    'merging': self.merging})
+        self.log.truncate()
+        self.lastCheckpointTime = time.time()
 
     def flushStore(self):
         print '--> flushing store for %s' % self.valueCode
         if self.running:
-            self.store.sync()
-            self.delayBox.sync()
+            self.flushLiveQueue()
+            self.checkpoint()
+            print '--> segment writer for %s: %s' % (self.valueCode, self.segmentWriter.getStatsString())
             self.statusStore.write(self.status)
 
     def stop(self):
         if self.running:
             self.flushStore()
             self.delayBox.stop()
+            self.segmentWriter.stop()
+            self.log.close()
             self.running = False
 
     def handleRecord(self, obj):
-        if self.queueMode:
-            self.queue.append(obj)
+        self.queue.append(obj)
+        if not self.queueMode and len(self.queue) >= LIVE_BATCH_NUM_RECORDS:
+            self.flushLiveQueue()
+
+    def flushLiveQueue(self):
+        """
+        Index the live records received since the last call.
+        """
+        if self.queueMode or not self.queue:
+            return
+        if len(self.queue) == 1:
+            self.indexRecord(self.queue.popleft())
         else:
-            self.indexRecord(obj)
+            recs = list(self.queue)
+            self.queue.clear()
+            self.indexRecords(recs)
 
     def indexRecord(self, obj):
-        if (self.queueMode and
-                (self.status['numSamples'] % BATCH_SLEEP_NUM_SAMPLES) == 0):
-            batchProcessDuration = time.time() - self.batchProcessStartTime
-            if settings.XGDS_PLOT_BATCH_SLEEP_TIME_FACTOR > 0:
-                sleepTime = batchProcessDuration * settings.XGDS_PLOT_BATCH_SLEEP_TIME_FACTOR
-                print 'sleeping for %.3f seconds to avoid overloading server' % sleepTime
-                time.sleep(sleepTime)
-            else:
-                time.sleep(0)
-            self.batchProcessStartTime = time.time()
+        self.indexSample(self.queryManager.getTimestamp(obj),
+                         self.valueManager.getValue(obj))
 
-        posixTimeMs = self.queryManager.getTimestamp(obj)
+    def indexRecords(self, recs):
+        if not recs:
+            return
+        posixTimesMs = numpy.array([self.queryManager.getTimestamp(rec)
+                                    for rec in recs], dtype='d')
+        vals = self.valueManager.getValues(recs)
+        self.indexSamples(posixTimesMs, vals)
+
+    def indexColumns(self, posixTimesMs, columns):
+        self.indexSamples(posixTimesMs,
+                          self.valueManager.getValuesFromColumns(columns))
+
+    def indexSamples(self, posixTimesMs, vals):
+        """
+        Add a batch of samples, in order of increasing time, to every level.
+        """
+        if (self.log is not None and not self.replaying
+                and time.time() - self.lastCheckpointTime > settings.XGDS_PLOT_CHECKPOINT_INTERVAL_SECONDS):
+            self.checkpoint()
+
+        # drop samples that are not newer than everything indexed before them
         maxTime = self.status['maxTime'] or -99e+20
-        if posixTimeMs <= maxTime:
-            print ('skipping old (duplicate?) record: posixTimeMs %.3f <= maxTime %.3f'
-                   % (posixTimeMs, self.status['maxTime']))
+        prevMaxTimes = numpy.maximum.accumulate(numpy.concatenate(([maxTime],
+                                                                   posixTimesMs)))[:-1]
+        keep = posixTimesMs > prevMaxTimes
+        numSkipped = len(keep) - numpy.count_nonzero(keep)
+        if numSkipped:
+            print ('skipping %d old (duplicate?) records: posixTimeMs <= maxTime %.3f'
+                   % (numSkipped, prevMaxTimes[~keep].max()))
+            posixTimesMs = posixTimesMs[keep]
+            vals = vals[..., keep]
+        if len(posixTimesMs) == 0:
             return
 
-        self.status['maxTime'] = max(maxTime, posixTimeMs)
+        # log the samples before they change any segment
+        if self.log is not None and not self.replaying:
+            self.log.append(posixTimesMs, vals)
+
+        self.status['maxTime'] = max(maxTime, posixTimesMs[-1])
         minTime = self.status['minTime'] or 99e+20
-        self.status['minTime'] = min(minTime, posixTimeMs)
+        self.status['minTime'] = min(minTime, posixTimesMs[0])
+
+        # records with no value are left out of the segments. they don't
+        # count as samples either, so numSamples always matches the
+        # segment counts that clearFrom() subtracts.
+        hasValue = ~numpy.isnan(numpy.atleast_2d(vals)).any(axis=0)
+        if not hasValue.all():
+            posixTimesMs = posixTimesMs[hasValue]
+            vals = vals[..., hasValue]
+            if len(posixTimesMs) == 0:
+                return
+
+        prevNumSamples = self.status['numSamples']
+        self.status['numSamples'] += len(posixTimesMs)
+        if self.status['numSamples'] // 100 != prevNumSamples // 100:
+            print '%d %s segment update' % (self.status['numSamples'], self.valueCode)
+
+        # compute segment and bucket indices for all levels in one step,
+        # then visit each affected segment once
+        segmentIndices, bucketIndices = self.getSegmentAndBucketIndices(posixTimesMs)
+        if self.queueMode and self.bottomUp:
+            levels = SEGMENT_LEVELS[:1]
+            self.pyramidSegments.update(numpy.unique(segmentIndices[0]).tolist())
+        else:
+            levels = SEGMENT_LEVELS
+        for levelIndex, level in enumerate(levels):
+            levelSegments = segmentIndices[levelIndex]
+            _, starts = numpy.unique(levelSegments, return_index=True)
+            ends = numpy.append(starts[1:], len(levelSegments))
+            for start, end in zip(starts, ends):
+                segmentIndex = (int(level), int(levelSegments[start]))
+                self.addSamples(segmentIndex,
+                                bucketIndices[levelIndex, start:end],
+                                posixTimesMs[start:end],
+                                vals[..., start:end])
+                self.segmentChanged(segmentIndex)
+
+    def indexSample(self, posixTimeMs, val):
+        """
+        Scalar version of indexSamples() for one live sample.
+        """
+        if time.time() - self.lastCheckpointTime > settings.XGDS_PLOT_CHECKPOINT_INTERVAL_SECONDS:
+            self.checkpoint()
+
+        maxTime = self.status['maxTime']
+        if maxTime is not None and posixTimeMs <= maxTime:
+            print ('skipping old (duplicate?) record: posixTimeMs %.3f <= maxTime %.3f'
+                   % (posixTimeMs, maxTime))
+            return
+
+        vals = numpy.array(val, dtype='d')[..., numpy.newaxis]
+        self.log.append(numpy.array([posixTimeMs], dtype='d'), vals)
+
+        self.status['maxTime'] = posixTimeMs
+        if self.status['minTime'] is None:
+            self.status['minTime'] = posixTimeMs
+
+        if numpy.isnan(vals).any():
+            return
         self.status['numSamples'] += 1
         if self.status['numSamples'] % 100 == 0:
             print '%d %s segment update' % (self.status['numSamples'], self.valueCode)
 
-        for segmentIndex in self.getSegmentIndicesContainingTime(posixTimeMs):
-            val = self.valueManager.getValue(obj)
-            if val is None:
-                continue
-            self.addSample(segmentIndex, posixTimeMs, val)
-            self.delayBox.addJob(segmentIndex)
-
-    def addSample(self, segmentIndex, posixTimeMs, val):
+        val = vals[..., 0].tolist()
+        resolution = settings.XGDS_PLOT_SEGMENT_RESOLUTION
+        for level, segmentLength in LEVEL_LENGTHS_MS:
+            segVal = posixTimeMs / segmentLength
+            t = int(segVal)
+            segmentIndex = (level, t)
+            self.addSample(segmentIndex,
+                           int((segVal - t) * resolution),
+                           posixTimeMs,
+                           val)
+            self.segmentChanged(segmentIndex)
+
+    def addSample(self, segmentIndex, bucketIndex, posixTimeMs, val):
         segmentKey = self.getKeyFromSegmentIndex(segmentIndex)
         try:
             segmentData = self.store[segmentKey]
         except KeyError:
             segmentData = self.valueManager.makeSegment()
             self.status['numSegments'] += 1
-        level, _t = segmentIndex
-        bucketIndex = self.getBucketIndexContainingTime(level, posixTimeMs)
         segmentData.addSample(bucketIndex, posixTimeMs, val)
         self.store[segmentKey] = segmentData
 
+    def segmentChanged(self, segmentIndex):
+        self.delayBox.addJob(segmentIndex)
+
+    def addSamples(self, segmentIndex, bucketIndices, posixTimesMs, vals):
+        segmentKey = self.getKeyFromSegmentIndex(segmentIndex)
+        try:
+            segmentData = self.store[segmentKey]
+            if (self.replaying
+                    and segmentKey not in self.replayedSegments
+                    and segmentData.minTime > self.checkpointMaxTime):
+                # created after the checkpoint, then written to the cache
+                self.status['numSegments'] += 1
+        except KeyError:
+            segmentData = self.valueManager.makeSegment()
+            self.status['numSegments'] += 1
+        if self.replaying:
+            # the cache may have received this segment after some of the
+            # logged samples were added to it
+            self.replayedSegments.add(segmentKey)
+            keep = posixTimesMs > segmentData.maxTime
+            if not keep.all():
+                bucketIndices = bucketIndices[keep]
+                posixTimesMs = posixTimesMs[keep]
+                vals = vals[..., keep]
+                if len(posixTimesMs) == 0:
+                    return
+        segmentData.addSamples(bucketIndices, posixTimesMs, vals)
+        self.store[segmentKey] = segmentData
+
+    def buildPyramid(self, segmentNumbers, level=MIN_SEGMENT_LEVEL):
+        """
+        Rebuild the coarser levels covering segments @segmentNumbers at
+        @level by merging children.
+        """
+        childNumbers = set(segmentNumbers)
+        for childLevel in xrange(level, MAX_SEGMENT_LEVEL - 1):
+            parentLevel = childLevel + 1
+            parentNumbers = set(t // 2 for t in childNumbers)
+            print ('--> building %d %s segments at level %d'
+                   % (len(parentNumbers), self.valueCode, parentLevel))
+            for t in sorted(parentNumbers):
+                parentData = self.valueManager.makeSegment()
+                numChildren = 0
+                for half in (0, 1):
+                    childKey = self.getKeyFromSegmentIndex((childLevel, 2 * t + half))
+                    try:
+                        childData = self.store[childKey]
+                    except KeyError:
+                        continue
+                    parentData.addChild(childData, half)
+                    numChildren += 1
+                if numChildren == 0:
+                    continue
+
+                parentKey = self.getKeyFromSegmentIndex((parentLevel, t))
+                try:
+                    self.store[parentKey]
+                except KeyError:
+                    self.status['numSegments'] += 1
+                self.store[parentKey] = parentData
+                self.segmentChanged((parentLevel, t))
+            childNumbers = parentNumbers
+
+    def rebuildPyramid(self):
+        """
+        Rebuild all coarser levels from the finest level, for example
+        after changing XGDS_PLOT_MAX_SEGMENT_LENGTH_MS.
+        """
+        if self.status['minTime'] is None:
+            return
+        segmentLength = 2.0 ** MIN_SEGMENT_LEVEL
+        self.buildPyramid(xrange(int(self.status['minTime'] / segmentLength),
+                                 int(self.status['maxTime'] / segmentLength) + 1))
+        self.flushStore()
+
+    def clearFrom(self, posixTimeMs):
+        """
+        Delete the indexed data from the finest segment containing
+        @posixTimeMs onward, on every level. Call start() first.
+        """
+        # start from a checkpoint, so no writes are pending for the
+        # segments about to be deleted
+        self.checkpoint()
+        boundarySegment = int(posixTimeMs // 2 ** MIN_SEGMENT_LEVEL)
+        boundaryTime = boundarySegment * 2.0 ** MIN_SEGMENT_LEVEL
+        print ('--> clearing %s data indexed since %s'
+               % (self.valueCode, plotUtil.getUtcTimeString(boundaryTime)))
+
+        finestManifest = self.getManifest(MIN_SEGMENT_LEVEL)
+        keptSegments = [t for t in finestManifest if t < boundarySegment]
+        numSamples = 0
+        numSegments = 0
+        for level in SEGMENT_LEVELS:
+            level = int(level)
+            manifest = self.getManifest(level)
+            first = int(boundaryTime // 2 ** level)
+            for t in sorted([t for t in manifest if t >= first]):
+                segmentKey = self.getKeyFromSegmentIndex((level, t))
+                try:
+                    segmentData = self.store[segmentKey]
+                except KeyError:
+                    pass
+                else:
+                    if level == MIN_SEGMENT_LEVEL:
+                        numSamples += int(segmentData.count.sum())
+                    del self.store[segmentKey]
+                    numSegments += 1
+                segmentFile.removeSegmentFiles(self.segmentDir, level, t)
+                del manifest[t]
+            self.dirtyManifests.add(level)
+        self.pyramidSegments = set([t for t in self.pyramidSegments if t < boundarySegment])
+
+        # resume batch indexing after the last sample that was kept
+        if keptSegments:
+            maxTime = self.store[self.getKeyFromSegmentIndex((MIN_SEGMENT_LEVEL, max(keptSegments)))].maxTime
+            if maxTime == -numpy.inf:
+                # segment written before segments tracked their time range
+                maxTime = boundaryTime - 1e-3
+            self.status['maxTime'] = maxTime
+            self.status['numSamples'] = max(self.status['numSamples'] - numSamples, 0)
+        else:
+            self.status['minTime'] = None
+            self.status['maxTime'] = None
+            self.status['numSamples'] = 0
+        self.status['numSegments'] -= numSegments
+        # clients cache closed segments as immutable, so they need a new
+        # url for segments that changed
+        self.status['buildId'] = int(time.time() * 1000)
+
+        print '--> deleted %d %s segments' % (numSegments, self.valueCode)
+        self.buildPyramid([boundarySegment])
+        self.flushStore()
+
     def writeJsonWithTmp(self, outPath, obj, styleArgs=None):
         if styleArgs is None:
             styleArgs = {}
-        tmpPath = outPath + '.part'
-        json.dump(plotUtil.compactFloats(obj),
-                  open(tmpPath, 'wb'),
-                  **styleArgs)
-        os.rename(tmpPath, outPath)
+        return segmentFile.writeSegmentData(outPath,
+                                            json.dumps(plotUtil.compactFloats(obj), **styleArgs),
+                                            self.encodings)
+
+    def writeSegmentFiles(self, segmentIndex, segmentData):
+        """
+        Write the output files for @segmentData. Runs on a segment writer
+        thread, so it must not touch the store or the manifests; it
+        reports the write through self.writtenSegments instead. Returns
+        the list of paths written.
+        """
+        level, t = segmentIndex
+        outBase = os.path.join(self.segmentDir, str(level), str(t))
+        paths = []
+        if 'json' in settings.XGDS_PLOT_SEGMENT_FORMATS:
+            if settings.XGDS_PLOT_PRETTY_PRINT_JSON_SEGMENTS:
+                styleArgs = dict(sort_keys=True,
+                                 indent=4)
+            else:
+                styleArgs = dict(separators=(',', ':'))
+            paths += self.writeJsonWithTmp(outBase + '.json', segmentData.getJsonObj(), styleArgs)
+        if 'bin' in settings.XGDS_PLOT_SEGMENT_FORMATS:
+            fields, columns = segmentData.getColumns()
+            paths += segmentFile.writeBinarySegment(outBase + '.bin', fields, columns, self.encodings)
+        self.writtenSegments.append((segmentIndex, int(time.time() * 1000)))
+        return paths
 
     def writeOutputSegment(self, segmentIndex):
+        # hand a snapshot to the writer, since indexing keeps modifying
+        # the segment in the store
         level, t = segmentIndex
-        segmentKey = self.getKeyFromSegmentIndex(segmentIndex)
-        segmentData = self.store[segmentKey]
-        outPath = '%s/%d/%d.json' % (self.segmentDir, level, t)
-        outDir = os.path.dirname(outPath)
-        if not os.path.exists(outDir):
-            os.makedirs(outDir)
-        if settings.XGDS_PLOT_PRETTY_PRINT_JSON_SEGMENTS:
-            styleArgs = dict(sort_keys=True,
-                             indent=4)
-        else:
-            styleArgs = dict(separators=(',', ':'))
-        self.writeJsonWithTmp(outPath, segmentData.getJsonObj(), styleArgs)
+        segmentData = self.store[self.getKeyFromSegmentIndex(segmentIndex)]
+        # the level directory also holds the manifest, so create it here
+        self.segmentWriter.makeDirs(os.path.join(self.segmentDir, str(level)))
+        self.segmentWriter.submit(segmentIndex, segmentData.copy())
+
+        if time.time() - self.lastManifestWriteTime > MANIFEST_WRITE_INTERVAL_SECONDS:
+            self.writeManifests()
+
+    def flushManifests(self):
+        """
+        Called periodically by the indexer, so segments written after
+        the last burst of data reach the manifests even if no more data
+        arrives. The views trust the manifests to list every segment.
+        """
+        if (self.writtenSegments
+                and time.time() - self.lastManifestWriteTime > MANIFEST_WRITE_INTERVAL_SECONDS):
+            self.writeManifests()
+
+    def getManifest(self, level):
+        if level not in self.manifests:
+            manifest = segmentFile.readManifest(self.segmentDir, level)
+            if manifest is None:
+                self.manifests[level] = segmentFile.scanSegments(self.segmentDir, level)
+            else:
+                self.manifests[level] = manifest[0]
+        return self.manifests[level]
+
+    def writeManifests(self):
+        while self.writtenSegments:
+            (level, t), writeTime = self.writtenSegments.popleft()
+            self.getManifest(level)[t] = writeTime
+            self.dirtyManifests.add(level)
+        for level in self.dirtyManifests:
+            segmentFile.writeManifest(self.segmentDir, level, self.manifests[level],
+                                      self.status['maxTime'])
+        self.dirtyManifests = set()
+        self.lastManifestWriteTime = time.time()
 
     def clean(self):
         # must call this before start() !
@@ -220,37 +626,301 @@ class SegmentIndex(object):
         plotUtil.rmIfPossible(self.segmentDir)
 
     def flushQueue(self):
-        while self.queue:
-            self.indexRecord(self.queue.popleft())
+        recs = list(self.queue)
+        self.queue.clear()
+        if recs:
+            self.batchProcessStartTime = plotUtil.batchSleep(self.batchProcessStartTime)
+        self.indexRecords(recs)
+
+    def getShardIntervals(self, numShards):
+        """
+        Split the data not yet indexed into @numShards intervals
+        (minTime, maxTime]; the last one is open-ended. Call readStatus()
+        or start() first.
+        """
+        minTime = self.status['maxTime']
+        if minTime is None:
+            minTime = self.queryManager.getMinTime()
+            if minTime is None:
+                return []
+            # intervals exclude their start time
+            minTime -= 1000
+        maxTime = self.queryManager.getMaxTime()
+        if maxTime is None or maxTime <= minTime:
+            return []
+        boundaries = numpy.linspace(minTime, maxTime, numShards + 1).tolist()
+        boundaries[-1] = None
+        return zip(boundaries[:-1], boundaries[1:])
+
+    def mergeShard(self, shardResult):
+        """
+        Merge the segments indexed by batchIndexShard(), in any order.
+        """
+        shardIndex, shardStatus, changedSegments, pyramidSegments = shardResult
+        if not self.merging:
+            # merges aren't logged, so a restart can't recover from a
+            # partial merge; the checkpoint records that one was underway
+            self.merging = True
+            self.checkpoint()
+        shardCacheDir = SegmentIndexShard.getShardCacheDir(self.cacheDir, shardIndex)
+        print ('--> merging %d %s segments from shard %d'
+               % (len(changedSegments), self.valueCode, shardIndex))
+        shardStore = makeSegmentStore(shardCacheDir, self.valueManager.makeSegment)
+        for segmentIndex in changedSegments:
+            segmentKey = self.getKeyFromSegmentIndex(segmentIndex)
+            shardData = shardStore[segmentKey]
+            try:
+                segmentData = self.store[segmentKey]
+                segmentData.merge(shardData)
+            except KeyError:
+                segmentData = shardData
+                self.status['numSegments'] += 1
+            self.store[segmentKey] = segmentData
+            self.segmentChanged(segmentIndex)
+        self.pyramidSegments.update(pyramidSegments)
+
+        if shardStatus['minTime'] is not None:
+            for field, func in (('minTime', min), ('maxTime', max)):
+                if self.status[field] is None:
+                    self.status[field] = shardStatus[field]
+                else:
+                    self.status[field] = func(self.status[field], shardStatus[field])
+            self.status['numSamples'] += shardStatus['numSamples']
+
+        plotUtil.rmIfPossible(shardCacheDir)
+
+    def finishShardMerge(self):
+        self.merging = False
+        shardsDir = os.path.join(self.cacheDir, 'shards')
+        if os.path.exists(shardsDir):
+            plotUtil.rmIfPossible(shardsDir)
+        if self.pyramidSegments:
+            self.buildPyramid(self.pyramidSegments)
+            self.pyramidSegments = set()
+        self.flushStore()
 
-    def batchIndex(self):
+    def batchIndex(self, maxTime=None):
         self.batchProcessStartTime = time.time()
 
         # index everything in db that comes after the last thing we indexed on
         # the previous run
         print '--> batch indexing %s' % self.valueCode
-        while 1:
-            recs = self.queryManager.getData(minTime=self.status['maxTime'])
-            n = recs.count()
-            if n == 0:
-                break
-            print '--> %d %s samples remaining' % (n, self.valueCode)
-            for rec in recs[:BATCH_READ_NUM_SAMPLES]:
-                self.indexRecord(rec)
+        startTime = self.status['maxTime']
+        endTime = self.queryManager.getMaxTime() or time.time() * 1000
+        valueFields = self.valueManager.getValueFields()
+        if maxTime is not None:
+            endTime = maxTime
+        pages = self.queryManager.iterColumns(valueFields,
+                                              minTime=self.status['maxTime'],
+                                              maxTime=maxTime,
+                                              pageSize=BATCH_READ_NUM_SAMPLES)
+        for posixTimesMs, columns in pages:
+            if startTime is None:
+                startTime = posixTimesMs[0]
+            self.batchProcessStartTime = plotUtil.batchSleep(self.batchProcessStartTime)
+            self.indexColumns(posixTimesMs, columns)
 
             # avoid django debug log memory leak
             db.reset_queries()
 
             self.statusStore.write(self.status)
+            if self.status['maxTime'] is not None:
+                print ('--> %s %s'
+                       % (self.valueCode,
+                          plotUtil.getProgressString(startTime, self.status['maxTime'], endTime)))
 
+        self.finishBatchIndex()
+
+    def finishBatchIndex(self):
         # batch process new records that arrived while we were
         # processing the database table.
         print ('--> indexing %d %s samples that came in during batch indexing'
                % (len(self.queue), self.valueCode))
         self.flushQueue()
 
+        if self.pyramidSegments:
+            self.buildPyramid(self.pyramidSegments)
+            self.pyramidSegments = set()
+
         self.flushStore()
 
         # switch modes to process each new record as it comes in.
         print '--> switching to live data mode'
         self.queueMode = False
+
+
+class SegmentIndexShard(SegmentIndex):
+    """
+    Indexes the records in (minTime, maxTime] into a private cache
+    directory, to be merged by SegmentIndex.mergeShard().
+    """
+    @classmethod
+    def getShardCacheDir(cls, cacheDir, shardIndex):
+        return os.path.join(cacheDir, 'shards', str(shardIndex))
+
+    def __init__(self, meta, shardIndex, minTime, maxTime):
+        super(SegmentIndexShard, self).__init__(meta, None)
+        self.shardIndex = shardIndex
+        self.shardMinTime = minTime
+        self.shardMaxTime = maxTime
+        self.cacheDir = self.getShardCacheDir(self.cacheDir, shardIndex)
+        self.changedSegments = set()
+
+    def start(self, batchIndex=True):
+        # discard leftovers from an interrupted run
+        if os.path.exists(self.cacheDir):
+            plotUtil.rmIfPossible(self.cacheDir)
+        self.store = makeSegmentStore(self.cacheDir, self.valueManager.makeSegment)
+        self.running = True
+        self.statusStore = plotUtil.JsonStore(os.path.join(self.cacheDir, 'status.json'))
+        self.status = {
+            'minTime': None,
+            'maxTime': self.shardMinTime,
+            'numSamples': 0,
+            'numSegments': 0
+        }
+        if batchIndex:
+            self.batchIndex(maxTime=self.shardMaxTime)
+
+    def segmentChanged(self, segmentIndex):
+        self.changedSegments.add(segmentIndex)
+
+    def finishBatchIndex(self):
+        self.store.sync()
+        self.statusStore.write(self.status)
+        self.queueMode = False
+
+    def stop(self):
+        self.running = False
+
+    def getResult(self):
+        return (self.shardIndex,
+                self.status,
+                sorted(self.changedSegments),
+                sorted(self.pyramidSegments))
+
+
+def batchIndexShard(meta, shardIndex, minTime, maxTime):
+    """
+    Index one shard of a time series. Intended to run in a worker process.
+    Returns a result to pass to SegmentIndex.mergeShard().
+    """
+    shard = SegmentIndexShard(meta, shardIndex, minTime, maxTime)
+    shard.start()
+    shard.stop()
+    return shard.getResult()
+
+
+class SegmentIndexGroup(object):
+    """
+    Indexes several time series that read from the same table, reading
+    each batch of rows once.
+    """
+    @classmethod
+    def getGroupKey(cls, meta):
+        if meta['queryType'] != 'xgds_plot.query.Django':
+            # can't assume anything about other query types
+            return ('valueCode', meta['valueCode'])
+        return (meta['queryType'],
+                meta['queryModel'],
+                tuple(tuple(f) for f in meta.get('queryFilter', [])),
+                meta['queryTimestampField'],
+                meta.get('queryTimestampMicrosecondsField'),
+                meta.get('queryTimestampNanosecondsField'),
+                meta.get('startTime'),
+                meta.get('endTime'))
+
+    @classmethod
+    def groupTimeSeries(cls, metaList):
+        """
+        Partition @metaList into lists of time series that can share a
+        query, preserving order.
+        """
+        groups = {}
+        result = []
+        for meta in metaList:
+            key = cls.getGroupKey(meta)
+            if key not in groups:
+                groups[key] = []
+                result.append(groups[key])
+            groups[key].append(meta)
+        return result
+
+    def __init__(self, metaList, subscriber, batchIndexAtStart=True):
+        self.subscriber = subscriber
+        self.queueMode = batchIndexAtStart
+        self.indexes = [SegmentIndex(meta, None, batchIndexAtStart)
+                        for meta in metaList]
+        self.queryManager = self.indexes[0].queryManager
+        self.valueCode = ','.join([index.valueCode for index in self.indexes])
+        self.batchProcessStartTime = None
+
+    def start(self):
+        for index in self.indexes:
+            index.start(batchIndex=False)
+        if self.subscriber:
+            self.queryManager.subscribeDjango(self.subscriber,
+                                              lambda topic, obj: self.handleRecord(obj))
+        if self.queueMode:
+            self.batchIndex()
+
+    def stop(self):
+        for index in self.indexes:
+            index.stop()
+
+    def handleRecord(self, obj):
+        for index in self.indexes:
+            index.handleRecord(obj)
+
+    def flushLiveQueue(self):
+        for index in self.indexes:
+            index.flushLiveQueue()
+
+    def batchIndex(self):
+        self.batchProcessStartTime = time.time()
+
+        # start after the least recent sample indexed by any member
+        maxTimes = [index.status['maxTime'] for index in self.indexes]
+        if None in maxTimes:
+            minTime = None
+        else:
+            minTime = min(maxTimes)
+
+        fields = []
+        for index in self.indexes:
+            for field in index.valueManager.getValueFields():
+                if field not in fields:
+                    fields.append(field)
+
+        print '--> batch indexing %s' % self.valueCode
+        startTime = minTime
+        endTime = self.queryManager.getMaxTime() or time.time() * 1000
+        pages = self.queryManager.iterColumns(fields,
+                                              minTime=minTime,
+                                              pageSize=BATCH_READ_NUM_SAMPLES)
+        for posixTimesMs, columns in pages:
+            if startTime is None:
+                startTime = posixTimesMs[0]
+            self.batchProcessStartTime = plotUtil.batchSleep(self.batchProcessStartTime)
+            columnLookup = dict(zip(fields, columns))
+            for index in self.indexes:
+                # skip rows this member indexed on a previous run
+                first = 0
+                if index.status['maxTime'] is not None:
+                    first = numpy.searchsorted(posixTimesMs, index.status['maxTime'], side='right')
+                index.indexColumns(posixTimesMs[first:],
+                                   [columnLookup[field][first:]
+                                    for field in index.valueManager.getValueFields()])
+                index.statusStore.write(index.status)
+
+            # avoid django debug log memory leak
+            db.reset_queries()
+
+            print ('--> %s %s'
+                   % (self.valueCode,
+                      plotUtil.getProgressString(startTime, posixTimesMs[-1], endTime)))
+
+        for index in self.indexes:
+            index.batchProcessStartTime = self.batchProcessStartTime
+            index.finishBatchIndex()
+        self.queueMode = False
@@ -0,0 +1,110 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The xGDS platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+"""
+Write-ahead log of the samples a SegmentIndex has ingested since its
+last checkpoint. After a crash, replaying the log on top of the
+checkpoint restores the in-memory segment state that was lost.
+
+The log is a sequence of records, one per batch of samples:
+
+  offset  size  contents
+  0       4     magic string 'XGWL'
+  4       4     uint32 number of samples
+  8       4     uint32 number of value rows (0 if the values are 1-D)
+  12      4     uint32 CRC-32 of the payload
+  16      ...   payload: float64 timestamps, then float64 values, row-major
+
+All integers and floats are little-endian. A record cut short by a
+crash fails its length or CRC check, and it and anything after it are
+ignored.
+"""
+
+import os
+import sys
+import struct
+import zlib
+
+import numpy
+
+MAGIC = 'XGWL'
+HEADER_FORMAT = '<4sIII'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+DTYPE = numpy.dtype('<f8')
+
+
+class SegmentLog(object):
+    def __init__(self, path):
+        self.path = path
+        pathDir = os.path.dirname(path)
+        if not os.path.exists(pathDir):
+            os.makedirs(pathDir)
+        self.out = open(path, 'ab')
+
+    def append(self, posixTimesMs, vals):
+        """
+        Log a batch of samples in the format taken by
+        SegmentIndex.indexSamples(). The record reaches the OS before
+        this returns, so it survives the process being killed.
+        """
+        vals = numpy.asarray(vals, dtype=DTYPE)
+        numRows = 0 if vals.ndim == 1 else vals.shape[0]
+        payload = (numpy.ascontiguousarray(posixTimesMs, dtype=DTYPE).tostring()
+                   + numpy.ascontiguousarray(vals).tostring())
+        self.out.write(struct.pack(HEADER_FORMAT, MAGIC, len(posixTimesMs), numRows,
+                                   zlib.crc32(payload) & 0xffffffff)
+                       + payload)
+        self.out.flush()
+
+    def read(self):
+        """
+        Yield the (posixTimesMs, vals) batches in the log, in order.
+        """
+        inFile = open(self.path, 'rb')
+        offset = 0
+        while True:
+            header = inFile.read(HEADER_SIZE)
+            if not header:
+                break
+            if len(header) == HEADER_SIZE:
+                magic, numSamples, numRows, crc = struct.unpack(HEADER_FORMAT, header)
+                payloadSize = numSamples * (1 + max(numRows, 1)) * DTYPE.itemsize
+                payload = inFile.read(payloadSize)
+            if (len(header) < HEADER_SIZE
+                    or magic != MAGIC
+                    or len(payload) < payloadSize
+                    or zlib.crc32(payload) & 0xffffffff != crc):
+                print >> sys.stderr, ('warning: ignoring %d bytes of incomplete records at the end of %s'
+                                      % (os.path.getsize(self.path) - offset, self.path))
+                break
+            offset += HEADER_SIZE + payloadSize
+            posixTimesMs = numpy.fromstring(payload[:numSamples * DTYPE.itemsize], dtype=DTYPE)
+            vals = numpy.fromstring(payload[numSamples * DTYPE.itemsize:], dtype=DTYPE)
+            if numRows:
+                vals = vals.reshape((numRows, numSamples))
+            yield posixTimesMs, vals
+        inFile.close()
+
+    def truncate(self):
+        """
+        Discard all records. Call only after a checkpoint has saved
+        their effects.
+        """
+        self.out.seek(0)
+        self.out.truncate()
+
+    def close(self):
+        self.out.close()
@@ -0,0 +1,234 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The xGDS platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+"""
+Stores for the segments of a SegmentIndex. A store is a dict-like
+object mapping segment keys ('<level>_<segmentNumber>') to segment
+objects, with a sync() method that flushes changes to disk.
+
+'pickle' store: geocamUtil FileStore of pickled segments with an
+in-memory LRU cache.
+
+'array' store: SegmentArrayStore, which keeps each level in one
+memory-mapped file of fixed-size records indexed by segment number.
+Loading a segment copies one record, with no deserialization, and the OS
+page cache decides what stays in memory. A level file has a 64-byte
+header followed by the records:
+
+  offset  size  contents
+  0       4     magic string 'XGSA'
+  4       2     uint16 format version
+  6       2     reserved
+  8       8     int64 segment number of the first record (the origin)
+  16      8     uint64 record size in bytes
+  24      40    reserved
+
+Each record holds the segment's per-bucket arrays followed by its
+float64 minTime and maxTime.
+"""
+
+import os
+import struct
+
+import numpy
+from django.conf import settings
+
+from geocamUtil.store import FileStore, LruCacheStore
+
+SEGMENTS_IN_MEMORY_PER_TIME_SERIES = 100
+
+MAGIC = 'XGSA'
+VERSION = 2
+HEADER_FORMAT = '<4sHxxqQ'
+HEADER_SIZE = 64
+
+# minimum number of records to add when a level file grows
+MIN_GROW_RECORDS = 64
+
+# bytes copied at a time when a level file grows at the front
+COPY_CHUNK_BYTES = 16 * 1024 * 1024
+
+
+def getSegmentDtype(segment):
+    """
+    Return the numpy record dtype for the state of @segment.
+    """
+    arrays = segment.getDenseArrays()
+    return numpy.dtype([(field, arrays[field].dtype.newbyteorder('<'), (segment.n,))
+                        for field in segment.ARRAY_FIELDS]
+                       + [('minTime', '<f8'), ('maxTime', '<f8')])
+
+
+class SegmentArrayStore(object):
+    def __init__(self, dirName, makeSegment):
+        self.dirName = dirName
+        self.makeSegment = makeSegment
+        self.dtype = getSegmentDtype(makeSegment())
+        self.levels = {}  # level -> (origin, memmap of records)
+
+    @classmethod
+    def parseKey(cls, key):
+        level, t = key.split('_')
+        return int(level), int(t)
+
+    def getPath(self, level):
+        return os.path.join(self.dirName, '%s.dat' % level)
+
+    def openLevel(self, level):
+        """
+        Return (origin, records) for @level, or (None, None) if the level
+        file does not exist yet.
+        """
+        if level in self.levels:
+            return self.levels[level]
+        path = self.getPath(level)
+        if not os.path.exists(path):
+            return None, None
+        inFile = open(path, 'rb')
+        header = inFile.read(HEADER_SIZE)
+        inFile.close()
+        magic, version, origin, recordSize = struct.unpack(HEADER_FORMAT, header[:struct.calcsize(HEADER_FORMAT)])
+        if magic != MAGIC or version != VERSION or recordSize != self.dtype.itemsize:
+            raise ValueError('%s is not a version %d segment array file with record size %d'
+                             % (path, VERSION, self.dtype.itemsize))
+        numRecords = (os.path.getsize(path) - HEADER_SIZE) // recordSize
+        records = numpy.memmap(path, dtype=self.dtype, mode='r+',
+                               offset=HEADER_SIZE, shape=(numRecords,))
+        self.levels[level] = (origin, records)
+        return origin, records
+
+    def writeLevel(self, level, origin, numRecords, oldOrigin=None, oldRecords=None):
+        """
+        Create the file for @level with room for @numRecords records
+        starting at segment number @origin, copying in @oldRecords if
+        specified. The file is built at a temporary path and renamed into
+        place.
+        """
+        if not os.path.exists(self.dirName):
+            os.makedirs(self.dirName)
+        path = self.getPath(level)
+        tmpPath = path + '.part'
+        out = open(tmpPath, 'wb')
+        out.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION, origin, self.dtype.itemsize)
+                  .ljust(HEADER_SIZE, '\0'))
+        if oldRecords is not None:
+            # copy in chunks, starting from the end so the file reaches
+            # its final size at once. empty records are all zero, so the
+            # gap before the old records can be a sparse hole.
+            itemSize = self.dtype.itemsize
+            oldStart = HEADER_SIZE + (oldOrigin - origin) * itemSize
+            chunkRecords = max(COPY_CHUNK_BYTES // itemSize, 1)
+            for end in xrange(len(oldRecords), 0, -chunkRecords):
+                start = max(end - chunkRecords, 0)
+                out.seek(oldStart + start * itemSize)
+                out.write(oldRecords[start:end].tostring())
+        out.truncate(HEADER_SIZE + numRecords * self.dtype.itemsize)
+        out.close()
+        self.levels.pop(level, None)
+        os.rename(tmpPath, path)
+        return self.openLevel(level)
+
+    def getRecord(self, level, t, create=False):
+        """
+        Return a one-element view of the record for segment @t of @level.
+        If the record is outside the file, return None, or grow the file
+        if @create is True.
+        """
+        origin, records = self.openLevel(level)
+        if records is None:
+            if not create:
+                return None
+            origin, records = self.writeLevel(level, t, MIN_GROW_RECORDS)
+        i = t - origin
+        if 0 <= i < len(records):
+            return records[i:i + 1]
+        if not create:
+            return None
+
+        # grow the file to cover t, leaving room for further growth in
+        # the same direction
+        records.flush()
+        numRecords = len(records)
+        if i < 0:
+            newOrigin = t - max(numRecords, MIN_GROW_RECORDS)
+            newNumRecords = numRecords + (origin - newOrigin)
+            origin, records = self.writeLevel(level, newOrigin, newNumRecords, origin, records)
+        else:
+            newNumRecords = max(i + 1, 2 * numRecords)
+            del records
+            self.levels.pop(level, None)
+            out = open(self.getPath(level), 'r+b')
+            out.truncate(HEADER_SIZE + newNumRecords * self.dtype.itemsize)
+            out.close()
+            origin, records = self.openLevel(level)
+        i = t - origin
+        return records[i:i + 1]
+
+    def __getitem__(self, key):
+        level, t = self.parseKey(key)
+        record = self.getRecord(level, t)
+        if record is None or not record['count'].any():
+            raise KeyError(key)
+        segment = self.makeSegment()
+        segment.setDenseArrays(dict([(field, record[field][0])
+                                     for field in segment.ARRAY_FIELDS]))
+        segment.minTime = float(record['minTime'][0])
+        segment.maxTime = float(record['maxTime'][0])
+        return segment
+
+    def __setitem__(self, key, segment):
+        level, t = self.parseKey(key)
+        record = self.getRecord(level, t, create=True)
+        arrays = segment.getDenseArrays()
+        for field in segment.ARRAY_FIELDS:
+            record[field] = arrays[field]
+        record['minTime'] = segment.minTime
+        record['maxTime'] = segment.maxTime
+
+    def __delitem__(self, key):
+        level, t = self.parseKey(key)
+        record = self.getRecord(level, t)
+        if record is None or not record['count'].any():
+            raise KeyError(key)
+        record[:] = numpy.zeros(1, dtype=self.dtype)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def sync(self):
+        for _origin, records in self.levels.itervalues():
+            records.flush()
+
+
+def makeSegmentStore(dirName, makeSegment):
+    """
+    Return a segment store for the files in @dirName, of the type
+    selected by settings.XGDS_PLOT_SEGMENT_STORE. @makeSegment is a
+    function that returns a new empty segment.
+    """
+    storeType = settings.XGDS_PLOT_SEGMENT_STORE
+    if storeType == 'pickle':
+        return LruCacheStore(FileStore(dirName),
+                             SEGMENTS_IN_MEMORY_PER_TIME_SERIES)
+    elif storeType == 'array':
+        return SegmentArrayStore(dirName, makeSegment)
+    else:
+        raise ValueError('unknown XGDS_PLOT_SEGMENT_STORE %s, expected pickle or array'
+                         % repr(storeType))
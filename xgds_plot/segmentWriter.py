@@ -0,0 +1,221 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The xGDS platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+"""
+Write-behind pool of threads that write output segment files, so
+encoding and file I/O don't stall the indexing thread.
+
+Jobs are keyed by segment. A job submitted while an earlier job for
+the same segment is still queued replaces its data, so a burst of
+updates to one segment costs one write. All jobs for a key go to the
+same thread, so writes of a segment are never reordered. Each thread
+has a bounded queue; when it is full, submit() blocks until there is
+room, which throttles indexing instead of letting the backlog grow.
+"""
+
+import os
+import sys
+import errno
+import time
+import threading
+import traceback
+import Queue
+
+# tells a writer thread to exit
+STOP = object()
+
+
+class SegmentWriter(object):
+    def __init__(self, writeFunc, numThreads=2, maxQueueSize=1000,
+                 fsync=False, fsyncBatchSize=64):
+        """
+        @writeFunc(key, data) writes the files for one job and returns a
+        list of the paths it wrote. If @numThreads is 0, jobs are written
+        immediately on the calling thread. If @fsync is True, written
+        files and their directories are synced to disk in batches of up
+        to @fsyncBatchSize files, or whenever a thread runs out of work.
+        """
+        self.writeFunc = writeFunc
+        self.numThreads = numThreads
+        self.fsync = fsync
+        self.fsyncBatchSize = fsyncBatchSize
+
+        self.lock = threading.Lock()
+        self.pending = {}  # key -> (data, time of first submit)
+        queueSize = max(1, maxQueueSize // max(numThreads, 1))
+        self.queues = [Queue.Queue(queueSize) for _i in xrange(numThreads)]
+        self.threads = []
+        self.createdDirs = set()
+
+        self.stats = {
+            'submitted': 0,
+            'coalesced': 0,
+            'written': 0,
+            'errors': 0,
+            'blocked': 0,
+            'blockedSeconds': 0.0,
+            'maxQueueDepth': 0,
+            'totalLatencySeconds': 0.0,
+            'maxLatencySeconds': 0.0,
+        }
+
+    def start(self):
+        for queue in self.queues:
+            thread = threading.Thread(target=self.run, args=(queue,))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        if self.threads:
+            for queue in self.queues:
+                queue.put(STOP)
+            for thread in self.threads:
+                thread.join()
+            self.threads = []
+
+    def sync(self):
+        """
+        Wait until all submitted jobs are written.
+        """
+        if self.threads:
+            for queue in self.queues:
+                queue.join()
+
+    def submit(self, key, data):
+        """
+        Queue @data to be written by writeFunc(@key, @data). @data must
+        not be modified afterwards.
+        """
+        submitTime = time.time()
+        with self.lock:
+            self.stats['submitted'] += 1
+        if not self.threads:
+            paths = self.write(key, data, submitTime)
+            if self.fsync:
+                self.syncFiles(paths)
+            return
+
+        with self.lock:
+            if key in self.pending:
+                # keep the first submit time, since the segment on disk
+                # has been stale since then
+                self.pending[key] = (data, self.pending[key][1])
+                self.stats['coalesced'] += 1
+                return
+            self.pending[key] = (data, submitTime)
+
+        queue = self.queues[hash(key) % len(self.queues)]
+        try:
+            queue.put_nowait(key)
+        except Queue.Full:
+            queue.put(key)
+            with self.lock:
+                self.stats['blocked'] += 1
+                self.stats['blockedSeconds'] += time.time() - submitTime
+        with self.lock:
+            self.stats['maxQueueDepth'] = max(self.stats['maxQueueDepth'], queue.qsize())
+
+    def makeDirs(self, path):
+        """
+        Make sure directory @path exists. Remembers directories it has
+        seen, to avoid a stat call for every file written.
+        """
+        if path in self.createdDirs:
+            return
+        try:
+            os.makedirs(path)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        self.createdDirs.add(path)
+
+    def write(self, key, data, submitTime):
+        try:
+            paths = self.writeFunc(key, data)
+        except:  # pylint: disable=W0702
+            print >> sys.stderr, 'warning: failed to write segment %s' % repr(key)
+            traceback.print_exc()
+            with self.lock:
+                self.stats['errors'] += 1
+            return []
+        latency = time.time() - submitTime
+        with self.lock:
+            self.stats['written'] += 1
+            self.stats['totalLatencySeconds'] += latency
+            self.stats['maxLatencySeconds'] = max(self.stats['maxLatencySeconds'], latency)
+        return paths
+
+    def syncFiles(self, paths):
+        dirs = set()
+        for path in paths:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            dirs.add(os.path.dirname(path))
+        # sync the directories so the renames are durable
+        for path in dirs:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def run(self, queue):
+        unsynced = []
+        numUnfinished = 0
+        while True:
+            key = queue.get()
+            numUnfinished += 1
+            if key is not STOP:
+                with self.lock:
+                    data, submitTime = self.pending.pop(key)
+                unsynced.extend(self.write(key, data, submitTime))
+                # task_done() is deferred until the batch is synced, so
+                # sync() returns only after the files are on disk
+                if self.fsync and len(unsynced) < self.fsyncBatchSize and not queue.empty():
+                    continue
+
+            if self.fsync and unsynced:
+                try:
+                    self.syncFiles(unsynced)
+                except OSError:
+                    traceback.print_exc()
+            unsynced = []
+            for _i in xrange(numUnfinished):
+                queue.task_done()
+            numUnfinished = 0
+            if key is STOP:
+                break
+
+    def getStats(self):
+        with self.lock:
+            stats = self.stats.copy()
+            stats['queueDepth'] = sum([queue.qsize() for queue in self.queues])
+        if stats['written']:
+            stats['meanLatencySeconds'] = stats['totalLatencySeconds'] / stats['written']
+        else:
+            stats['meanLatencySeconds'] = 0.0
+        return stats
+
+    def getStatsString(self):
+        return ('%(written)d written, %(coalesced)d coalesced, %(errors)d errors, '
+                'queue depth %(queueDepth)d (max %(maxQueueDepth)d), '
+                'blocked %(blocked)d times for %(blockedSeconds).1fs, '
+                'latency mean %(meanLatencySeconds).3fs max %(maxLatencySeconds).3fs'
+                % self.getStats())
@@ -412,47 +412,184 @@ $.extend(xgds_plot, {
         return result;
     },
 
-    getSegmentUrl: function(segment) {
-        return (settings.DATA_URL +
-                settings.XGDS_PLOT_DATA_SUBDIR +
-                'plot/' +
-                segment.info.meta.valueCode + '/' +
-                segment.level + '/' +
-                segment.index + '.json');
+    getSegmentUrl: function(segment, extension) {
+        if (extension == undefined) {
+            extension = 'json';
+        }
+        // served by django rather than statically, so closed segments
+        // get long-lived caching headers
+        var url = (settings.SCRIPT_NAME +
+                   'xgds_plot/rest/segment/' +
+                   segment.info.meta.valueCode + '/' +
+                   segment.level + '/' +
+                   segment.index + '.' + extension +
+                   '?v=' + xgds_plot.getSegmentVersion(segment.info));
+        return url;
+    },
+
+    getSegmentVersion: function(info) {
+        // closed segments are cached as immutable, so each build of the
+        // index (a clean rebuild or a partial reindex) needs different
+        // urls
+        if (info.status != undefined && info.status.buildId != undefined) {
+            return info.status.buildId;
+        }
+        return 0;
     },
 
     getStatusUrl: function(info) {
-        return (settings.DATA_URL +
-                settings.XGDS_PLOT_DATA_SUBDIR +
-                'plot/' +
-                info.meta.valueCode + '/' +
-                'status.json');
+        return (settings.SCRIPT_NAME +
+                'xgds_plot/rest/status/' +
+                info.meta.valueCode + '.json');
     },
 
     requestStatus: function(info) {
         $.getJSON(xgds_plot.getStatusUrl(info),
                   function(info) {
                       return function(result) {
-                          info.status = result;
-                          xgds_plot.dataTimeRange.min = Math.min(xgds_plot.dataTimeRange.min,
-                                                                 info.status.minTime);
-                          xgds_plot.dataTimeRange.max = Math.max(xgds_plot.dataTimeRange.max,
-                                                                 info.status.maxTime);
-                          xgds_plot.checkIfStatusComplete();
+                          xgds_plot.handleStatus(info, result);
                       };
                   }(info));
     },
 
-    loadSegmentData: function(segment) {
+    handleStatus: function(info, status) {
+        info.status = status;
+        if (status.minTime != null) {
+            xgds_plot.dataTimeRange.min = Math.min(xgds_plot.dataTimeRange.min,
+                                                   status.minTime);
+            xgds_plot.dataTimeRange.max = Math.max(xgds_plot.dataTimeRange.max,
+                                                   status.maxTime);
+        }
+        xgds_plot.checkIfStatusComplete();
+    },
+
+    requestSegmentsBatch: function(plots) {
+        /* request the status and initial segment data of all @plots
+         * with one request */
+        var valueCodes = [];
+        $.each(plots, function(i, info) {
+            valueCodes.push(info.meta.valueCode);
+        });
+        var params = {s: valueCodes.join(',')};
+        if (xgds_plot.liveMode) {
+            var interval = xgds_plot.getLiveTimeInterval();
+            params.start = xgds_plot.utcFromDisplayTime(interval.min);
+            params.end = xgds_plot.utcFromDisplayTime(interval.max);
+        }
+        $.getJSON(settings.SCRIPT_NAME + 'xgds_plot/rest/segments/',
+                  params,
+                  xgds_plot.handleSegmentsBatch)
+        .error(function(evt) {
+            // fall back to loading the status of each plot separately
+            $.each(plots, function(i, info) {
+                xgds_plot.requestStatus(info);
+            });
+        });
+    },
+
+    handleSegmentsBatch: function(result) {
+        $.each(result.series, function(valueCode, seriesResult) {
+            var info = xgds_plot.plotNameLookup[valueCode];
+            if (result.level != null) {
+                var segmentLength = Math.pow(2, result.level);
+                var segments = [];
+                for (var i = Math.round(result.start / segmentLength);
+                     i < Math.round(result.end / segmentLength); i++) {
+                    segments.push({info: info,
+                                   level: result.level,
+                                   index: i});
+                }
+                xgds_plot.handleSegmentRangeData(segments,
+                                                 {level: result.level,
+                                                  fields: seriesResult.fields,
+                                                  data: seriesResult.data});
+            }
+            xgds_plot.handleStatus(info, seriesResult.status || {});
+        });
+    },
+
+    segmentNeedsUpdate: function(segment) {
         var cached = xgds_plot.getSegmentDataCache(segment);
         if (cached == undefined) {
+            return true;
+        }
+        var now = new Date().valueOf();
+        return settings.XGDS_PLOT_CHECK_FOR_NEW_DATA && now - cached.timestamp > 5000;
+    },
+
+    loadSegmentData: function(segment) {
+        if (xgds_plot.segmentNeedsUpdate(segment)) {
             xgds_plot.requestSegmentData(segment);
-        } else {
-            var now = new Date().valueOf();
-            if (settings.XGDS_PLOT_CHECK_FOR_NEW_DATA && now - cached.timestamp > 5000) {
-                xgds_plot.requestSegmentData(segment);
+        }
+    },
+
+    loadSegmentRange: function(info, segments) {
+        /* load all the segments that need updating with one request to
+         * the segments view */
+        var needed = $.grep(segments, xgds_plot.segmentNeedsUpdate);
+        if (needed.length == 0) {
+            return;
+        }
+        var level = needed[0].level;
+        var indexMin = needed[0].index;
+        var indexMax = needed[needed.length - 1].index + 1;
+        var rangeSegments = [];
+        for (var i = indexMin; i < indexMax; i++) {
+            var segment = {info: info,
+                           level: level,
+                           index: i};
+            rangeSegments.push(segment);
+
+            // mark the segment as requested so the next poll doesn't
+            // request it again
+            var cached = xgds_plot.getSegmentDataCache(segment);
+            if (cached == undefined) {
+                cached = {};
             }
+            cached.timestamp = new Date().valueOf();
+            xgds_plot.setSegmentDataCache(segment, cached);
         }
+
+        var segmentLength = Math.pow(2, level);
+        var params = {start: indexMin * segmentLength,
+                      end: indexMax * segmentLength,
+                      level: level,
+                      v: xgds_plot.getSegmentVersion(info)};
+        $.getJSON(xgds_plot.getSegmentRangeUrl(info),
+                  params,
+                  function(result) {
+                      xgds_plot.handleSegmentRangeData(rangeSegments, result);
+                  })
+        .error(function(evt) {
+            $.each(rangeSegments, function(i, segment) {
+                xgds_plot.handleSegmentDataError(segment, evt);
+            });
+        });
+    },
+
+    getSegmentRangeUrl: function(info) {
+        return (settings.SCRIPT_NAME + 'xgds_plot/rest/segments/' +
+                info.meta.valueCode);
+    },
+
+    handleSegmentRangeData: function(segments, result) {
+        // split the buckets back into segments. each bucket's timestamp
+        // falls within its segment.
+        var segmentLength = Math.pow(2, result.level);
+        var timestampIndex = $.inArray('timestamp', result.fields);
+        var rowsByIndex = {};
+        $.each(result.data, function(i, row) {
+            var index = Math.floor(row[timestampIndex] / segmentLength);
+            if (rowsByIndex[index] == undefined) {
+                rowsByIndex[index] = [];
+            }
+            rowsByIndex[index].push(row);
+        });
+        $.each(segments, function(i, segment) {
+            xgds_plot.handleSegmentData(segment,
+                                        {fields: result.fields,
+                                         data: rowsByIndex[segment.index] || []});
+        });
     },
 
     getSegmentKey: function(segment) {
@@ -468,32 +605,85 @@ $.extend(xgds_plot, {
     },
 
     requestSegmentData: function(segment) {
+        if ($.inArray('bin', settings.XGDS_PLOT_SEGMENT_FORMATS) != -1) {
+            xgds_plot.requestBinarySegmentData(segment);
+            return;
+        }
         $.getJSON(xgds_plot.getSegmentUrl(segment),
                   function(segment) {
                       return function(result) {
-                          result.timestamp = new Date().valueOf();
-                          xgds_plot.setSegmentDataCache(segment, result);
-                          xgds_plot.haveNewData = true;
+                          xgds_plot.handleSegmentData(segment, result);
                       };
                   }(segment))
         .error(function(segment) {
             return function(evt) {
-                if (evt.status == 200) {
-                    console.log('unknown error in handling segment data at url' +
-                                ' ' + xgds_plot.getSegmentUrl(segment));
-                    console.log('check segment file for json parse errors?');
-                }
-
-                var updatedSegmentData = xgds_plot.getSegmentDataCache(segment);
-                if (updatedSegmentData == undefined) {
-                    updatedSegmentData = {};
-                }
-                updatedSegmentData.timestamp = new Date().valueOf();
-                xgds_plot.setSegmentDataCache(segment, updatedSegmentData);
+                xgds_plot.handleSegmentDataError(segment, evt);
             };
         }(segment));
     },
 
+    requestBinarySegmentData: function(segment) {
+        var xhr = new XMLHttpRequest();
+        xhr.open('GET', xgds_plot.getSegmentUrl(segment, 'bin'), true);
+        xhr.responseType = 'arraybuffer';
+        xhr.onload = function() {
+            if (xhr.status == 200) {
+                xgds_plot.handleSegmentData(segment,
+                                            xgds_plot.parseBinarySegment(xhr.response));
+            } else {
+                xgds_plot.handleSegmentDataError(segment, xhr);
+            }
+        };
+        xhr.onerror = function() {
+            xgds_plot.handleSegmentDataError(segment, xhr);
+        };
+        xhr.send();
+    },
+
+    parseBinarySegment: function(buffer) {
+        /* see segmentFile.py for a description of the format. assumes a
+         * little-endian client, which is true of all common browsers. */
+        var header = new DataView(buffer, 0, 16);
+        var numFields = header.getUint16(6, true);
+        var numRows = header.getUint32(8, true);
+        var dataOffset = header.getUint32(12, true);
+        var names = String.fromCharCode.apply(null, new Uint8Array(buffer, 16, dataOffset - 16));
+        var fields = names.replace(/\0+$/, '').split(',');
+        var columns = new Float64Array(buffer, dataOffset, numFields * numRows);
+        var data = [];
+        for (var i = 0; i < numRows; i++) {
+            var row = [];
+            for (var j = 0; j < numFields; j++) {
+                var val = columns[j * numRows + i];
+                row.push(isNaN(val) ? null : val);
+            }
+            data.push(row);
+        }
+        return {fields: fields,
+                data: data};
+    },
+
+    handleSegmentData: function(segment, result) {
+        result.timestamp = new Date().valueOf();
+        xgds_plot.setSegmentDataCache(segment, result);
+        xgds_plot.haveNewData = true;
+    },
+
+    handleSegmentDataError: function(segment, evt) {
+        if (evt.status == 200) {
+            console.log('unknown error in handling segment data at url' +
+                        ' ' + xgds_plot.getSegmentUrl(segment));
+            console.log('check segment file for json parse errors?');
+        }
+
+        var updatedSegmentData = xgds_plot.getSegmentDataCache(segment);
+        if (updatedSegmentData == undefined) {
+            updatedSegmentData = {};
+        }
+        updatedSegmentData.timestamp = new Date().valueOf();
+        xgds_plot.setSegmentDataCache(segment, updatedSegmentData);
+    },
+
     getIntervalForPlot: function(info) {
         var xopts = info.plot.getAxes().xaxis.options;
         return {min: xopts.min,
@@ -510,9 +700,13 @@ $.extend(xgds_plot, {
                 return true; // continue to next iteration
             }
             var segments = xgds_plot.getSegmentsCoveringInterval(info, interval);
-            $.each(segments, function(j, segment) {
-                xgds_plot.loadSegmentData(segment);
-            });
+            if (settings.XGDS_PLOT_MERGE_SEGMENT_REQUESTS) {
+                xgds_plot.loadSegmentRange(info, segments);
+            } else {
+                $.each(segments, function(j, segment) {
+                    xgds_plot.loadSegmentData(segment);
+                });
+            }
         });
     },
 
@@ -578,11 +772,16 @@ $.extend(xgds_plot, {
         }
 
         // request status of each time series
-        $.each(xgds_plot.plots, function(i, info) {
-            if (info.show) {
-                xgds_plot.requestStatus(info);
-            }
+        var shownPlots = $.grep(xgds_plot.plots, function(info) {
+            return info.show;
         });
+        if (settings.XGDS_PLOT_MERGE_SEGMENT_REQUESTS) {
+            xgds_plot.requestSegmentsBatch(shownPlots);
+        } else {
+            $.each(shownPlots, function(i, info) {
+                xgds_plot.requestStatus(info);
+            });
+        }
     },
 
     checkIfStatusComplete: function() {
@@ -37,7 +37,7 @@ from geocamUtil.loader import getClassByName
 
 from django.conf import settings
 from xgds_plot import pylabUtil
-from xgds_plot.meta import TIME_SERIES_LOOKUP
+from xgds_plot.meta import getTimeSeriesLookup
 
 
 # shift time zone from UTC to desired time zone
@@ -54,6 +54,14 @@ def epochMsToMatPlotLib(epochMs):
             + TIME_OFFSET_DAYS)
 
 
+def getPlotValues(valueManager, columns):
+    """
+    Return the values in @columns with one row per record, as plt.plot()
+    expects. Value managers put the records on the last axis instead.
+    """
+    return valueManager.getValuesFromColumns(columns).T
+
+
 def writePlotData(out,
                   seriesId,
                   widthPix=None,
@@ -69,18 +77,17 @@ def writePlotData(out,
     yinch = float(heightPix) / 100
     fig = plt.figure()
 
-    meta = TIME_SERIES_LOOKUP[seriesId]
+    meta = getTimeSeriesLookup()[seriesId]
     queryClass = getClassByName(meta['queryType'])
     queryManager = queryClass(meta)
     valueClass = getClassByName(meta['valueType'])
     valueManager = valueClass(meta, queryManager)
 
-    recs = queryManager.getData(minTime=minTime,
-                                maxTime=maxTime)
-    timestamps = [epochMsToMatPlotLib(queryManager.getTimestamp(rec))
-                  for rec in recs]
-    vals = [valueManager.getValue(rec)
-            for rec in recs]
+    posixTimesMs, columns = queryManager.getColumns(valueManager.getValueFields(),
+                                                    minTime=minTime,
+                                                    maxTime=maxTime)
+    timestamps = [epochMsToMatPlotLib(t) for t in posixTimesMs]
+    vals = getPlotValues(valueManager, columns)
 
     plt.plot(timestamps, vals)
 
@@ -98,7 +105,8 @@ def writePlotData(out,
     ax.axis([xmin, xmax, ymin, ymax])
 
     pylabUtil.setXAxisDate()
-    plt.title(queryManager.getValueName(meta['valueField']))
+    # the value manager fills in valueName for scalar time series
+    plt.title(meta.get('valueName', meta['valueCode']))
 
     logging.info('writePlotData: writing image')
     plt.setp(fig, figwidth=xinch, figheight=yinch)
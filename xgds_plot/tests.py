@@ -15,13 +15,49 @@
 #__END_LICENSE__
 
 import collections
+import cPickle as pickle
+import datetime
+import os
+import shutil
+import tempfile
+import threading
 
-from django.test import TransactionTestCase
+import numpy
+import matplotlib.cm
 
-from xgds_plot.tile import getTileBounds, getTileContainingPoint, getTileContainingBounds
+from geocamUtil import anyjson as json
+
+from django.test import TransactionTestCase, RequestFactory, override_settings
+from django.http import HttpResponse
+from django.core.urlresolvers import reverse
+
+from xgds_plot.segment import ScalarSegment, RatioSegment
+from xgds_plot.segmentStore import SegmentArrayStore
+from xgds_plot.segmentWriter import SegmentWriter
+from xgds_plot.segmentLog import SegmentLog
+from xgds_plot.mbtiles import MbTiles
+from xgds_plot.tile import getTileBounds, getTileContainingPoint, getTileContainingBounds, RatioTile
+from xgds_plot.tile import getPixelOfLonLat, getParentTile, getChildTiles
+from xgds_plot.value import Scalar, Ratio
+from xgds_plot.query import TimeSeriesQueryManager, Django
+from xgds_plot.models import TimeSeries
+from xgds_plot.segmentIndex import SegmentIndex, SegmentIndexGroup, batchIndexShard
+from xgds_plot.tileIndex import TileIndex, getColorLut
+from xgds_plot import segmentFile, segmentIndex, segmentStore, tileIndex, views, staticPlot
 from django.conf import settings
 
 
+class TempDirTestCase(TransactionTestCase):
+    """
+    Gives each test a fresh temporary directory, self.dirName.
+    """
+    def setUp(self):
+        self.dirName = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirName)
+
+
 class TileTest(TransactionTestCase):
     def assertNearlyEqual(self, a, b, msg=None, delta=settings.XGDS_PLOT_MAP_TILE_EPS):
         if isinstance(a, collections.Iterable):
@@ -54,3 +90,797 @@ class TileTest(TransactionTestCase):
                          (3, 1, 1))
         self.assertEqual(getTileContainingBounds([-134, -44, -89, -1]),
                          (1, 0, 0))
+
+    def test_getSmoothedIncremental(self):
+        tile = RatioTile(('20120101', 20, 0, 0), 1.0, 3)
+        tile.addSample((1.0, 2.0), 0, 0)
+        tile.getSmoothed()
+        for i, j in ((100, 100), (101, 120), (255, 3)):
+            tile.addSample((3.0, 4.0), i, j)
+        result, alpha = tile.getSmoothed()
+
+        fresh = pickle.loads(pickle.dumps(tile, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(fresh.blurred, None)
+        freshResult, freshAlpha = fresh.getSmoothed()
+        self.assertEqual(result.dtype, numpy.float32)
+        self.assertTrue(numpy.allclose(result, freshResult, rtol=0, atol=1e-6))
+        self.assertTrue(numpy.allclose(alpha, freshAlpha, rtol=0, atol=1e-6))
+
+    def test_addChild(self):
+        level = 20
+        lon, lat = -155.4671, 19.7601
+        x, y, i, j = getPixelOfLonLat(level, lon, lat)
+        child = RatioTile(('20120101', level, x, y), 1.0, 3)
+        child.addSample((1.0, 2.0), i, j)
+
+        parentParams = getParentTile(child.tileParams)
+        self.assertTrue(child.tileParams in getChildTiles(parentParams))
+        parent = RatioTile(parentParams, 1.0, 3)
+        parent.addChild(child)
+
+        px, py, pi, pj = getPixelOfLonLat(level - 1, lon, lat)
+        self.assertEqual((px, py), parentParams[2:])
+        self.assertEqual(parent.weightSum[pi, pj], 1)
+        self.assertEqual(parent.weightSum.sum(), 1)
+        self.assertEqual(parent.denomSum[pi, pj], 2.0)
+
+
+class TileStoreParent(object):
+    """
+    Stands in for the map indexer that owns the tile store.
+    """
+    def __init__(self):
+        self.store = {}
+
+
+class TileIndexTest(TempDirTestCase):
+    META = {'queryType': 'xgds_plot.tests.ArrayQueryManager',
+            'valueType': 'xgds_plot.value.Scalar',
+            'valueField': 'v',
+            'valueName': 'V',
+            'valueCode': 'v',
+            'map': {'colorRange': [-1.0, 1.0],
+                    'smoothingMeters': 0.1,
+                    'opaqueWeight': 1}}
+
+    def setUp(self):
+        super(TileIndexTest, self).setUp()
+        self.dataPath = tileIndex.DATA_PATH
+        tileIndex.DATA_PATH = self.dirName
+        self.index = TileIndex(dict(self.META), TileStoreParent())
+        self.finestLevel = settings.XGDS_PLOT_MAP_ZOOM_RANGE[1] - 1
+
+    def tearDown(self):
+        tileIndex.DATA_PATH = self.dataPath
+        super(TileIndexTest, self).tearDown()
+
+    def test_renderTile(self):
+        n = settings.XGDS_PLOT_MAP_PIXELS_PER_TILE
+        signal = numpy.linspace(-1.5, 1.5, n * n).reshape((n, n))
+        alpha = numpy.random.RandomState(0).rand(n, n)
+        self.index.renderTile(signal, alpha)
+
+        # same colors as the colormap, up to a difference of one table
+        # entry where float rounding puts a pixel in the next bin
+        expected = matplotlib.cm.jet(numpy.clip((signal.T + 1.0) / 2.0, 0, 1), bytes=True)
+        lut = getColorLut(matplotlib.cm.jet).astype(int)
+        maxStep = abs(numpy.diff(lut, axis=0)).max()
+        colorError = abs(self.index.rgba[:, :, :3].astype(int) - expected[:, :, :3])
+        self.assertTrue(colorError.max() <= maxStep)
+        self.assertTrue(abs(self.index.rgba[:, :, 3] - alpha.T * 255).max() <= 0.5 + 1e-9)
+
+    def test_getPaletteImage(self):
+        n = settings.XGDS_PLOT_MAP_PIXELS_PER_TILE
+        signal = numpy.linspace(-1.0, 1.0, n * n).reshape((n, n))
+        alpha = numpy.random.RandomState(0).rand(n, n)
+        alpha[:, :n // 4] = 0
+        alpha[:, -n // 4:] = 1
+        self.index.renderTile(signal, alpha)
+        self.index.getPaletteImage()
+        approx = self.index.palette[self.index.paletteIndex].astype(int)
+        rgba = self.index.rgba.astype(int)
+
+        transparent = rgba[:, :, 3] == 0
+        opaque = rgba[:, :, 3] == 255
+        edge = ~transparent & ~opaque
+        self.assertTrue((approx[transparent, 3] == 0).all())
+        self.assertTrue((approx[opaque, 3] == 255).all())
+        self.assertTrue(abs(approx[edge, 3] - rgba[edge, 3]).max()
+                        <= 256 // tileIndex.NUM_EDGE_ALPHAS // 2)
+
+        # colors are off by at most half a palette bin
+        lut = self.index.colorLut.astype(int)
+        maxStep = abs(numpy.diff(lut, axis=0)).max()
+        self.assertTrue(abs(approx[opaque, :3] - rgba[opaque, :3]).max() <= maxStep)
+        edgeBinSize = -(-len(lut) // tileIndex.NUM_EDGE_COLORS)
+        self.assertTrue(abs(approx[edge, :3] - rgba[edge, :3]).max() <= maxStep * edgeBinSize)
+
+    def checkWriteOutputTile(self, tileExists):
+        tileParams = ('20120101', self.finestLevel, 5, 6)
+        tileKey = self.index.getTileKey(self.index.valueCode, tileParams)
+        store = self.index.parent.store
+
+        # no image for a tile that renders fully transparent
+        store[tileKey] = self.index.makeTile(tileParams)
+        self.index.writeOutputTile(tileParams)
+        self.assertFalse(tileExists())
+
+        store[tileKey].addSample(0.5, 100, 100)
+        self.index.writeOutputTile(tileParams)
+        self.assertTrue(tileExists())
+
+        # an image written before is deleted
+        store[tileKey] = self.index.makeTile(tileParams)
+        self.index.writeOutputTile(tileParams)
+        self.assertFalse(tileExists())
+
+    def test_writeOutputTile(self):
+        outPath = os.path.join(self.index.outputDir, '20120101', str(self.finestLevel),
+                               '5', '6.png')
+        with self.settings(XGDS_PLOT_MAP_MBTILES=False):
+            self.checkWriteOutputTile(lambda: os.path.exists(outPath))
+
+    def test_writeOutputTileMbTiles(self):
+        with self.settings(XGDS_PLOT_MAP_MBTILES=True):
+            tileDb = self.index.getTileDb('20120101')
+            self.checkWriteOutputTile(lambda: tileDb.hasTile(self.finestLevel, 5, 6))
+            tileDb.close()
+
+    def test_finestTiles(self):
+        tiles = set([('20120101', self.finestLevel, 5, 6),
+                     ('20120101', self.finestLevel, 5, 7),
+                     ('20120102', self.finestLevel, 5, 6)])
+        for tileParams in tiles:
+            self.index.addFinestTile(tileParams)
+        self.assertEqual(self.index.getFinestTiles(), tiles)
+
+
+class SegmentTest(TransactionTestCase):
+    def assertSegmentsEqual(self, a, b):
+        self.assertEqual(a.getJsonObj()['fields'], b.getJsonObj()['fields'])
+        for rowA, rowB in zip(a.getJsonObj()['data'], b.getJsonObj()['data']):
+            for valA, valB in zip(rowA, rowB):
+                if valA is None or valB is None:
+                    self.assertEqual(valA, valB)
+                else:
+                    self.assertAlmostEqual(valA, valB, places=6)
+
+    def test_addSamples(self):
+        buckets = [3, 3, 7, 0, 3]
+        times = [1000.0, 1001.0, 1002.0, 1003.0, 1004.0]
+        vals = [2.0, -1.0, 5.0, 0.5, 4.0]
+
+        expected = ScalarSegment()
+        for b, t, v in zip(buckets, times, vals):
+            expected.addSample(b, t, v)
+        actual = ScalarSegment()
+        actual.addSamples(numpy.array(buckets), numpy.array(times), numpy.array(vals))
+        self.assertSegmentsEqual(expected, actual)
+
+    def test_addSamplesRatio(self):
+        buckets = [1, 1, 2]
+        times = [1000.0, 1001.0, 1002.0]
+        nums = [2.0, 3.0, 1.0]
+        denoms = [4.0, 0.0, 2.0]
+
+        expected = RatioSegment()
+        for b, t, num, denom in zip(buckets, times, nums, denoms):
+            expected.addSample(b, t, (num, denom))
+        actual = RatioSegment()
+        actual.addSamples(buckets, times, (nums, denoms))
+        self.assertSegmentsEqual(expected, actual)
+
+    def test_addSamplesEmpty(self):
+        for seg, vals in ((ScalarSegment(), []), (RatioSegment(), ([], []))):
+            seg.addSamples(numpy.zeros(0, dtype='l'), numpy.zeros(0), vals)
+            self.assertEqual(seg.getJsonObj()['data'], [])
+            self.assertEqual(seg.minTime, numpy.inf)
+
+    def test_addChild(self):
+        n = settings.XGDS_PLOT_SEGMENT_RESOLUTION
+        rng = numpy.random.RandomState(0)
+        expected = ScalarSegment()
+        actual = ScalarSegment()
+        for half in (0, 1):
+            buckets = rng.randint(0, n, 100)
+            times = rng.uniform(0, 1000, 100)
+            vals = rng.randn(100)
+            child = ScalarSegment()
+            child.addSamples(buckets, times, vals)
+            actual.addChild(child, half)
+            expected.addSamples(half * n // 2 + buckets // 2, times, vals)
+        self.assertSegmentsEqual(expected, actual)
+
+    def test_varianceLargeOffset(self):
+        vals = 1.5e+12 + numpy.array([1.0, 2.0, 3.0, 4.0])
+        seg = ScalarSegment()
+        seg.addSamples(numpy.zeros(4, dtype='l'), vals, vals)
+        self.assertAlmostEqual(seg.getVariance(0), 1.25, places=6)
+
+    def test_merge(self):
+        n = settings.XGDS_PLOT_SEGMENT_RESOLUTION
+        rng = numpy.random.RandomState(1)
+        buckets = rng.randint(0, n, 200)
+        times = rng.uniform(0, 1000, 200)
+        vals = 1e+6 + rng.randn(200)
+
+        expected = ScalarSegment()
+        expected.addSamples(buckets, times, vals)
+        actual = ScalarSegment()
+        actual.addSamples(buckets[:80], times[:80], vals[:80])
+        other = ScalarSegment()
+        other.addSamples(buckets[80:], times[80:], vals[80:])
+        actual.merge(other)
+        self.assertSegmentsEqual(expected, actual)
+
+    def test_varianceRatioZeroDenom(self):
+        seg = RatioSegment()
+        seg.addSamples([0, 0, 0], [1000.0, 1001.0, 1002.0], ([1.0, 3.0, 5.0], [1.0, 1.0, 0.0]))
+        self.assertEqual(seg.count[0], 3)
+        self.assertAlmostEqual(seg.getVariance(0), 1.0, places=6)
+
+    def test_sparse(self):
+        n = settings.XGDS_PLOT_SEGMENT_RESOLUTION
+        rng = numpy.random.RandomState(2)
+        dense = ScalarSegment()
+        dense.setBuckets(None)
+        sparse = ScalarSegment()
+        for numBuckets in (5, 20, n):
+            buckets = rng.randint(0, numBuckets, 2 * n)
+            times = rng.uniform(0, 1000, 2 * n)
+            vals = rng.randn(2 * n)
+            dense.addSamples(buckets, times, vals)
+            sparse.addSamples(buckets, times, vals)
+            self.assertSegmentsEqual(dense, sparse)
+            self.assertSegmentsEqual(dense, pickle.loads(pickle.dumps(dense, 2)))
+        # the segment switches to dense as it fills up
+        self.assertTrue(sparse.buckets is None)
+
+        child = ScalarSegment()
+        child.addSamples([3, 4, 400], [1.0, 2.0, 3.0], [1.0, 2.0, 3.0])
+        dense.addChild(child, 1)
+        sparse = ScalarSegment()
+        sparse.merge(dense)
+        self.assertSegmentsEqual(dense, sparse)
+
+
+class SegmentArrayStoreTest(TempDirTestCase):
+    def setUp(self):
+        super(SegmentArrayStoreTest, self).setUp()
+        # copy one record at a time when a level file grows at the front
+        self.copyChunkBytes = segmentStore.COPY_CHUNK_BYTES
+        segmentStore.COPY_CHUNK_BYTES = 1
+
+    def tearDown(self):
+        segmentStore.COPY_CHUNK_BYTES = self.copyChunkBytes
+        super(SegmentArrayStoreTest, self).tearDown()
+
+    def test_getSet(self):
+        store = SegmentArrayStore(self.dirName, RatioSegment)
+        segments = {}
+        # out of order segment numbers force the level file to grow at
+        # both ends
+        for t in (1000, 1001, 1200, 900, 5):
+            seg = RatioSegment()
+            seg.addSamples([t % 512], [float(t)], ([1.0], [2.0]))
+            store['17_%d' % t] = seg
+            segments[t] = seg
+        self.assertRaises(KeyError, lambda: store['17_1002'])
+        self.assertRaises(KeyError, lambda: store['18_1000'])
+        store.sync()
+
+        store = SegmentArrayStore(self.dirName, RatioSegment)
+        for t, seg in segments.iteritems():
+            self.assertEqual(store['17_%d' % t].getJsonObj(), seg.getJsonObj())
+        del store['17_900']
+        self.assertFalse('17_900' in store)
+
+
+class SegmentWriterTest(TransactionTestCase):
+    def test_coalesce(self):
+        written = []
+        release = threading.Event()
+
+        def writeFunc(key, data):
+            release.wait()
+            written.append((key, data))
+            return []
+
+        writer = SegmentWriter(writeFunc, numThreads=1)
+        writer.start()
+        # the writer thread is stuck on the first job, so the later jobs
+        # for 'b' replace each other while queued
+        writer.submit('a', 1)
+        for data in (1, 2, 3):
+            writer.submit('b', data)
+        release.set()
+        writer.sync()
+        writer.stop()
+        self.assertEqual(written, [('a', 1), ('b', 3)])
+        self.assertEqual(writer.getStats()['coalesced'], 2)
+
+
+class SegmentLogTest(TempDirTestCase):
+    def test_appendRead(self):
+        path = os.path.join(self.dirName, 'log.dat')
+        log = SegmentLog(path)
+        log.append(numpy.array([1.0, 2.0]), numpy.array([10.0, 20.0]))
+        log.append(numpy.array([3.0]), numpy.array([[4.0], [5.0]]))
+        log.append(numpy.array([6.0]), numpy.array([60.0]))
+        log.close()
+
+        # cut the last record short, as if the writer was killed
+        open(path, 'r+b').truncate(os.path.getsize(path) - 1)
+        batches = list(SegmentLog(path).read())
+        self.assertEqual(len(batches), 2)
+        self.assertEqual(batches[0][1].tolist(), [10.0, 20.0])
+        self.assertEqual(batches[1][1].tolist(), [[4.0], [5.0]])
+
+        log = SegmentLog(path)
+        log.truncate()
+        self.assertEqual(list(log.read()), [])
+
+
+class SegmentFileTest(TempDirTestCase):
+    def setUp(self):
+        super(SegmentFileTest, self).setUp()
+        self.levelDir = os.path.join(self.dirName, '17')
+        os.mkdir(self.levelDir)
+
+    def assertColumnsEqual(self, a, b):
+        self.assertEqual(a.shape, b.shape)
+        self.assertTrue(((a == b) | (numpy.isnan(a) & numpy.isnan(b))).all())
+
+    def test_binaryRoundTrip(self):
+        # buckets with one sample have undefined variance
+        seg = ScalarSegment()
+        seg.addSamples(numpy.array([0, 0, 5]), numpy.array([1.0, 2.0, 800.0]),
+                       numpy.array([1.0, 3.0, 4.0]))
+        fields, columns = seg.getColumns()
+        self.assertTrue(numpy.isnan(columns).any())
+        segmentFile.writeBinarySegment(os.path.join(self.levelDir, '0.bin'), fields, columns)
+        segmentFile.writeSegmentData(os.path.join(self.levelDir, '0.json'),
+                                     json.dumps(seg.getJsonObj()))
+
+        # JSON stores undefined values as null
+        for fmt in ('bin', 'json'):
+            readFields, readColumns = segmentFile.readSegment(self.dirName, 17, 0, (fmt,))
+            self.assertEqual(list(readFields), list(fields))
+            self.assertColumnsEqual(numpy.asarray(readColumns), columns)
+
+        # a segment with no rows
+        path = os.path.join(self.levelDir, '1.bin')
+        segmentFile.writeBinarySegment(path, fields, numpy.zeros((len(fields), 0)))
+        self.assertEqual(segmentFile.readBinarySegment(path)[1].shape, (len(fields), 0))
+
+    def test_getEncodedPath(self):
+        path = os.path.join(self.levelDir, '0.json')
+        segmentFile.writeSegmentData(path, '[]', ['gzip'])
+        self.assertEqual(segmentFile.getEncodedPath(path, set(['gzip', 'deflate'])),
+                         (path + '.gz', 'gzip'))
+        self.assertEqual(segmentFile.getEncodedPath(path, set(['deflate'])),
+                         (path, None))
+
+        # a copy older than its segment file is stale
+        mtime = os.path.getmtime(path)
+        os.utime(path + '.gz', (mtime - 10, mtime - 10))
+        self.assertEqual(segmentFile.getEncodedPath(path, set(['gzip'])),
+                         (path, None))
+
+
+class MbTilesTest(TempDirTestCase):
+    def test_putGet(self):
+        path = os.path.join(self.dirName, 'layer', '20120101.mbtiles')
+        tileDb = MbTiles(path, batchSize=2)
+        tileDb.putTile(20, 1, 2, 'png1')
+        reader = MbTiles(path, readOnly=True)
+        self.assertEqual(reader.getTile(20, 1, 2), None)  # not committed yet
+
+        tileDb.putTile(20, 1, 2, 'png2')
+        self.assertEqual(reader.getTile(20, 1, 2), 'png2')
+
+        tileDb.deleteTile(20, 1, 2)
+        tileDb.close()
+        self.assertFalse(reader.hasTile(20, 1, 2))
+        reader.close()
+
+
+class SegmentCacheTest(TempDirTestCase):
+    def test_isSegmentRangeClosed(self):
+        # data past the end of a segment doesn't close it until the
+        # indexer has written it and advanced closedTime
+        status = {'maxTime': 5000, 'closedTime': None}
+        self.assertFalse(views.isSegmentRangeClosed(10, 2, status))
+        status['closedTime'] = 2048
+        self.assertTrue(views.isSegmentRangeClosed(10, 2, status))
+        self.assertFalse(views.isSegmentRangeClosed(10, 3, status))
+        self.assertFalse(views.isSegmentRangeClosed(10, 2, {'maxTime': 5000}))
+        self.assertFalse(views.isSegmentRangeClosed(10, 2, None))
+
+    def test_cacheHeaders(self):
+        response = views.setSegmentCacheHeaders(HttpResponse(), 'abc', True)
+        self.assertEqual(response['ETag'], '"abc"')
+        self.assertIn('immutable', response['Cache-Control'])
+
+        response = views.setSegmentCacheHeaders(HttpResponse(), 'abc', False)
+        self.assertNotIn('immutable', response['Cache-Control'])
+        self.assertIn('max-age=%d' % settings.XGDS_PLOT_OPEN_SEGMENT_MAX_AGE_SECONDS,
+                      response['Cache-Control'])
+
+    def test_fileEtag(self):
+        path = os.path.join(self.dirName, '0.json')
+        with open(path, 'w') as f:
+            f.write('[]')
+        etag = views.getFileEtag(path)
+        request = RequestFactory().get('/', HTTP_IF_NONE_MATCH='"%s"' % etag)
+        self.assertTrue(views.etagMatches(request, etag))
+        request = RequestFactory().get('/', HTTP_IF_NONE_MATCH='"x", W/"%s"' % etag)
+        self.assertTrue(views.etagMatches(request, etag))
+
+        # rewriting the segment invalidates the old ETag
+        with open(path, 'w') as f:
+            f.write('[[0]]')
+        self.assertFalse(views.etagMatches(request, views.getFileEtag(path)))
+
+
+class StaticPlotTest(TransactionTestCase):
+    def test_getPlotValues(self):
+        columns = [numpy.array([1.0, 2.0, 3.0]),
+                   numpy.array([4.0, 5.0, 6.0])]
+        scalar = Scalar({'valueField': 'a', 'valueName': 'A'}, None)
+        vals = staticPlot.getPlotValues(scalar, columns[:1])
+        self.assertEqual(vals.tolist(), [1, 2, 3])
+
+        # one (numerator, denominator) row per record
+        ratio = Ratio({'valueFields': ['a', 'b']}, None)
+        vals = staticPlot.getPlotValues(ratio, columns)
+        self.assertEqual(vals.tolist(), [[1, 4], [2, 5], [3, 6]])
+
+
+class DjangoQueryTest(TransactionTestCase):
+    def test_pagination(self):
+        # runs of four records share a timestamp, and pks decrease with
+        # time, so pages end inside runs and the pk tie-break matters
+        startTime = datetime.datetime(2012, 1, 1)
+        for i in reversed(xrange(23)):
+            TimeSeries.objects.create(name='ts%d' % i,
+                                      startTime=startTime + datetime.timedelta(seconds=i // 4),
+                                      stripChartMin=float(i))
+        query = Django({'queryModel': 'xgds_plot.TimeSeries',
+                        'queryTimestampField': 'startTime'})
+        expectedPks = sorted(TimeSeries.objects.values_list('pk', flat=True))
+        for pageSize in (1, 3, 4, 5, 100):
+            pks = [rec.pk for page in query.iterData(pageSize=pageSize) for rec in page]
+            self.assertEqual(sorted(pks), expectedPks)
+
+            pages = list(query.iterColumns(['stripChartMin'], pageSize=pageSize))
+            posixTimesMs = numpy.concatenate([page[0] for page in pages])
+            vals = numpy.concatenate([page[1][0] for page in pages])
+            self.assertEqual(sorted(vals.tolist()), [float(i) for i in xrange(23)])
+            self.assertTrue((numpy.diff(posixTimesMs) >= 0).all())
+
+
+Record = collections.namedtuple('Record', ['timestamp', 'v'])
+
+
+class ArrayQueryManager(TimeSeriesQueryManager):
+    """
+    Serves the samples in COLUMNS, so the index can be tested without a
+    database table.
+    """
+    COLUMNS = {}
+
+    def __init__(self, meta):
+        pass
+
+    def getValueName(self, valueField):
+        return valueField
+
+    def iterColumns(self, fields, minTime=None, maxTime=None, pageSize=5000):
+        posixTimesMs = self.COLUMNS['timestamp']
+        keep = numpy.ones(len(posixTimesMs), dtype=bool)
+        if minTime is not None:
+            keep &= posixTimesMs > minTime
+        if maxTime is not None:
+            keep &= posixTimesMs <= maxTime
+        indices = numpy.flatnonzero(keep)
+        for start in xrange(0, len(indices), pageSize):
+            page = indices[start:start + pageSize]
+            yield posixTimesMs[page], [self.COLUMNS[field][page] for field in fields]
+
+    def getRecords(self):
+        return [Record(t, v) for t, v in zip(self.COLUMNS['timestamp'], self.COLUMNS['v'])]
+
+    def getTimestamp(self, obj):
+        return obj.timestamp
+
+    def getMinTime(self):
+        return self.COLUMNS['timestamp'][0]
+
+    def getMaxTime(self):
+        return self.COLUMNS['timestamp'][-1]
+
+
+class SegmentIndexTest(TempDirTestCase):
+    META = {'queryType': 'xgds_plot.tests.ArrayQueryManager',
+            'valueType': 'xgds_plot.value.Scalar',
+            'valueField': 'v',
+            'valueName': 'V',
+            'valueCode': 'v'}
+
+    def setUp(self):
+        super(SegmentIndexTest, self).setUp()
+        self.dataPath = segmentIndex.DATA_PATH
+        segmentIndex.DATA_PATH = self.dirName
+
+        rand = numpy.random.RandomState(0)
+        vals = rand.randn(5000)
+        vals[::50] = numpy.nan  # records with no value
+        ArrayQueryManager.COLUMNS = {
+            'timestamp': 1.5e+12 + numpy.cumsum(rand.exponential(700.0, 5000)),
+            'v': vals,
+            'w': rand.rand(5000)
+        }
+
+    def tearDown(self):
+        segmentIndex.DATA_PATH = self.dataPath
+        super(SegmentIndexTest, self).tearDown()
+
+    def runIndex(self, clearFromTime=None, meta=META):
+        if clearFromTime is not None:
+            index = SegmentIndex(dict(meta), None, batchIndexAtStart=False)
+            index.start()
+            index.clearFrom(clearFromTime)
+            index.stop()
+        index = SegmentIndex(dict(meta), None)
+        index.start()
+        index.stop()
+        return index
+
+    def test_clearFrom(self):
+        full = self.runIndex()
+        self.assertEqual(full.status['numSamples'], 4900)
+        fullStatus = dict(full.status)
+        fullSegments = sorted(full.getManifest(segmentIndex.MIN_SEGMENT_LEVEL))
+
+        # reindexing the second half gives the same result as indexing
+        # everything
+        reindexed = self.runIndex(ArrayQueryManager.COLUMNS['timestamp'][2500])
+        for field in ('minTime', 'maxTime', 'numSamples', 'numSegments'):
+            self.assertEqual(reindexed.status[field], fullStatus[field])
+        self.assertEqual(sorted(reindexed.getManifest(segmentIndex.MIN_SEGMENT_LEVEL)),
+                         fullSegments)
+        self.assertNotEqual(reindexed.status['buildId'], fullStatus['buildId'])
+
+    def readSegments(self, index):
+        result = {}
+        for level in segmentIndex.SEGMENT_LEVELS:
+            for t in index.getManifest(level):
+                result[(level, t)] = segmentFile.readSegment(index.segmentDir, level, t,
+                                                             settings.XGDS_PLOT_SEGMENT_FORMATS)[1]
+        return result
+
+    def test_mergeShard(self):
+        full = self.runIndex()
+        fullSegments = self.readSegments(full)
+
+        segmentIndex.DATA_PATH = os.path.join(self.dirName, 'sharded')
+        index = SegmentIndex(dict(self.META), None, batchIndexAtStart=False)
+        index.readStatus()
+        results = [batchIndexShard(dict(self.META), shardIndex, minTime, maxTime)
+                   for shardIndex, (minTime, maxTime) in enumerate(index.getShardIntervals(3))]
+        self.assertEqual(len(results), 3)
+        index.start()
+        # shards may be merged in any order
+        for result in reversed(results):
+            index.mergeShard(result)
+        index.finishShardMerge()
+        index.stop()
+
+        for field in ('minTime', 'maxTime', 'numSamples', 'numSegments'):
+            self.assertEqual(index.status[field], full.status[field])
+        self.assertFalse(os.path.exists(os.path.join(index.cacheDir, 'shards')))
+        segments = self.readSegments(index)
+        self.assertEqual(sorted(segments), sorted(fullSegments))
+        for key, columns in segments.iteritems():
+            self.assertTrue(numpy.allclose(columns, fullSegments[key], equal_nan=True))
+
+    def test_indexGroup(self):
+        ratioMeta = {'queryType': 'xgds_plot.tests.ArrayQueryManager',
+                     'valueType': 'xgds_plot.value.Ratio',
+                     'valueFields': ['w', 'v'],
+                     'valueCode': 'r'}
+        separate = [self.runIndex(meta=meta) for meta in (self.META, ratioMeta)]
+
+        # one query pass fanned out to both indexes
+        segmentIndex.DATA_PATH = os.path.join(self.dirName, 'group')
+        group = SegmentIndexGroup([dict(self.META), dict(ratioMeta)], None)
+        group.start()
+        group.stop()
+
+        for index, single in zip(group.indexes, separate):
+            self.assertFalse(index.queueMode)
+            for field in ('minTime', 'maxTime', 'numSamples', 'numSegments'):
+                self.assertEqual(index.status[field], single.status[field])
+            segments = self.readSegments(index)
+            singleSegments = self.readSegments(single)
+            self.assertEqual(sorted(segments), sorted(singleSegments))
+            for key, columns in segments.iteritems():
+                self.assertTrue(numpy.allclose(columns, singleSegments[key], equal_nan=True))
+
+    def test_recover(self):
+        full = self.runIndex()
+        fullSegments = self.readSegments(full)
+
+        segmentIndex.DATA_PATH = os.path.join(self.dirName, 'crash')
+        columns = ArrayQueryManager.COLUMNS
+        index = SegmentIndex(dict(self.META), None, batchIndexAtStart=False)
+        index.start()
+
+        def indexRange(index, start, end):
+            index.indexColumns(columns['timestamp'][start:end], [columns['v'][start:end]])
+
+        indexRange(index, 0, 1000)
+        index.checkpoint()
+        indexRange(index, 1000, 2000)
+
+        # only some of the segments changed since the checkpoint reach
+        # the cache, including some created since then
+        partialStore = segmentStore.makeSegmentStore(index.cacheDir, index.valueManager.makeSegment)
+        segmentIndices, _ = index.getSegmentAndBucketIndices(columns['timestamp'][1000:2000])
+        for levelIndex, level in enumerate(segmentIndex.SEGMENT_LEVELS):
+            for t in numpy.unique(segmentIndices[levelIndex])[::2]:
+                key = index.getKeyFromSegmentIndex((level, t))
+                partialStore[key] = index.store[key]
+        partialStore.sync()
+
+        # crash without syncing the rest
+        indexRange(index, 2000, 3000)
+        index.segmentWriter.stop()
+        index.log.close()
+
+        restarted = SegmentIndex(dict(self.META), None, batchIndexAtStart=False)
+        restarted.start()
+        indexRange(restarted, 3000, 5000)
+        restarted.stop()
+
+        for field in ('minTime', 'maxTime', 'numSamples', 'numSegments'):
+            self.assertEqual(restarted.status[field], full.status[field])
+        segments = self.readSegments(restarted)
+        self.assertEqual(sorted(segments), sorted(fullSegments))
+        for key, segmentColumns in segments.iteritems():
+            # includes the bucket counts
+            self.assertTrue(numpy.allclose(segmentColumns, fullSegments[key], equal_nan=True))
+
+    def test_flushManifests(self):
+        index = SegmentIndex(dict(self.META), None)
+        index.start()
+        # a live record an hour after the rest starts a new segment
+        rec = Record(ArrayQueryManager.COLUMNS['timestamp'][-1] + 3600e+3, 1.0)
+        index.handleRecord(rec)
+        index.flushLiveQueue()
+        index.delayBox.sync()
+        index.segmentWriter.sync()
+
+        # the periodic flush lists it in the manifest with no further data
+        index.lastManifestWriteTime = 0
+        index.flushManifests()
+        level = segmentIndex.MIN_SEGMENT_LEVEL
+        manifest = segmentFile.readManifest(index.segmentDir, level)[0]
+        self.assertIn(int(rec.timestamp // 2 ** level), manifest)
+        index.stop()
+
+    def test_liveIndex(self):
+        full = self.runIndex()
+        fullSegments = self.readSegments(full)
+
+        # index the first half in batch mode and the rest as live records,
+        # first flushed one at a time, then in batches
+        segmentIndex.DATA_PATH = os.path.join(self.dirName, 'live')
+        index = SegmentIndex(dict(self.META), None)
+        index.start(batchIndex=False)
+        index.batchIndex(maxTime=ArrayQueryManager.COLUMNS['timestamp'][2499])
+        for i, rec in enumerate(index.queryManager.getRecords()[2500:]):
+            index.handleRecord(rec)
+            if i < 100 or i % 300 == 0:
+                index.flushLiveQueue()
+        index.stop()
+
+        for field in ('minTime', 'maxTime', 'numSamples', 'numSegments'):
+            self.assertEqual(index.status[field], full.status[field])
+        segments = self.readSegments(index)
+        self.assertEqual(sorted(segments), sorted(fullSegments))
+        for key, columns in segments.iteritems():
+            self.assertTrue(numpy.allclose(columns, fullSegments[key], equal_nan=True))
+
+
+@override_settings(XGDS_PLOT_TIME_SERIES={'type': 'Group',
+                                          'members': [dict(SegmentIndexTest.META, type='TimeSeries')]})
+class SegmentViewTest(TempDirTestCase):
+    def setUp(self):
+        super(SegmentViewTest, self).setUp()
+        self.dataPath = segmentIndex.DATA_PATH
+        self.plotDataDir = views.PLOT_DATA_DIR
+        segmentIndex.DATA_PATH = self.dirName
+        views.PLOT_DATA_DIR = os.path.join(self.dirName, 'plot')
+
+        ArrayQueryManager.COLUMNS = {
+            'timestamp': 1.5e+12 + 1000.0 * numpy.arange(1000),
+            'v': numpy.sin(numpy.arange(1000) * 0.01)
+        }
+        index = SegmentIndex(dict(SegmentIndexTest.META), None)
+        index.start()
+        index.stop()
+        self.status = index.status
+
+        # the first segment ends before closedTime, the last one doesn't
+        self.level = segmentIndex.MIN_SEGMENT_LEVEL
+        segmentLength = 2.0 ** self.level
+        self.firstSegment = int(self.status['minTime'] // segmentLength)
+        self.lastSegment = int(self.status['maxTime'] // segmentLength)
+        self.assertEqual(self.status['closedTime'], self.status['maxTime'])
+        self.assertTrue((self.firstSegment + 1) * segmentLength <= self.status['closedTime'])
+
+    def tearDown(self):
+        segmentIndex.DATA_PATH = self.dataPath
+        views.PLOT_DATA_DIR = self.plotDataDir
+        super(SegmentViewTest, self).tearDown()
+
+    def assertCacheHeaders(self, response, closed):
+        cacheControl = response['Cache-Control']
+        if closed:
+            self.assertIn('immutable', cacheControl)
+        else:
+            self.assertNotIn('immutable', cacheControl)
+            self.assertIn('max-age=%d' % settings.XGDS_PLOT_OPEN_SEGMENT_MAX_AGE_SECONDS,
+                          cacheControl)
+
+    def assertRevalidates(self, url, closed, params=None):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        self.assertCacheHeaders(response, closed)
+        response = self.client.get(url, params, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertCacheHeaders(response, closed)
+
+    def test_getSegmentFile(self):
+        for t, closed in ((self.firstSegment, True), (self.lastSegment, False)):
+            url = reverse('xgds_plot_segmentFile',
+                          kwargs={'valueCode': 'v', 'level': self.level, 'index': t, 'extension': 'json'})
+            self.assertRevalidates(url, closed)
+
+    def test_getSegments(self):
+        url = reverse('xgds_plot_segments', kwargs={'valueCode': 'v'})
+        segmentLength = 2.0 ** self.level
+        for t, closed in ((self.firstSegment, True), (self.lastSegment, False)):
+            params = {'start': t * segmentLength,
+                      'end': (t + 1) * segmentLength,
+                      'level': self.level}
+            self.assertRevalidates(url, closed, params)
+
+    def test_getSegmentStatus(self):
+        url = reverse('xgds_plot_segmentStatus', kwargs={'valueCode': 'v'})
+        response = self.client.get(url)
+        self.assertEqual(json.loads(response.content)['maxTime'], self.status['maxTime'])
+        self.assertIn('no-cache', response['Cache-Control'])
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_getSegmentsBatch(self):
+        url = reverse('xgds_plot_segmentsBatch')
+        response = self.client.get(url, {'s': 'v', 'level': self.level})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('no-cache', response['Cache-Control'])
+        result = json.loads(''.join(response.streaming_content))
+        self.assertEqual(result['series']['v']['status']['maxTime'], self.status['maxTime'])
+        self.assertEqual(len(result['series']['v']['data']), 1000)
+
+        # too many segments is an error before anything is streamed
+        maxSegments = views.MAX_SEGMENTS_PER_REQUEST
+        views.MAX_SEGMENTS_PER_REQUEST = 1
+        try:
+            response = self.client.get(url, {'s': 'v', 'level': self.level})
+        finally:
+            views.MAX_SEGMENTS_PER_REQUEST = maxSegments
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get(url, {'s': 'v,x'}).status_code, 404)
@@ -33,6 +33,11 @@ DATA_PATH = os.path.join(settings.DATA_ROOT,
 
 N = settings.XGDS_PLOT_MAP_PIXELS_PER_TILE
 
+# dtype of the blurred and smoothed caches. they only feed 8-bit
+# rendering, so single precision halves their memory: 256 KB per array
+# at 256 pixels per tile, 1-1.25 MB per cached tile.
+CACHE_DTYPE = numpy.float32
+
 
 def dosys(cmd):
     ret = os.system(cmd)
@@ -96,6 +101,18 @@ def getTilesOverlappingBounds(dayCode, bounds, levels=None):
                 yield dayCode, level, x, y
 
 
+def getParentTile(tileParams):
+    dayCode, level, x, y = tileParams
+    return dayCode, level - 1, x // 2, y // 2
+
+
+def getChildTiles(tileParams):
+    dayCode, level, x, y = tileParams
+    for childX in (2 * x, 2 * x + 1):
+        for childY in (2 * y, 2 * y + 1):
+            yield dayCode, level + 1, childX, childY
+
+
 def getLatLonBox(bounds):
     return ("""
 <LatLonBox>
@@ -125,13 +142,30 @@ def getMetersPerPixel(level):
 
 
 class ScalarTile(object):
-    @classmethod
-    def spread(cls, M, sigma):
-        return (2 * math.pi * sigma ** 2
-                * filters.gaussian_filter(M, sigma))
+    # accumulator arrays that are blurred to make the smoothed tile
+    SUM_FIELDS = ('numSum', 'weightSum')
+
+    # cached results of getSmoothed(), not pickled
+    CACHE_FIELDS = ('blurred', 'smoothed', 'dirty')
 
     def __init__(self, tileParams, smoothingMeters, opaqueWeight):
         self.tileParams = tileParams
+        self.setSmoothing(smoothingMeters, opaqueWeight)
+
+        self.numSum = numpy.zeros((N, N))
+        self.weightSum = numpy.zeros((N, N))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for field in self.CACHE_FIELDS:
+            state.pop(field, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.clearCache()
+
+    def setSmoothing(self, smoothingMeters, opaqueWeight):
         self.smoothingMeters = smoothingMeters
         self.opaqueWeight = opaqueWeight
 
@@ -140,29 +174,120 @@ class ScalarTile(object):
         _dayCode, level, _x, _y = self.tileParams
         self.sigmaPixels = max(0.5, self.smoothingMeters / getMetersPerPixel(level))
 
-        self.numSum = numpy.zeros((N, N))
-        self.weightSum = numpy.zeros((N, N))
+        self.clearCache()
+
+    def clearCache(self):
+        self.blurred = None
+        self.smoothed = None
+        self.dirty = None
+
+    def markDirty(self, i, j):
+        """
+        Grow the dirty bounding box to include pixel (@i, @j).
+        """
+        if self.dirty is None:
+            self.dirty = (i, i + 1, j, j + 1)
+        else:
+            i0, i1, j0, j1 = self.dirty
+            self.dirty = (min(i0, i), max(i1, i + 1), min(j0, j), max(j1, j + 1))
 
     def addSample(self, val, i, j):
         self.numSum[i, j] += val
         self.weightSum[i, j] += 1
-
-    def getSmoothed(self):
-        sumBlurred = filters.gaussian_filter(self.numSum, self.sigmaPixels)
-        weightSumBlurred = filters.gaussian_filter(self.weightSum, self.sigmaPixels)
-
-        alpha = self.spread(self.weightSum / self.opaqueWeight,
-                            self.sigmaPixels)
+        self.markDirty(i, j)
+
+    def addChild(self, child):
+        """
+        Add the sums of @child, a tile one level down, into the quadrant
+        of this tile that it covers. Each 2x2 block of child pixels maps
+        to one pixel of this tile.
+        """
+        _dayCode, _level, x, y = child.tileParams
+        half = N // 2
+        # i runs east and j runs south, so the child to the north (odd
+        # y) fills the top half
+        i0 = half * (x % 2)
+        j0 = half * (1 - y % 2)
+        for field in self.SUM_FIELDS:
+            blockSums = getattr(child, field).reshape((half, 2, half, 2)).sum(axis=3).sum(axis=1)
+            getattr(self, field)[i0:i0 + half, j0:j0 + half] += blockSums
+        self.markDirty(i0, j0)
+        self.markDirty(i0 + half - 1, j0 + half - 1)
+
+    def getKernelRadius(self):
+        # matches gaussian_filter() with its default truncate=4.0
+        return int(4.0 * self.sigmaPixels + 0.5)
+
+    def updateBlurred(self):
+        """
+        Bring the blurred copies of the SUM_FIELDS arrays up to date and
+        return the window of pixels that changed, or None. Only the dirty
+        box plus a kernel radius is recomputed. Its values depend on
+        input pixels up to a kernel radius further out, so the blur runs
+        over that larger window and just the inner part is kept.
+        """
+        if self.blurred is None:
+            self.blurred = dict([(field, filters.gaussian_filter(getattr(self, field),
+                                                                 self.sigmaPixels,
+                                                                 output=CACHE_DTYPE))
+                                 for field in self.SUM_FIELDS])
+            self.dirty = None
+            return (slice(0, N), slice(0, N))
+
+        if self.dirty is None:
+            return None
+
+        r = self.getKernelRadius()
+        i0, i1, j0, j1 = self.dirty
+        oi0, oi1, oj0, oj1 = max(0, i0 - r), min(N, i1 + r), max(0, j0 - r), min(N, j1 + r)
+        ii0, ii1, ij0, ij1 = max(0, oi0 - r), min(N, oi1 + r), max(0, oj0 - r), min(N, oj1 + r)
+        window = (slice(oi0, oi1), slice(oj0, oj1))
+        inner = (slice(oi0 - ii0, oi1 - ii0), slice(oj0 - ij0, oj1 - ij0))
+        for field in self.SUM_FIELDS:
+            blurred = filters.gaussian_filter(getattr(self, field)[ii0:ii1, ij0:ij1],
+                                              self.sigmaPixels)
+            self.blurred[field][window] = blurred[inner]
+        self.dirty = None
+        return window
+
+    def getAlpha(self, weightSumBlurred):
+        # same as spread(weightSum / opaqueWeight), reusing the blurred weights
+        alpha = (2 * math.pi * self.sigmaPixels ** 2 / self.opaqueWeight) * weightSumBlurred
         alpha[alpha < 0.1] = 0
         alpha[alpha > 1.0] = 1
+        return alpha
+
+    def smooth(self, blurred):
+        """
+        Return (result, alpha) for the pixels in the @blurred arrays.
+        """
+        alpha = self.getAlpha(blurred['weightSum'])
 
-        result = sumBlurred / (weightSumBlurred + 1e-3)
+        result = blurred['numSum'] / (blurred['weightSum'] + 1e-3)
         result[alpha < 0.1] = 0
 
         return result, alpha
 
+    def getSmoothed(self):
+        """
+        Return (result, alpha) arrays for the tile. They are cached
+        between calls and must not be modified.
+        """
+        window = self.updateBlurred()
+        if window is not None:
+            result, alpha = self.smooth(dict([(field, blurred[window])
+                                              for field, blurred in self.blurred.iteritems()]))
+            if self.smoothed is None:
+                self.smoothed = (result, alpha)
+            else:
+                self.smoothed[0][window] = result
+                self.smoothed[1][window] = alpha
+        return self.smoothed
+
 
 class RatioTile(ScalarTile):
+    SUM_FIELDS = ('numSum', 'denomSum', 'weightSum')
+
     def __init__(self, tileParams, smoothingMeters, opaqueWeight):
         super(RatioTile, self).__init__(tileParams, smoothingMeters, opaqueWeight)
 
@@ -173,19 +298,15 @@ class RatioTile(ScalarTile):
         self.numSum[i, j] += num
         self.denomSum[i, j] += denom
         self.weightSum[i, j] += 1
+        self.markDirty(i, j)
 
-    def getSmoothed(self):
-        numSumBlurred = filters.gaussian_filter(self.numSum, self.sigmaPixels)
-
-        alpha = self.spread(self.weightSum / self.opaqueWeight,
-                            self.sigmaPixels)
-        alpha[alpha < 0.1] = 0
-        alpha[alpha > 1.0] = 1
+    def smooth(self, blurred):
+        alpha = self.getAlpha(blurred['weightSum'])
 
-        denomSumBlurred = filters.gaussian_filter(self.denomSum, self.sigmaPixels)
+        denomSumBlurred = blurred['denomSum'].copy()
         denomSumBlurred[alpha < 0.1] = 1  # avoid divide by zero
 
-        result = numSumBlurred / (denomSumBlurred + 1e-20)
+        result = blurred['numSum'] / (denomSumBlurred + 1e-20)
         result[alpha < 0.1] = 0
 
         return result, alpha
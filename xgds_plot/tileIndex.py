@@ -15,6 +15,7 @@
 #__END_LICENSE__
 
 import os
+from cStringIO import StringIO
 from collections import deque
 import time
 import pytz
@@ -22,7 +23,6 @@ import datetime
 
 from django import db
 import numpy
-from scipy.misc import pilutil
 import matplotlib
 matplotlib.use('Agg')  # non-interactive png plotting backend
 from matplotlib import pyplot, mpl
@@ -33,7 +33,7 @@ from geocamUtil.loader import getClassByName
 from geocamUtil import TimeUtil
 
 from django.conf import settings
-from xgds_plot import tile, plotUtil
+from xgds_plot import tile, plotUtil, mbtiles
 
 # pylint: disable=E1101
 
@@ -52,26 +52,73 @@ else:
     OPS_TIME_ZONE = pytz.timezone(settings.XGDS_PLOT_OPS_TIME_ZONE)
 
 
+def getColorLut(cmap):
+    """
+    Return the RGBA colors of @cmap as a (cmap.N, 4) uint8 array.
+    """
+    return cmap(numpy.arange(cmap.N), bytes=True)
+
+
+# layout of the 256-entry palette for paletted tile images
+NUM_OPAQUE_COLORS = 128
+NUM_EDGE_COLORS = 15
+NUM_EDGE_ALPHAS = 8
+
+
+def getPalette(colorLut):
+    """
+    Return (palette, paletteLut) for approximating tiles colored with
+    @colorLut in 256 colors. palette is a (256, 4) uint8 RGBA array.
+    paletteLut maps lutIndex * 256 + alpha to a palette entry.
+
+    Entry 0 is transparent. Fully opaque pixels, usually most of the
+    visible ones, get NUM_OPAQUE_COLORS colors. Partly transparent
+    pixels at the edges of the data get NUM_EDGE_COLORS colors times
+    NUM_EDGE_ALPHAS alpha levels.
+    """
+    lutSize = len(colorLut)
+    palette = numpy.zeros((256, 4), dtype='uint8')
+    paletteLut = numpy.zeros((lutSize, 256), dtype='uint8')
+    colorIndex = numpy.arange(lutSize)
+
+    opaqueStart = 256 - NUM_OPAQUE_COLORS
+    opaqueBins = colorIndex * NUM_OPAQUE_COLORS // lutSize
+    paletteLut[:, 255] = opaqueStart + opaqueBins
+    binCenters = (numpy.arange(NUM_OPAQUE_COLORS) + 0.5) * lutSize / NUM_OPAQUE_COLORS
+    palette[opaqueStart:, :3] = colorLut[binCenters.astype(int), :3]
+    palette[opaqueStart:, 3] = 255
+
+    edgeBins = colorIndex * NUM_EDGE_COLORS // lutSize
+    alpha = numpy.arange(1, 255)
+    alphaBins = alpha * NUM_EDGE_ALPHAS // 256
+    paletteLut[:, 1:255] = 1 + edgeBins[:, numpy.newaxis] * NUM_EDGE_ALPHAS + alphaBins
+    binCenters = (numpy.arange(NUM_EDGE_COLORS) + 0.5) * lutSize / NUM_EDGE_COLORS
+    alphaCenters = (numpy.arange(NUM_EDGE_ALPHAS) + 0.5) * 256 / NUM_EDGE_ALPHAS
+    for i, center in enumerate(binCenters.astype(int)):
+        start = 1 + i * NUM_EDGE_ALPHAS
+        palette[start:start + NUM_EDGE_ALPHAS, :3] = colorLut[center, :3]
+        palette[start:start + NUM_EDGE_ALPHAS, 3] = alphaCenters
+
+    return palette, paletteLut.ravel()
+
+
 class TileIndex(object):
     @classmethod
     def getTileKey(cls, valueCode, tileTuple):
         dayCode, level, x, y = tileTuple
         return '%s_%s_%s_%s_%s' % (valueCode, dayCode, level, x, y)
 
-    @classmethod
-    def scaleAndClip(cls, M, crange):
-        cmin, cmax = crange
-        M = (M - cmin) / (cmax - cmin)
-        M = numpy.maximum(0.0, M)
-        M = numpy.minimum(1.0, M)
-        return M
-
     def __init__(self, meta, parent, batchIndexAtStart=True):
         self.meta = meta
         self.parent = parent
         self.queueMode = batchIndexAtStart
 
+        # rendering buffers, reused for every tile
+        self.scaled = numpy.zeros((N, N))
+        self.lutIndex = numpy.zeros((N, N), dtype='uint8')
         self.rgba = numpy.zeros((N, N, 4), dtype='uint8')
+        self.paletteKey = numpy.zeros((N, N), dtype='uint16')
+        self.paletteIndex = numpy.zeros((N, N), dtype='uint8')
 
         queryClass = getClassByName(self.meta['queryType'])
         self.queryManager = queryClass(self.meta)
@@ -85,12 +132,17 @@ class TileIndex(object):
                                       self.valueCode)
 
         self.colorRange = self.meta['map']['colorRange']
+        self.colorLut = getColorLut(matplotlib.cm.jet)  # pylint: disable=E1101
+        self.palette, self.paletteLut = getPalette(self.colorLut)
         colorBarPath = os.path.join(DATA_PATH,
                                     self.valueCode,
                                     'colorbar.png')
         self.writeColorBar(colorBarPath)
 
         self.queue = deque()
+        self.bottomUp = settings.XGDS_PLOT_MAP_BOTTOM_UP_PYRAMID
+        self.pyramidTiles = set()
+        self.tileDbs = {}  # dayCode -> MbTiles, if XGDS_PLOT_MAP_MBTILES is set
         self.running = False
         self.status = None
         self.statusPath = None
@@ -124,8 +176,31 @@ class TileIndex(object):
     def stop(self):
         if self.running:
             self.statusStore.write(self.status)
+            for tileDb in self.tileDbs.itervalues():
+                tileDb.close()
+            self.tileDbs = {}
             self.running = False
 
+    def getTileDb(self, dayCode):
+        try:
+            return self.tileDbs[dayCode]
+        except KeyError:
+            tileDb = mbtiles.MbTiles(mbtiles.getPath(self.outputDir, dayCode),
+                                     batchSize=settings.XGDS_PLOT_MAP_MBTILES_BATCH_SIZE)
+            tileDb.setMetadata({
+                'name': '%s %s' % (self.meta['valueName'], dayCode),
+                'type': 'overlay',
+                'version': '1',
+                'description': 'xgds_plot raster map layer',
+                'format': 'png',
+            })
+            self.tileDbs[dayCode] = tileDb
+            return tileDb
+
+    def commitTiles(self):
+        for tileDb in self.tileDbs.itervalues():
+            tileDb.commit()
+
     def writeColorBar(self, path):
         if os.path.exists(path):
             return
@@ -186,12 +261,20 @@ class TileIndex(object):
         timestampUtc = datetime.datetime.utcfromtimestamp(1e-3 * posixTimeMs)
         timestampLocal = pytz.utc.localize(timestampUtc).astimezone(OPS_TIME_ZONE)
         dayCode = timestampLocal.strftime('%Y%m%d')
+        if self.queueMode and self.bottomUp:
+            _zoomMin, zoomMax = settings.XGDS_PLOT_MAP_ZOOM_RANGE
+            levels = [zoomMax - 1]
+        else:
+            levels = None
         for tileParams in tile.getTilesOverlappingBounds(dayCode,
                                                          (pos.longitude, pos.latitude,
-                                                          pos.longitude, pos.latitude)):
+                                                          pos.longitude, pos.latitude),
+                                                         levels):
             val = self.valueManager.getValue(obj)
             self.addSample(tileParams, pos, val)
             self.parent.delayBox.addJob((self.valueCode, tileParams))
+            if levels is not None:
+                self.pyramidTiles.add(tileParams)
 
     def addSample(self, tileParams, pos, val):
         _dayCode, level, _x, _y = tileParams
@@ -203,32 +286,196 @@ class TileIndex(object):
         try:
             tileData = self.parent.store[tileKey]
         except KeyError:
-            tileData = self.valueClass.makeTile(tileParams,
-                                                self.meta['map']['smoothingMeters'],
-                                                self.meta['map']['opaqueWeight'])
+            tileData = self.makeTile(tileParams)
             self.status['numTiles'] += 1
+            if level == settings.XGDS_PLOT_MAP_ZOOM_RANGE[1] - 1:
+                self.addFinestTile(tileParams)
         tileData.addSample(val, i, j)
         self.parent.store[tileKey] = tileData
 
-    def getImage(self, tileData):
-        signal, alpha = tileData.getSmoothed()
+    def getFinestTilesPath(self, dayCode):
+        return os.path.join(self.outputDir, 'finestTiles', '%s.txt' % dayCode)
 
-        signal = self.scaleAndClip(signal, self.colorRange)
+    def addFinestTile(self, tileParams):
+        # remember tiles at the finest level, since tiles that render
+        # fully transparent have no output image to find them by. each
+        # day has its own list, which is only ever appended to.
+        dayCode, _level, x, y = tileParams
+        path = self.getFinestTilesPath(dayCode)
+        outDir = os.path.dirname(path)
+        if not os.path.exists(outDir):
+            os.makedirs(outDir)
+        with open(path, 'a') as out:
+            out.write('%d %d\n' % (x, y))
+
+    def getFinestTiles(self):
+        """
+        Return the set of tiles recorded by addFinestTile().
+        """
+        _zoomMin, zoomMax = settings.XGDS_PLOT_MAP_ZOOM_RANGE
+        tiles = set()
+        tilesDir = os.path.join(self.outputDir, 'finestTiles')
+        if not os.path.isdir(tilesDir):
+            return tiles
+        for name in os.listdir(tilesDir):
+            dayCode = name[:-len('.txt')]
+            for line in open(os.path.join(tilesDir, name)):
+                # skip a line cut short by a crash
+                if line.endswith('\n'):
+                    x, y = line.split()
+                    tiles.add((dayCode, zoomMax - 1, int(x), int(y)))
+        return tiles
+
+    def makeTile(self, tileParams):
+        return self.valueClass.makeTile(tileParams,
+                                        self.meta['map']['smoothingMeters'],
+                                        self.meta['map']['opaqueWeight'])
+
+    def buildPyramid(self, tiles):
+        """
+        Rebuild the tiles at all zoom levels coarser than the finest
+        level that cover @tiles, a set of finest-level tiles. Each parent
+        tile is computed by summing its four children, so the raw data
+        is not needed.
+        """
+        zoomMin, zoomMax = settings.XGDS_PLOT_MAP_ZOOM_RANGE
+        childTiles = set(tiles)
+        for parentLevel in xrange(zoomMax - 2, zoomMin - 1, -1):
+            parentTiles = set([tile.getParentTile(t) for t in childTiles])
+            print ('--> building %d %s tiles at zoom level %d'
+                   % (len(parentTiles), self.valueCode, parentLevel))
+            for parentParams in sorted(parentTiles):
+                parentData = self.makeTile(parentParams)
+                numChildren = 0
+                for childParams in tile.getChildTiles(parentParams):
+                    try:
+                        childData = self.parent.store[self.getTileKey(self.valueCode, childParams)]
+                    except KeyError:
+                        continue
+                    parentData.addChild(childData)
+                    numChildren += 1
+                if numChildren == 0:
+                    continue
+
+                parentKey = self.getTileKey(self.valueCode, parentParams)
+                try:
+                    self.parent.store[parentKey]
+                except KeyError:
+                    self.status['numTiles'] += 1
+                self.parent.store[parentKey] = parentData
+                self.parent.delayBox.addJob((self.valueCode, parentParams))
+            childTiles = parentTiles
+
+    def rebuildPyramid(self):
+        """
+        Re-smooth the finest zoom level with the current smoothing
+        settings and rebuild all coarser levels from it. The finest
+        tiles are the ones recorded by addFinestTile() plus any with
+        output images, which covers tiles indexed before they were
+        recorded.
+        """
+        _zoomMin, zoomMax = settings.XGDS_PLOT_MAP_ZOOM_RANGE
+        level = zoomMax - 1
+        tiles = self.getFinestTiles()
+        for dayCode in sorted(os.listdir(self.outputDir)):
+            levelDir = os.path.join(self.outputDir, dayCode, str(level))
+            if not os.path.isdir(levelDir):
+                continue
+            for x in os.listdir(levelDir):
+                for name in os.listdir(os.path.join(levelDir, x)):
+                    if name.endswith('.png'):
+                        tiles.add((dayCode, level, int(x), int(name[:-len('.png')])))
+        tiles = sorted(tiles)
+
+        print '--> re-smoothing %d %s tiles at zoom level %d' % (len(tiles), self.valueCode, level)
+        for tileParams in tiles:
+            tileKey = self.getTileKey(self.valueCode, tileParams)
+            try:
+                tileData = self.parent.store[tileKey]
+            except KeyError:
+                continue
+            tileData.setSmoothing(self.meta['map']['smoothingMeters'],
+                                  self.meta['map']['opaqueWeight'])
+            self.parent.store[tileKey] = tileData
+            self.parent.delayBox.addJob((self.valueCode, tileParams))
+        self.buildPyramid(tiles)
+
+    def renderTile(self, signal, alpha):
+        """
+        Render into self.rgba by looking up colors in self.colorLut. The
+        table index of each pixel is left in self.lutIndex.
+        """
+        # quantize the same way the colormap would: scale the color range
+        # to [0, 1], multiply by the table size and truncate. the arrays
+        # are indexed [i, j] = [column, row], so reading them transposed
+        # puts the pixels in image order without copying the result.
+        cmin, cmax = self.colorRange
+        scaled = self.scaled
+        numpy.subtract(signal.T, cmin, out=scaled)
+        numpy.divide(scaled, cmax - cmin, out=scaled)
+        numpy.multiply(scaled, len(self.colorLut), out=scaled)
+        numpy.clip(scaled, 0, len(self.colorLut) - 1, out=scaled)
+        self.lutIndex[...] = scaled
+        numpy.take(self.colorLut, self.lutIndex, axis=0, out=self.rgba, mode='clip')
+
+        # alpha in [0, 1] rounded to [0, 255]
+        numpy.multiply(alpha.T, 255, out=scaled)
+        scaled += 0.5
+        self.rgba[:, :, 3] = scaled
+
+    def getPaletteImage(self):
+        """
+        Return the last rendered tile approximated as an 8-bit paletted
+        image with alpha per palette entry. See getPalette().
+        """
+        key = self.paletteKey
+        key[...] = self.lutIndex
+        key <<= 8
+        key |= self.rgba[:, :, 3]
+        numpy.take(self.paletteLut, key, out=self.paletteIndex)
+
+        im = Image.frombuffer('P', (N, N), self.paletteIndex,
+                              'raw', 'P', 0, 1)
+        im.putpalette(self.palette[:, :3].tostring())
+        im.info['transparency'] = self.palette[:, 3].tostring()
+        return im
 
-        rgba = self.rgba
-        rgba = matplotlib.cm.jet(signal, bytes=True)  # pylint: disable=E1101
-        rgba[:, :, 3] = pilutil.bytescale(alpha, cmin=0.0, cmax=1.0)
-        rgbaT = rgba.transpose((1, 0, 2)).copy()
-        return Image.frombuffer('RGBA', (N, N), rgbaT,
+    def getImage(self, tileData):
+        """
+        Render @tileData as a paletted image if
+        XGDS_PLOT_MAP_PALETTE_PNG is set, otherwise as RGBA. The image
+        shares its pixels with the rendering
+        buffers, so it is only valid until the next call.
+        """
+        self.renderTile(*tileData.getSmoothed())
+        if settings.XGDS_PLOT_MAP_PALETTE_PNG:
+            return self.getPaletteImage()
+        return Image.frombuffer('RGBA', (N, N), self.rgba,
                                 'raw', 'RGBA', 0, 1)
 
     def writeOutputTile(self, tileParams):
         tileKey = self.getTileKey(self.valueCode, tileParams)
         tileData = self.parent.store[tileKey]
-        im = self.getImage(tileData)
 
         dayCode, level, x, y = tileParams
         outPath = '%s/%s/%d/%d/%d.png' % (self.outputDir, dayCode, level, x, y)
+        _signal, alpha = tileData.getSmoothed()
+        if not alpha.any():
+            # don't write fully transparent tiles. the tile KML leaves
+            # out tiles with no image once their day is over.
+            if settings.XGDS_PLOT_MAP_MBTILES:
+                self.getTileDb(dayCode).deleteTile(level, x, y)
+            elif os.path.exists(outPath):
+                os.remove(outPath)
+            return
+
+        im = self.getImage(tileData)
+        if settings.XGDS_PLOT_MAP_MBTILES:
+            out = StringIO()
+            im.save(out, format='PNG')
+            self.getTileDb(dayCode).putTile(level, x, y, out.getvalue())
+            return
+
         outDir = os.path.dirname(outPath)
         if not os.path.exists(outDir):
             os.makedirs(outDir)
@@ -248,24 +495,33 @@ class TileIndex(object):
         # index everything in db that comes after the last thing we indexed on
         # the previous run
         print '--> batch indexing %s' % self.valueCode
-        while 1:
-            recs = self.queryManager.getData(minTime=self.status['maxTime'])
-            n = recs.count()
-            if n == 0:
-                break
-            print '--> %d %s samples remaining' % (n, self.valueCode)
-            for rec in recs[:BATCH_READ_NUM_SAMPLES]:
+        startTime = self.status['maxTime']
+        endTime = self.queryManager.getMaxTime() or time.time() * 1000
+        for recs in self.queryManager.iterData(minTime=self.status['maxTime'],
+                                               pageSize=BATCH_READ_NUM_SAMPLES):
+            if startTime is None:
+                startTime = self.queryManager.getTimestamp(recs[0])
+            for rec in recs:
                 self.indexRecord(rec)
 
             # avoid django debug log memory leak
             db.reset_queries()
 
+            if self.status['maxTime'] is not None:
+                print ('--> %s %s'
+                       % (self.valueCode,
+                          plotUtil.getProgressString(startTime, self.status['maxTime'], endTime)))
+
         # batch process new records that arrived while we were
         # processing the database table.
         print ('--> indexing %d %s samples that came in during batch indexing'
                % (len(self.queue), self.valueCode))
         self.flushQueue()
 
+        if self.pyramidTiles:
+            self.buildPyramid(self.pyramidTiles)
+            self.pyramidTiles = set()
+
         # switch modes to process each new record as it comes in.
         print '--> switching to live data mode'
         self.queueMode = False
@@ -14,6 +14,8 @@
 # specific language governing permissions and limitations under the License.
 #__END_LICENSE__
 
+import numpy
+
 from xgds_plot.segment import ScalarSegment, RatioSegment
 from xgds_plot.tile import ScalarTile, RatioTile
 
@@ -35,6 +37,27 @@ class Scalar(object):
     def getValue(self, rec):
         return getattr(rec, self.valueField)
 
+    def getValues(self, recs):
+        """
+        Return the values of @recs as an array whose last axis indexes
+        the records. Missing values are NaN.
+        """
+        return numpy.array([self.getValue(rec) for rec in recs], dtype='d')
+
+    def getValueFields(self):
+        """
+        Return the list of fields to request from the query manager's
+        getColumns().
+        """
+        return [self.valueField]
+
+    def getValuesFromColumns(self, columns):
+        """
+        Convert columns returned by getColumns() to the format returned
+        by getValues().
+        """
+        return columns[0]
+
 
 class Ratio(object):
     makeSegment = RatioSegment
@@ -47,3 +70,13 @@ class Ratio(object):
     def getValue(self, rec):
         return (getattr(rec, self.numField),
                 getattr(rec, self.denomField))
+
+    def getValues(self, recs):
+        vals = numpy.array([self.getValue(rec) for rec in recs], dtype='d')
+        return vals.reshape((-1, 2)).T
+
+    def getValueFields(self):
+        return [self.numField, self.denomField]
+
+    def getValuesFromColumns(self, columns):
+        return numpy.array(columns, dtype='d').reshape((2, -1))
@@ -15,6 +15,7 @@
 #__END_LICENSE__
 
 import os
+import math
 import time
 from cStringIO import StringIO
 import datetime
@@ -22,14 +23,20 @@ import calendar
 import tempfile
 import logging
 import re
+import hashlib
 import pytz
+import numpy
 
 from django.shortcuts import render
 from django.http import (HttpResponse,
+                         StreamingHttpResponse,
+                         HttpResponseNotModified,
                          HttpResponseNotFound,
                          HttpResponseBadRequest)
 from django.template import RequestContext
 from django.core.urlresolvers import reverse
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import parse_etags, quote_etag
 import django.db
 
 from geocamUtil import anyjson as json
@@ -38,6 +45,7 @@ from geocamUtil.loader import getClassByName
 
 from django.conf import settings
 from xgds_plot.plotUtil import parseTime
+from xgds_plot import segment, segmentFile, mbtiles
 try:
     from xgds_plot import meta, tile, profiles, staticPlot
 except ImportError:
@@ -47,6 +55,23 @@ MAP_DATA_PATH = os.path.join(settings.DATA_URL,
                              settings.XGDS_PLOT_DATA_SUBDIR,
                              'map')
 
+MAP_DATA_DIR = os.path.join(settings.DATA_DIR,
+                            settings.XGDS_PLOT_DATA_SUBDIR,
+                            'map')
+
+PLOT_DATA_DIR = os.path.join(settings.DATA_DIR,
+                             settings.XGDS_PLOT_DATA_SUBDIR,
+                             'plot')
+
+# upper limit on the number of segment files read for one request
+MAX_SEGMENTS_PER_REQUEST = 1024
+
+# closed segments never change, so caches may keep them indefinitely
+CLOSED_SEGMENT_MAX_AGE_SECONDS = 365 * 24 * 60 * 60
+
+SEGMENT_CONTENT_TYPES = {'json': 'application/json',
+                         'bin': 'application/octet-stream'}
+
 
 OPS_TIME_ZONE = pytz.timezone(settings.XGDS_PLOT_OPS_TIME_ZONE)
 
@@ -104,6 +129,8 @@ def plots(request):
                     'XGDS_ZMQ_WEB_SOCKET_URL',
                     'XGDS_PLOT_LIVE_PLOT_HISTORY_LENGTH_MS',
                     'XGDS_PLOT_SEGMENT_RESOLUTION',
+                    'XGDS_PLOT_SEGMENT_FORMATS',
+                    'XGDS_PLOT_MERGE_SEGMENT_REQUESTS',
                     'XGDS_PLOT_MIN_DISPLAY_RESOLUTION',
                     'XGDS_PLOT_MIN_DATA_INTERVAL_MS',
                     'XGDS_PLOT_MAX_SEGMENT_LENGTH_MS',
@@ -332,6 +359,53 @@ def writeMapIndexKmlForDayAndLayer(request, out, day, layerOpts):
 #     return HttpResponse(out.getvalue(), content_type='application/vnd.google-earth.kml+xml')
 
 
+def getMapTileData(layerId, dayCode, level, x, y, dataNeeded=True):
+    """
+    Return the PNG data of a map tile, or None if it has not been
+    written. If @dataNeeded is False, return True instead of the data.
+    """
+    layerDir = os.path.join(MAP_DATA_DIR, layerId)
+    if settings.XGDS_PLOT_MAP_MBTILES:
+        path = mbtiles.getPath(layerDir, dayCode)
+        if not os.path.exists(path):
+            return None
+        tileDb = mbtiles.MbTiles(path, readOnly=True)
+        try:
+            if not dataNeeded:
+                return tileDb.hasTile(level, x, y) or None
+            return tileDb.getTile(level, x, y)
+        finally:
+            tileDb.close()
+    else:
+        path = '%s/%s/%d/%d/%d.png' % (layerDir, dayCode, level, x, y)
+        if not os.path.exists(path):
+            return None
+        if not dataNeeded:
+            return True
+        return open(path, 'rb').read()
+
+
+def getMapTile(request, layerId, dayCode, level, x, y):
+    """
+    Serve one map tile image. Needed when tiles are stored in MBTiles
+    files; otherwise they are also available statically under DATA_URL.
+    """
+    if layerId not in meta.getTimeSeriesLookup():
+        return HttpResponseNotFound('<h1>404 No map layer named "%s"</h1>' % layerId)
+    data = getMapTileData(layerId, dayCode, int(level), int(x), int(y))
+    if data is None:
+        return HttpResponseNotFound('<h1>404 No tile %s/%s/%s for map layer "%s" on %s</h1>'
+                                    % (level, x, y, layerId, dayCode))
+
+    # clients refresh tiles every few seconds, so make that cheap
+    etag = hashlib.md5(data).hexdigest()
+    if etagMatches(request, etag):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(data, content_type='image/png')
+    return setSegmentCacheHeaders(response, etag, closed=False)
+
+
 def mapTileKml(request, layerId, dayCode, level, x, y):
     level = int(level)
     x = int(x)
@@ -371,11 +445,34 @@ def mapTileKml(request, layerId, dayCode, level, x, y):
         netLinks = ''
 
     #tileUrl = request.build_absolute_uri(reverse('mapTileImage', args=[level, x, y]))
-    tileUrl = request.build_absolute_uri('%s/%s/%s/%d/%d/%d.png'
-                                         % (MAP_DATA_PATH,
-                                            layerId,
-                                            dayCode,
-                                            level, x, y))
+    if settings.XGDS_PLOT_MAP_MBTILES:
+        tileUrl = (request.build_absolute_uri
+                   (reverse
+                    ('xgds_plot_mapTileImage',
+                     args=[layerId, dayCode, level, x, y])))
+    else:
+        tileUrl = request.build_absolute_uri('%s/%s/%s/%d/%d/%d.png'
+                                             % (MAP_DATA_PATH,
+                                                layerId,
+                                                dayCode,
+                                                level, x, y))
+    todayCode = utcToTz(datetime.datetime.utcnow()).strftime('%Y%m%d')
+    if (dayCode < todayCode
+            and getMapTileData(layerId, dayCode, level, x, y, dataNeeded=False) is None):
+        # the indexer doesn't write fully transparent tiles, and this
+        # day's tiles won't change any more, so leave out the overlay
+        # instead of polling for an image that doesn't exist
+        return KmlUtil.wrapKmlDjango("""
+<Folder>
+  %(netLinks)s
+  <Style>
+    <ListStyle>
+      <listItemType>checkHideChildren</listItemType>
+    </ListStyle>
+  </Style>
+</Folder>
+""" % dict(netLinks=netLinks))
+
     bounds = tile.getTileBounds(level, x, y)
     minZoom, maxZoom = settings.XGDS_PLOT_MAP_ZOOM_RANGE
     if level < maxZoom - 1:
@@ -534,3 +631,347 @@ def getStaticPlot(request, seriesId):
     django.db.reset_queries()  # clear query log to reduce memory usage
     return HttpResponse(imgData,
                         content_type='image/png')
+
+
+def getSegmentLevelForInterval(minTime, maxTime, numPoints):
+    """
+    Return the coarsest segment level that shows at least @numPoints
+    buckets in the interval. Matches getSegmentLevelForInterval() in
+    xgds_plot.js.
+    """
+    minSegmentsInPlot = float(numPoints) / settings.XGDS_PLOT_SEGMENT_RESOLUTION
+    maxSegmentLength = max((maxTime - minTime) / minSegmentsInPlot, 1)
+    level = int(math.floor(math.log(maxSegmentLength, 2)))
+    level = max(level, segment.MIN_SEGMENT_LEVEL)
+    level = min(level, segment.MAX_SEGMENT_LEVEL - 1)
+    return level
+
+
+def parseSegmentParams(request, requireInterval=True):
+    """
+    Parse the start, end, points and level parameters of the segment
+    views. Returns (minTime, maxTime, numPoints, level), where any of
+    the values not specified are None, or raises ValueError with a
+    message for the client.
+    """
+    try:
+        minTime = request.GET.get('start')
+        maxTime = request.GET.get('end')
+        if minTime is not None or maxTime is not None or requireInterval:
+            minTime = float(minTime)
+            maxTime = float(maxTime)
+        numPoints = int(request.GET.get('points', settings.XGDS_PLOT_MIN_DISPLAY_RESOLUTION))
+        level = request.GET.get('level')
+        if level is not None:
+            level = int(level)
+    except (TypeError, ValueError):
+        raise ValueError('HTTP GET parameters: start, end: posix times in ms; points, level: integers')
+    if minTime is not None and not minTime < maxTime:
+        raise ValueError('HTTP GET parameters: start, end: start time must be before end time')
+    if numPoints < 1:
+        raise ValueError('HTTP GET parameters: points: must be positive')
+    if level is not None and not segment.MIN_SEGMENT_LEVEL <= level < segment.MAX_SEGMENT_LEVEL:
+        raise ValueError('HTTP GET parameters: level: must be in range [%d, %d)'
+                         % (segment.MIN_SEGMENT_LEVEL, segment.MAX_SEGMENT_LEVEL))
+    return minTime, maxTime, numPoints, level
+
+
+def getSegmentIndexRange(level, minTime, maxTime):
+    """
+    Return the range [indexMin, indexMax) of segment indices at @level
+    that overlap [minTime, maxTime).
+    """
+    segmentLength = 2.0 ** level
+    indexMin = int(math.floor(minTime / segmentLength))
+    indexMax = int(math.ceil(maxTime / segmentLength))
+    return indexMin, indexMax
+
+
+def getSegmentRangeIndices(valueCode, level, minTime, maxTime):
+    """
+    Return the indices of the segments of @valueCode at @level that
+    overlap [minTime, maxTime), or raise ValueError if there are too
+    many to read for one request.
+    """
+    indexMin, indexMax = getSegmentIndexRange(level, minTime, maxTime)
+
+    # only visit segments that exist, if the index has a manifest
+    manifest = segmentFile.readManifest(os.path.join(PLOT_DATA_DIR, valueCode), level)
+    if manifest is None:
+        indices = xrange(indexMin, indexMax)
+    else:
+        indices = sorted([t for t in manifest[0]
+                          if indexMin <= t < indexMax])
+    if len(indices) > MAX_SEGMENTS_PER_REQUEST:
+        raise ValueError('interval covers more than %d segments at level %d'
+                         % (MAX_SEGMENTS_PER_REQUEST, level))
+    return indices
+
+
+def readSegmentRange(valueCode, level, minTime, maxTime, indices=None):
+    """
+    Return (fields, data) for the buckets of @valueCode at @level with
+    timestamps in [minTime, maxTime). data is a list of rows as in a
+    JSON segment. @indices defaults to the result of
+    getSegmentRangeIndices().
+    """
+    if indices is None:
+        indices = getSegmentRangeIndices(valueCode, level, minTime, maxTime)
+    valueDir = os.path.join(PLOT_DATA_DIR, valueCode)
+
+    # prefer the binary format, which loads without parsing
+    formats = sorted(settings.XGDS_PLOT_SEGMENT_FORMATS, key=lambda fmt: fmt != 'bin')
+    fields = []
+    parts = []
+    for index in indices:
+        segmentData = segmentFile.readSegment(valueDir, level, index, formats)
+        if segmentData is None:
+            continue
+        fields, columns = segmentData
+        timestamps = columns[fields.index('timestamp')]
+        parts.append(columns[:, (minTime <= timestamps) & (timestamps < maxTime)])
+
+    data = []
+    if parts:
+        for row in numpy.hstack(parts).T.tolist():
+            data.append([None if val != val else val
+                         for val in row])
+    return fields, data
+
+
+def readSegmentStatus(valueCode):
+    """
+    Return the contents of the status.json file for @valueCode, or None
+    if it has not been indexed yet.
+    """
+    statusPath = os.path.join(PLOT_DATA_DIR, valueCode, 'status.json')
+    if os.path.exists(statusPath):
+        return json.loads(open(statusPath, 'rb').read())
+    else:
+        return None
+
+
+def isSegmentRangeClosed(level, indexMax, status):
+    """
+    Return True if the segments before @indexMax at @level can no longer
+    change. The indexer advances status['closedTime'] only after the
+    segments before it have been written, so a segment doesn't count as
+    closed just because the index has data past its end.
+    """
+    return (status is not None
+            and status.get('closedTime') is not None
+            and indexMax * 2.0 ** level <= status['closedTime'])
+
+
+def getFileEtag(path):
+    stat = os.stat(path)
+    return '%x-%x' % (int(stat.st_mtime * 1e+6), stat.st_size)
+
+
+def getAcceptedEncodings(request):
+    """
+    Return the set of content codings listed in the Accept-Encoding
+    header of @request, leaving out any with q=0.
+    """
+    result = set()
+    for entry in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        params = [param.strip() for param in entry.split(';')]
+        if not params[0]:
+            continue
+        if any(re.match(r'q=0(\.0*)?$', param) for param in params[1:]):
+            continue
+        result.add(params[0].lower())
+    return result
+
+
+def etagMatches(request, etag):
+    etags = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+    # Django 1.11 and later keep the quotes and weak prefix
+    etags = [e[2:] if e.startswith('W/') else e for e in etags]
+    return '*' in etags or etag in [e.strip('"') for e in etags]
+
+
+def setSegmentCacheHeaders(response, etag, closed):
+    """
+    Closed segments get a far-future expiry; open segments may be cached
+    briefly and then must be revalidated with the ETag.
+    """
+    if etag is not None:
+        response['ETag'] = quote_etag(etag)
+    if closed:
+        patch_cache_control(response,
+                            public=True,
+                            max_age=CLOSED_SEGMENT_MAX_AGE_SECONDS,
+                            immutable=True)
+    else:
+        patch_cache_control(response,
+                            public=True,
+                            max_age=settings.XGDS_PLOT_OPEN_SEGMENT_MAX_AGE_SECONDS)
+    return response
+
+
+def getSegments(request, valueCode):
+    """
+    Return the buckets of time series @valueCode with timestamps in the
+    interval [start, end), given as posix times in milliseconds, merged
+    from all the segments at one level into a single JSON object. The
+    level is chosen to give at least 'points' buckets unless 'level' is
+    specified.
+    """
+    if valueCode not in meta.getTimeSeriesLookup():
+        return HttpResponseNotFound('<h1>404 No time series named "%s"</h1>' % valueCode)
+
+    try:
+        minTime, maxTime, numPoints, level = parseSegmentParams(request)
+        if level is None:
+            level = getSegmentLevelForInterval(minTime, maxTime, numPoints)
+    except ValueError, e:
+        return HttpResponseBadRequest(str(e))
+
+    # the response only changes when a segment in the range is rewritten,
+    # which the manifest records
+    indexMin, indexMax = getSegmentIndexRange(level, minTime, maxTime)
+    closed = isSegmentRangeClosed(level, indexMax, readSegmentStatus(valueCode))
+    manifest = segmentFile.readManifest(os.path.join(PLOT_DATA_DIR, valueCode), level)
+    if manifest is None:
+        etag = None
+    else:
+        versions = sorted([(t, mtime) for t, mtime in manifest[0].iteritems()
+                           if indexMin <= t < indexMax])
+        etag = hashlib.md5(repr((valueCode, level, minTime, maxTime, versions))).hexdigest()
+        if etagMatches(request, etag):
+            return setSegmentCacheHeaders(HttpResponseNotModified(), etag, closed)
+
+    try:
+        fields, data = readSegmentRange(valueCode, level, minTime, maxTime)
+    except ValueError, e:
+        return HttpResponseBadRequest(str(e))
+
+    result = {'valueCode': valueCode,
+              'level': level,
+              'start': minTime,
+              'end': maxTime,
+              'fields': fields,
+              'data': data}
+    return setSegmentCacheHeaders(HttpResponse(json.dumps(result),
+                                               content_type='application/json'),
+                                  etag, closed)
+
+
+def getSegmentFile(request, valueCode, level, index, extension):
+    """
+    Serve one output segment file with caching headers. The files are
+    also available statically under DATA_URL, but a static file server
+    can't tell whether a segment is closed.
+    """
+    if valueCode not in meta.getTimeSeriesLookup():
+        return HttpResponseNotFound('<h1>404 No time series named "%s"</h1>' % valueCode)
+    level = int(level)
+    index = int(index)
+    path = os.path.join(PLOT_DATA_DIR, valueCode, str(level), '%d.%s' % (index, extension))
+    if not os.path.exists(path):
+        return HttpResponseNotFound('<h1>404 No segment %d at level %d for time series "%s"</h1>'
+                                    % (index, level, valueCode))
+
+    # each copy has its own ETag, as required for different encodings
+    path, encoding = segmentFile.getEncodedPath(path, getAcceptedEncodings(request))
+    etag = getFileEtag(path)
+    closed = isSegmentRangeClosed(level, index + 1, readSegmentStatus(valueCode))
+    if etagMatches(request, etag):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(open(path, 'rb').read(),
+                                content_type=SEGMENT_CONTENT_TYPES[extension])
+        if encoding is not None:
+            response['Content-Encoding'] = encoding
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return setSegmentCacheHeaders(response, etag, closed)
+
+
+def getSegmentStatus(request, valueCode):
+    """
+    Serve the status.json file for @valueCode. Clients must revalidate
+    it on every use, which costs little with a conditional GET.
+    """
+    if valueCode not in meta.getTimeSeriesLookup():
+        return HttpResponseNotFound('<h1>404 No time series named "%s"</h1>' % valueCode)
+    path = os.path.join(PLOT_DATA_DIR, valueCode, 'status.json')
+    if not os.path.exists(path):
+        return HttpResponseNotFound('<h1>404 Time series "%s" has not been indexed</h1>' % valueCode)
+
+    etag = getFileEtag(path)
+    if etagMatches(request, etag):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(open(path, 'rb').read(),
+                                content_type='application/json')
+    response['ETag'] = quote_etag(etag)
+    patch_cache_control(response, no_cache=True)
+    return response
+
+
+def getSegmentsBatch(request):
+    """
+    Return the status and segment data of several time series in one
+    response, for loading the plots page in one round trip. Parameters:
+    's', a comma-separated list of valueCodes, and optionally start, end,
+    points and level as for getSegments(). The interval defaults to the
+    time range covered by all the time series. Data is returned for all
+    the segments that overlap the interval, as in getSegmentsCoveringInterval()
+    in xgds_plot.js. The response is streamed one time series at a time.
+    """
+    valueCodes = [code for code in request.GET.get('s', '').split(',') if code]
+    lookup = meta.getTimeSeriesLookup()
+    for valueCode in valueCodes:
+        if valueCode not in lookup:
+            return HttpResponseNotFound('<h1>404 No time series named "%s"</h1>' % valueCode)
+
+    statuses = dict([(valueCode, readSegmentStatus(valueCode))
+                     for valueCode in valueCodes])
+    segmentIndices = {}
+    try:
+        minTime, maxTime, numPoints, level = parseSegmentParams(request, requireInterval=False)
+        if minTime is None:
+            minTimes = [status['minTime'] for status in statuses.itervalues()
+                        if status and status['minTime'] is not None]
+            maxTimes = [status['maxTime'] for status in statuses.itervalues()
+                        if status and status['maxTime'] is not None]
+            if minTimes:
+                minTime = min(minTimes)
+                maxTime = max(max(maxTimes), minTime + 1)
+        if minTime is not None:
+            if level is None:
+                level = getSegmentLevelForInterval(minTime, maxTime, numPoints)
+            segmentLength = 2.0 ** level
+            indexMin, indexMax = getSegmentIndexRange(level, minTime, maxTime)
+            # include one extra segment, like getSegmentsCoveringInterval()
+            minTime = indexMin * segmentLength
+            maxTime = (indexMax + 1) * segmentLength
+            # check every range now; an error after the response has
+            # started streaming would truncate the JSON
+            for valueCode in valueCodes:
+                segmentIndices[valueCode] = getSegmentRangeIndices(valueCode, level,
+                                                                   minTime, maxTime)
+    except ValueError, e:
+        return HttpResponseBadRequest(str(e))
+
+    def generateResponse():
+        yield ('{"start": %s, "end": %s, "level": %s, "series": {'
+               % (json.dumps(minTime), json.dumps(maxTime), json.dumps(level)))
+        for i, valueCode in enumerate(valueCodes):
+            result = {'status': statuses[valueCode],
+                      'fields': [],
+                      'data': []}
+            if minTime is not None:
+                result['fields'], result['data'] = readSegmentRange(valueCode, level, minTime, maxTime,
+                                                                    segmentIndices[valueCode])
+            if i > 0:
+                yield ', '
+            yield '%s: %s' % (json.dumps(valueCode), json.dumps(result))
+        yield '}}'
+
+    # includes status, which changes constantly
+    response = StreamingHttpResponse(generateResponse(),
+                                     content_type='application/json')
+    patch_cache_control(response, no_cache=True)
+    return response